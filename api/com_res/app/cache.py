@@ -0,0 +1,372 @@
+"""
+In-process response cache with size-bounded LRU eviction and per-entry TTL.
+An optional backend (local disk or a Redis-compatible store) can be attached
+as a second tier so that cached entries survive restarts and can be shared
+between API workers.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Tuple, Union
+
+from config import get_settings
+
+
+class CacheBackend(ABC):
+    """
+    Interface for second-tier cache storage. Values must be JSON serializable,
+    except for BinaryDiskBackend, which stores bytes. The methods perform blocking
+    I/O, so TTLCache calls them from a worker thread in async code (see TTLCache.aget).
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Union[Tuple[Any, float], None]:
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: Any, expires_at: float) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        pass
+
+
+class FileBackend(CacheBackend):
+    """
+    Stores each entry as a file in a local directory. Expired entries are removed
+    when they are read, and the modification time of each file records when it was
+    last used, so that the least recently used files are evicted once the directory
+    holds more than maxsize entries. Subclasses define how entries are serialized.
+    """
+
+    SUFFIX = ""
+
+    def __init__(self, directory: Union[str, Path], maxsize: int = 10000, trim_interval: int = 100):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.maxsize = maxsize
+        self.trim_interval = trim_interval
+        self.__writes = 0
+
+    @abstractmethod
+    def serialize(self, value: Any, expires_at: float) -> bytes:
+        pass
+
+    @abstractmethod
+    def deserialize(self, content: bytes) -> Tuple[Any, float]:
+        pass
+
+    def __path(self, key: str) -> Path:
+        return self.directory / f"{hashlib.sha256(key.encode()).hexdigest()}{self.SUFFIX}"
+
+    def get(self, key: str) -> Union[Tuple[Any, float], None]:
+        path = self.__path(key)
+        try:
+            with open(path, "rb") as f:
+                value, expires_at = self.deserialize(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            logging.warning(f"Failed to read cache entry {path}: {e}")
+            return None
+
+        if expires_at <= time.time():
+            path.unlink(missing_ok=True)
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value, expires_at
+
+    def set(self, key: str, value: Any, expires_at: float) -> None:
+        path = self.__path(key)
+        # unique to the writing process and thread, since entries are written from worker threads
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(self.serialize(value, expires_at))
+
+        # replace atomically so that readers never see a partial entry
+        tmp_path.replace(path)
+
+        # trim periodically rather than on every write, which requires listing the directory
+        self.__writes += 1
+        if self.__writes % self.trim_interval == 0:
+            self.trim()
+
+    def delete(self, key: str) -> None:
+        self.__path(key).unlink(missing_ok=True)
+
+    def trim(self) -> None:
+        """
+        Evicts the least recently used entries until at most maxsize remain.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.SUFFIX):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    continue
+        if len(entries) <= self.maxsize:
+            return
+        entries.sort()
+        for _, path in entries[: len(entries) - self.maxsize]:
+            Path(path).unlink(missing_ok=True)
+
+
+class DiskBackend(FileBackend):
+    """
+    Stores each entry as a JSON file in a local directory (see FileBackend).
+    """
+
+    SUFFIX = ".json"
+
+    def serialize(self, value: Any, expires_at: float) -> bytes:
+        return json.dumps({"value": value, "expires_at": expires_at}).encode()
+
+    def deserialize(self, content: bytes) -> Tuple[Any, float]:
+        entry = json.loads(content)
+        return entry["value"], entry["expires_at"]
+
+
+class BinaryDiskBackend(FileBackend):
+    """
+    Stores bytes values, e.g. rendered map tiles, as files in a local directory
+    (see FileBackend). Each file starts with its expiration time.
+    """
+
+    SUFFIX = ".bin"
+    HEADER = struct.Struct("<d")
+
+    def serialize(self, value: bytes, expires_at: float) -> bytes:
+        return self.HEADER.pack(expires_at) + value
+
+    def deserialize(self, content: bytes) -> Tuple[bytes, float]:
+        (expires_at,) = self.HEADER.unpack_from(content)
+        return content[self.HEADER.size :], expires_at
+
+
+class RedisBackend(CacheBackend):
+    """
+    Stores entries in a Redis-compatible key-value store, e.g. Redis, Valkey, or a local stand-in.
+    Expiration is delegated to the store.
+    """
+
+    def __init__(self, url: str, prefix: str = "com_res"):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("The redis package is required to use the redis cache backend")
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key: str) -> Union[Tuple[Any, float], None]:
+        raw = self.client.get(f"{self.prefix}:{key}")
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        return entry["value"], entry["expires_at"]
+
+    def set(self, key: str, value: Any, expires_at: float) -> None:
+        ttl = max(int(expires_at - time.time()), 1)
+        self.client.set(f"{self.prefix}:{key}", json.dumps({"value": value, "expires_at": expires_at}), ex=ttl)
+
+    def delete(self, key: str) -> None:
+        self.client.delete(f"{self.prefix}:{key}")
+
+
+class TTLCache:
+    """
+    A size-bounded LRU cache where every entry carries its own time-to-live.
+    """
+
+    def __init__(self, maxsize: int = 512, backend: Union[CacheBackend, None] = None):
+        self.maxsize = maxsize
+        self.backend = backend
+        self.__entries: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.backend_hits = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __store(self, key: str, value: Any, expires_at: float) -> None:
+        self.__entries[key] = (value, expires_at)
+        self.__entries.move_to_end(key)
+
+        # evict the least recently used entries
+        while len(self.__entries) > self.maxsize:
+            self.__entries.popitem(last=False)
+            self.evictions += 1
+
+    def __memory_get(self, key: str, now: float) -> Union[Tuple[Any, float], None]:
+        entry = self.__entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] > now:
+            self.__entries.move_to_end(key)
+            return entry
+        del self.__entries[key]
+        return None
+
+    def __backend_get(self, key: str) -> Union[Tuple[Any, float], None]:
+        try:
+            return self.backend.get(key)
+        except Exception as e:
+            logging.warning(f"Cache backend lookup failed: {e}")
+            return None
+
+    def __backend_set(self, key: str, value: Any, expires_at: float) -> None:
+        try:
+            self.backend.set(key, value, expires_at)
+        except Exception as e:
+            logging.warning(f"Cache backend write failed: {e}")
+
+    def __backend_delete(self, key: str) -> None:
+        try:
+            self.backend.delete(key)
+        except Exception as e:
+            logging.warning(f"Cache backend delete failed: {e}")
+
+    def __result(
+        self, key: str, entry: Union[Tuple[Any, float], None], backend_entry: Union[Tuple[Any, float], None], now: float
+    ) -> Union[Any, None]:
+        # count the lookup, promoting entries from the second-tier backend into memory
+        if entry is not None:
+            self.hits += 1
+            return entry[0]
+        if backend_entry is not None and backend_entry[1] > now:
+            self.__store(key, *backend_entry)
+            self.hits += 1
+            self.backend_hits += 1
+            return backend_entry[0]
+        self.misses += 1
+        return None
+
+    def get(self, key: str) -> Union[Any, None]:
+        """
+        Returns the cached value for the key, or None if it is missing or expired.
+        The backend is read in the calling thread; use aget in async code.
+        """
+        now = time.time()
+        entry = self.__memory_get(key, now)
+        backend_entry = None
+        if entry is None and self.backend is not None:
+            backend_entry = self.__backend_get(key)
+        return self.__result(key, entry, backend_entry, now)
+
+    async def aget(self, key: str) -> Union[Any, None]:
+        """
+        Returns the cached value for the key like get, but reads the backend
+        in a worker thread so that its I/O does not block the event loop.
+        """
+        now = time.time()
+        entry = self.__memory_get(key, now)
+        backend_entry = None
+        if entry is None and self.backend is not None:
+            backend_entry = await asyncio.to_thread(self.__backend_get, key)
+        return self.__result(key, entry, backend_entry, now)
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        """
+        Stores a value for the key that expires after ttl seconds.
+        The backend is written in the calling thread; use aset in async code.
+        """
+        expires_at = time.time() + ttl
+        self.__store(key, value, expires_at)
+        if self.backend is not None:
+            self.__backend_set(key, value, expires_at)
+
+    async def aset(self, key: str, value: Any, ttl: float) -> None:
+        """
+        Stores a value for the key like set, but writes the backend (and trims
+        it, see FileBackend) in a worker thread.
+        """
+        expires_at = time.time() + ttl
+        self.__store(key, value, expires_at)
+        if self.backend is not None:
+            await asyncio.to_thread(self.__backend_set, key, value, expires_at)
+
+    def delete(self, key: str) -> None:
+        self.__entries.pop(key, None)
+        if self.backend is not None:
+            self.__backend_delete(key)
+
+    def stats(self) -> Dict[str, Union[int, float, str, None]]:
+        """
+        Returns hit/miss metrics for the cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.__entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "backend_hits": self.backend_hits,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "backend": type(self.backend).__name__ if self.backend is not None else None,
+        }
+
+
+def build_cache_backend(backend: str, location: str, prefix: str, disk_size: int = 10000) -> Union[CacheBackend, None]:
+    """
+    Builds a second-tier cache backend from its configured name.
+
+    Arguments:
+    ==========
+    backend: str - the backend name, one of "memory", "disk", or "redis".
+    location: str - the directory (disk) or connection url (redis) for the backend.
+    prefix: str - namespace used to separate caches that share a location.
+    disk_size: int - the maximum number of entries kept by the disk backend.
+
+    Returns:
+    ========
+    CacheBackend: the backend, or None when only the in-memory tier is used.
+    """
+    if backend == "memory":
+        return None
+    if backend == "disk":
+        return DiskBackend(Path(location) / prefix, maxsize=disk_size)
+    if backend == "redis":
+        return RedisBackend(location, prefix=prefix)
+    raise ValueError(f"Invalid cache backend: {backend}. Valid options are 'memory', 'disk', or 'redis'.")
+
+
+@lru_cache()
+def get_timeseries_cache() -> TTLCache:
+    __settings = get_settings()
+    backend = build_cache_backend(
+        __settings.timeseries_cache_backend,
+        __settings.timeseries_cache_location,
+        "timeseries",
+        disk_size=__settings.timeseries_cache_disk_size,
+    )
+    return TTLCache(maxsize=__settings.timeseries_cache_size, backend=backend)
+
+
+@lru_cache()
+def get_fim_tile_cache() -> TTLCache:
+    __settings = get_settings()
+    backend = None
+    if __settings.fim_tile_cache_location:
+        backend = BinaryDiskBackend(
+            Path(__settings.fim_tile_cache_location) / "fim_tiles", maxsize=__settings.fim_tile_cache_disk_size
+        )
+    return TTLCache(maxsize=__settings.fim_tile_cache_size, backend=backend)
@@ -0,0 +1,167 @@
+"""
+Application-scoped clients that are shared across requests. These are
+opened once in the FastAPI lifespan (see main.py) so that connections
+to upstream services are pooled and kept alive between requests.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Union
+
+import httpx
+from google.auth import default
+from google.cloud import bigquery
+
+from config import get_settings
+
+_http_client: Union[httpx.AsyncClient, None] = None
+_nwm_semaphore: Union[asyncio.Semaphore, None] = None
+
+_bigquery_client: Union[bigquery.Client, None] = None
+_bigquery_executor: Union[ThreadPoolExecutor, None] = None
+_bigquery_lock = threading.Lock()
+
+
+def _build_http_client() -> httpx.AsyncClient:
+    __settings = get_settings()
+    limits = httpx.Limits(
+        max_connections=__settings.nwm_http_max_connections,
+        max_keepalive_connections=__settings.nwm_http_max_connections,
+    )
+    return httpx.AsyncClient(limits=limits, timeout=__settings.nwm_http_timeout)
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Returns the shared async HTTP client used for upstream requests,
+    e.g. the CIROH NWM BigQuery proxy. The client is created lazily if
+    the application lifespan has not opened it (e.g. in scripts).
+
+    Returns:
+    ========
+    httpx.AsyncClient: the shared client with keep-alive connection pooling.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = _build_http_client()
+    return _http_client
+
+
+def get_nwm_semaphore() -> asyncio.Semaphore:
+    """
+    Returns the semaphore that bounds the number of requests in flight against
+    the NWM proxy. It is shared by every request handler so that the limit
+    applies to the whole process rather than to each call.
+
+    Returns:
+    ========
+    asyncio.Semaphore: the shared semaphore.
+    """
+    global _nwm_semaphore
+    if _nwm_semaphore is None:
+        _nwm_semaphore = asyncio.Semaphore(get_settings().nwm_max_concurrent_requests)
+    return _nwm_semaphore
+
+
+def _build_bigquery_client() -> bigquery.Client:
+    """Helper function to create BigQuery client with flexible credential handling"""
+    __settings = get_settings()
+
+    # 1. First try explicit service account path if configured
+    if hasattr(__settings, 'google_application_credentials_path'):
+        credentials_path = __settings.google_application_credentials_path
+        if credentials_path and os.path.exists(credentials_path):
+            try:
+                os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_path
+                credentials, project = default()
+                return bigquery.Client(credentials=credentials, project=project or "com-res")
+            except Exception as e:
+                logging.warning(f"GOOGLE_APPLICATION_CREDENTIALS auth failed: {e}")
+
+    # 2. Try Application Default Credentials
+    credentials, project = default()
+    return bigquery.Client(credentials=credentials, project=project or "com-res")  # Fallback project
+
+
+def get_bigquery_client() -> bigquery.Client:
+    """
+    Returns the shared BigQuery client. Credential discovery and client
+    construction happen once; the client is reused by every query.
+
+    Returns:
+    ========
+    bigquery.Client: the shared client.
+
+    Raises:
+    =======
+    google.auth.exceptions.DefaultCredentialsError: if no valid credentials are found.
+    """
+    global _bigquery_client
+    with _bigquery_lock:
+        if _bigquery_client is None:
+            _bigquery_client = _build_bigquery_client()
+        return _bigquery_client
+
+
+def _get_bigquery_executor() -> ThreadPoolExecutor:
+    global _bigquery_executor
+    with _bigquery_lock:
+        if _bigquery_executor is None:
+            _bigquery_executor = ThreadPoolExecutor(
+                max_workers=get_settings().bigquery_max_concurrency, thread_name_prefix="bigquery"
+            )
+        return _bigquery_executor
+
+
+async def run_bigquery(fn: Callable[..., Any], *args: Any) -> Any:
+    """
+    Runs a blocking BigQuery call off the event loop. Calls share a bounded
+    thread pool, which limits the number of concurrent queries.
+
+    Arguments:
+    ==========
+    fn: Callable - the blocking function to run, e.g. one that queries get_bigquery_client().
+    args: Any - the arguments passed to fn.
+
+    Returns:
+    ========
+    Any: the result of fn.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_get_bigquery_executor(), fn, *args)
+
+
+async def open_clients() -> None:
+    """
+    Opens the shared clients. Called on application startup.
+    """
+    get_http_client()
+    get_nwm_semaphore()
+
+    # build the BigQuery client up front so that the first request does not pay for
+    # credential discovery. Failures are logged and retried on the first query.
+    try:
+        await run_bigquery(get_bigquery_client)
+    except Exception as e:
+        logging.warning(f"Could not create BigQuery client on startup: {e}")
+
+
+async def close_clients() -> None:
+    """
+    Closes the shared clients and releases pooled connections. Called on application shutdown.
+    """
+    global _http_client, _nwm_semaphore, _bigquery_client, _bigquery_executor
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+    _nwm_semaphore = None
+
+    if _bigquery_client is not None:
+        _bigquery_client.close()
+        _bigquery_client = None
+
+    if _bigquery_executor is not None:
+        _bigquery_executor.shutdown(wait=False)
+        _bigquery_executor = None
@@ -0,0 +1,227 @@
+"""
+In-memory index of the FIM catalog. The catalog is small and read-mostly, so
+the JSONL (or Parquet) export written by fim/build-catalog.py is loaded once at
+startup, indexed by reach_id with its stages pre-sorted, and refreshed in the
+background. This keeps BigQuery out of the request path for reach lookups.
+"""
+
+import asyncio
+import io
+import logging
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Union
+
+import httpx
+import numpy
+import pandas
+
+from config import get_settings
+
+
+def public_url(url: str) -> str:
+    # replace the "gs://" prefix with "https://storage.googleapis.com/"
+    return url.replace("gs://", "https://storage.googleapis.com/")
+
+
+def huc_from_url(url: pandas.Series) -> pandas.Series:
+    # FIM assets are stored as .../flood_{huc}/{huc}_inundation/{reach_id}/{name}.cog
+    return url.str.extract(r"flood_(\d+)/", expand=False).fillna("")
+
+
+CATALOG_COLUMNS = ["reach_id", "huc", "stage", "flow", "asset_url"]
+
+BRACKET_COLUMNS = [f"{prefix}_{column}" for prefix in ("lower", "upper") for column in ("stage_m", "flow_cms", "file")]
+
+
+def read_catalog(source: str) -> pandas.DataFrame:
+    """
+    Reads the flattened FIM catalog from a local path or a url.
+
+    Arguments:
+    ==========
+    source: str - a local path, http(s) url, or gs:// url to a .jsonl or .parquet catalog export.
+
+    Returns:
+    ========
+    pandas.DataFrame: the catalog, containing reach_id, stage, flow, and asset_url columns.
+    """
+    if source.startswith(("http://", "https://", "gs://")):
+        response = httpx.get(public_url(source), timeout=get_settings().nwm_http_timeout)
+        response.raise_for_status()
+        data = io.BytesIO(response.content)
+    else:
+        data = Path(source)
+
+    if source.endswith(".parquet"):
+        return pandas.read_parquet(data)
+    return pandas.read_json(data, lines=True)
+
+
+def interpolate_stage(entry: dict, flows: numpy.ndarray) -> pandas.DataFrame:
+    """
+    Finds the FIM assets that bracket each flow and linearly interpolates the stage
+    between them. The bracketing assets are found with a binary search on the flows
+    of the reach, which are ordered by stage and increase monotonically with it.
+
+    Arguments:
+    ==========
+    entry: dict - the FIM data of a reach, as returned by FimCatalog.lookup.
+    flows: numpy.ndarray - the flows to look up in cms.
+
+    Returns:
+    ========
+    pandas.DataFrame: one row per flow containing flow_cms, stage_m, and the stage_m, flow_cms, and file
+                      of the lower and upper bracketing assets. Brackets that do not exist, e.g. for
+                      flows outside of the rating table, and their interpolated stage are missing.
+    """
+    flows = numpy.asarray(flows, dtype=numpy.float64)
+    table_flows = numpy.asarray(entry["flows_cms"], dtype=numpy.float64)
+    table_stages = numpy.asarray(entry["stages_m"], dtype=numpy.float64)
+    files = numpy.asarray(entry["files"], dtype=object)
+
+    df = pandas.DataFrame(dict(flow_cms=flows, stage_m=numpy.nan))
+    for column in BRACKET_COLUMNS:
+        df[column] = None
+    if len(table_flows) == 0:
+        return df
+
+    # binary search for the number of assets with a flow at or below each flow
+    upper = numpy.searchsorted(table_flows, flows, side="right")
+    lower = upper - 1
+    has_lower = lower >= 0
+    has_upper = upper < len(table_flows)
+    lower = numpy.clip(lower, 0, len(table_flows) - 1)
+    upper = numpy.clip(upper, 0, len(table_flows) - 1)
+
+    f0, f1 = table_flows[lower], table_flows[upper]
+    s0, s1 = table_stages[lower], table_stages[upper]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        stages = numpy.where(has_lower & has_upper, s0 + (flows - f0) / (f1 - f0) * (s1 - s0), numpy.nan)
+    # a flow that matches the highest asset exactly has no upper bracket
+    df["stage_m"] = numpy.where(has_lower & ~has_upper & (flows == f0), s0, stages)
+
+    for prefix, index, valid in (("lower", lower, has_lower), ("upper", upper, has_upper)):
+        df[f"{prefix}_stage_m"] = numpy.where(valid, table_stages[index].astype(object), None)
+        df[f"{prefix}_flow_cms"] = numpy.where(valid, table_flows[index].astype(object), None)
+        df[f"{prefix}_file"] = numpy.where(valid, files[index], None)
+    return df
+
+
+class FimCatalog:
+    def __init__(self, source: str):
+        self.source = source
+        self.loaded_at: Union[float, None] = None
+        self.__index: Dict[str, dict] = {}
+        self.__table = pandas.DataFrame(columns=CATALOG_COLUMNS)
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.loaded_at is not None
+
+    def load(self) -> None:
+        """
+        Loads the catalog and replaces the index. The new index is built
+        before it is swapped in, so lookups are never served a partial index.
+        """
+        df = read_catalog(self.source)
+        df = df.sort_values(["reach_id", "stage"], kind="stable")
+        table = pandas.DataFrame(
+            dict(
+                reach_id=df.reach_id.astype(str),
+                huc=huc_from_url(df.asset_url),
+                stage=df.stage.astype(float),
+                flow=df.flow.astype(float),
+                asset_url=df.asset_url.map(public_url),
+            )
+        ).reset_index(drop=True)
+
+        index = {}
+        for reach_id, group in table.groupby("reach_id", sort=False):
+            index[reach_id] = dict(
+                files=group.asset_url.tolist(),
+                flows_cms=group.flow.tolist(),
+                stages_m=group.stage.tolist(),
+            )
+
+        self.__index = index
+        self.__table = table
+        self.loaded_at = time.time()
+        logging.info(f"Loaded FIM catalog with {len(index)} reaches from {self.source}")
+
+    def lookup(self, reach_id: str) -> dict:
+        """
+        Returns the FIM data of a reach ordered by stage.
+
+        Arguments:
+        ==========
+        reach_id: str - the NWM reach ID.
+
+        Returns:
+        ========
+        dict: a dictionary containing the files, flows_cms, and stages_m of the reach. The lists are empty for unknown reaches.
+        """
+        return self.__index.get(str(reach_id).strip(), dict(files=[], flows_cms=[], stages_m=[]))
+
+    def select(self, reach_ids: Union[List[str], None] = None, huc: Union[str, None] = None) -> pandas.DataFrame:
+        """
+        Returns the catalog entries of many reaches at once, ordered by reach and stage.
+
+        Arguments:
+        ==========
+        reach_ids: Union[List[str], None] - the NWM reach IDs to select.
+        huc: Union[str, None] - the HUC8 to select all reaches of.
+
+        Returns:
+        ========
+        pandas.DataFrame: the reach_id, huc, stage, flow, and asset_url of every matching FIM asset.
+        """
+        table = self.__table
+        mask = pandas.Series(True, index=table.index)
+        if reach_ids is not None:
+            mask &= table.reach_id.isin(reach_ids)
+        if huc is not None:
+            mask &= table.huc == huc
+        return table[mask]
+
+    async def refresh_forever(self, interval: float) -> None:
+        """
+        Periodically reloads the catalog off the event loop. Failed reloads keep the previous index.
+        """
+        while True:
+            try:
+                await asyncio.to_thread(self.load)
+            except Exception as e:
+                logging.warning(f"Failed to load FIM catalog from {self.source}: {e}")
+            await asyncio.sleep(interval)
+
+
+_refresh_task: Union[asyncio.Task, None] = None
+
+
+@lru_cache()
+def get_fim_catalog() -> FimCatalog:
+    return FimCatalog(get_settings().fim_catalog_source)
+
+
+async def start_fim_catalog() -> None:
+    """
+    Starts loading and periodically refreshing the FIM catalog. Called on application startup.
+    Lookups fall back to BigQuery until the first load completes.
+    """
+    global _refresh_task
+    __settings = get_settings()
+    if not __settings.fim_catalog_source:
+        return
+    _refresh_task = asyncio.create_task(get_fim_catalog().refresh_forever(__settings.fim_catalog_refresh_interval))
+
+
+async def stop_fim_catalog() -> None:
+    """
+    Stops refreshing the FIM catalog. Called on application shutdown.
+    """
+    global _refresh_task
+    if _refresh_task is not None:
+        _refresh_task.cancel()
+        _refresh_task = None
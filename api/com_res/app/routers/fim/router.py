@@ -1,42 +1,151 @@
+import asyncio
 import logging
-import os
+from typing import List, Union
 
-from fastapi import APIRouter, HTTPException, Query
+import pandas
+from fastapi import APIRouter, HTTPException, Path, Query, Request
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
-from google.auth import default, exceptions
+from fastapi.responses import HTMLResponse, JSONResponse, Response
 from google.cloud import bigquery
 
+from app.cache import get_fim_tile_cache
+from app.clients import get_bigquery_client, run_bigquery
+from app.routers.timeseries.forecast import Forecasts, parse_forecast_request
+from app.routers.timeseries.formats import OutputFormats, binary_response, columnar_response, negotiate_output_format
+from app.routers.timeseries.reference_times import resolve_reference_time
+from app.singleflight import get_single_flight
 from config import get_settings
 
+from .catalog import CATALOG_COLUMNS, get_fim_catalog, huc_from_url, interpolate_stage, public_url
+from .tiles import render_tile
+
 router = APIRouter()
 
 
-def get_bigquery_client():
-    """Helper function to create BigQuery client with flexible credential handling"""
-    __settings = get_settings()
+def query_fim_catalog(reach_id: str) -> dict:
+    """
+    Queries the FIM catalog in BigQuery for a given reach ID.
 
-    # 1. First try explicit service account path if configured
-    if hasattr(__settings, 'google_application_credentials_path'):
-        credentials_path = __settings.google_application_credentials_path
-        if credentials_path and os.path.exists(credentials_path):
-            try:
-                os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_path
-                credentials, project = default()
-                return bigquery.Client(credentials=credentials, project=project or "com-res")
-            except Exception as e:
-                logging.warning(f"GOOGLE_APPLICATION_CREDENTIALS auth failed: {e}")
-
-    # 2. Try Application Default Credentials
-    try:
-        credentials, project = default()
-        return bigquery.Client(credentials=credentials, project=project or "com-res")  # Fallback project
-    except exceptions.DefaultCredentialsError as e:
-        logging.error("No valid credentials found")
-        raise HTTPException(status_code=500, detail=f"Could not authenticate with BigQuery credentials: {str(e)}")
+    Arguments:
+    ==========
+    reach_id: str - the NWM reach ID for which to collect data.
 
+    Returns:
+    ========
+    dict: a dictionary containing the files, flows_cms, and stages_m of the reach ordered by stage.
+    """
+    client = get_bigquery_client()
 
-router = APIRouter()
+    query = """
+    SELECT *
+    FROM `com-res.flood_data.fim_catalog`
+    WHERE reach_id = @reach_id
+    ORDER BY stage ASC
+    """
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("reach_id", "INT64", reach_id),
+        ]
+    )
+
+    query_job = client.query(query, job_config=job_config)
+
+    results = dict(files=[], flows_cms=[], stages_m=[])
+
+    for row in query_job:
+        # TODO fix the "public_url listing in bigQuery"
+        # https://cuahsi.atlassian.net/browse/CAM-797
+        results['files'].append(row['asset_url'])
+        results['stages_m'].append(row['stage'])
+        results['flows_cms'].append(row['flow'])
+
+    # replace the "gs://" prefix with "https://storage.googleapis.com/"
+    results['files'] = [url.replace("gs://", "https://storage.googleapis.com/") for url in results['files']]
+
+    return results
+
+
+def query_fim_catalog_bulk(reach_ids: Union[List[str], None], huc: Union[str, None]) -> pandas.DataFrame:
+    """
+    Queries the FIM catalog in BigQuery for many reaches at once.
+
+    Arguments:
+    ==========
+    reach_ids: Union[List[str], None] - the NWM reach IDs to select.
+    huc: Union[str, None] - the HUC8 to select all reaches of.
+
+    Returns:
+    ========
+    pandas.DataFrame: the reach_id, huc, stage, flow, and asset_url of every matching FIM asset.
+    """
+    client = get_bigquery_client()
+
+    filters = []
+    query_parameters = []
+    if reach_ids is not None:
+        filters.append("reach_id IN UNNEST(@reach_ids)")
+        query_parameters.append(bigquery.ArrayQueryParameter("reach_ids", "INT64", [int(r) for r in reach_ids]))
+    if huc is not None:
+        filters.append("STRPOS(asset_url, @huc_prefix) > 0")
+        query_parameters.append(bigquery.ScalarQueryParameter("huc_prefix", "STRING", f"/flood_{huc}/"))
+
+    query = f"""
+    SELECT reach_id, stage, flow, asset_url
+    FROM `com-res.flood_data.fim_catalog`
+    WHERE {" AND ".join(filters)}
+    ORDER BY reach_id ASC, stage ASC
+    """
+
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+    rows = [dict(row) for row in client.query(query, job_config=job_config)]
+    df = pandas.DataFrame(rows, columns=["reach_id", "stage", "flow", "asset_url"])
+
+    return pandas.DataFrame(
+        dict(
+            reach_id=df.reach_id.astype(str),
+            huc=huc_from_url(df.asset_url),
+            stage=df.stage.astype(float),
+            flow=df.flow.astype(float),
+            asset_url=df.asset_url.map(public_url),
+        ),
+        columns=CATALOG_COLUMNS,
+    )
+
+
+async def lookup_fim(reach_id: str) -> dict:
+    """
+    Looks up the FIM data of a reach. Lookups are served from the in-memory
+    catalog index, and only fall back to BigQuery while the index has not been loaded.
+
+    Arguments:
+    ==========
+    reach_id: str - the NWM reach ID for which to collect data.
+
+    Returns:
+    ========
+    dict: a dictionary containing the files, flows_cms, and stages_m of the reach ordered by stage.
+
+    Raises:
+    =======
+    HTTPException: if the BigQuery operation fails.
+    """
+    # serve the lookup from the in-memory catalog index once it has loaded
+    catalog = get_fim_catalog()
+    if catalog.is_loaded:
+        return catalog.lookup(reach_id)
+
+    try:
+        # concurrent requests for the same reach share a single BigQuery query,
+        # which runs in the bounded BigQuery thread pool so that it does not block the event loop.
+        return await get_single_flight().do(
+            f"fim:{reach_id}",
+            lambda: run_bigquery(query_fim_catalog, reach_id),
+        )
+
+    except Exception as e:
+        logging.error(f"Query failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"BigQuery operation failed: {str(e)}")
 
 
 @router.get("/fim")
@@ -58,38 +167,208 @@ async def get_fim(
     Raises:
     =======
     HTTPException: if the BigQuery operation fails or if the reach ID is not found.
+
+    Lookups are served from the in-memory catalog index, and only fall back to
+    BigQuery while the index has not been loaded.
     """
-    try:
-        client = get_bigquery_client()
-
-        query = """
-        SELECT *
-        FROM `com-res.flood_data.fim_catalog`
-        WHERE reach_id = @reach_id
-        ORDER BY stage ASC
-        """
-
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("reach_id", "INT64", reach_id),
-            ]
-        )
+    results = await lookup_fim(reach_id)
+    return JSONResponse(content=jsonable_encoder(results))
+
+
+@router.get("/fim/bulk")
+async def get_fim_bulk(
+    request: Request,
+    reach_ids: Union[str, None] = Query(
+        None, description="Comma separated NWM reach identifiers.", example="8584970,8585000"
+    ),
+    huc: Union[str, None] = Query(None, description="A HUC8 to select all reaches of.", example="11010001"),
+    output_format: Union[str, None] = Query(None, description="json (default), compact, arrow, or parquet."),
+) -> Response:
+    """
+    Get FIM data for many reaches at once, e.g. to prefetch the catalog of a whole region.
+
+    Arguments:
+    ==========
+    reach_ids: str - a comma separated list of NWM reach IDs.
+    huc: str - a HUC8 identifier. All reaches with FIM in this HUC are returned.
+    output_format: str - the output format: json, compact, arrow, or parquet.
+                         Defaults to the Accept header, or json.
+
+    Returns:
+    ========
+    Response: a columnar table in the form {"reach_id": [...], "huc": [...], "stage": [...], "flow": [...], "asset_url": [...]},
+              ordered by reach and stage.
+
+    Raises:
+    =======
+    HTTPException: if neither reach_ids nor huc is provided, too many reaches are requested, or the BigQuery operation fails.
+    """
+    fmt = negotiate_output_format(request, output_format)
+
+    ids = None
+    if reach_ids is not None:
+        ids = list(dict.fromkeys(r.strip() for r in reach_ids.split(",") if r.strip() != ""))
+        max_reaches = get_settings().fim_bulk_max_reaches
+        if len(ids) > max_reaches:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Too many reach IDs: {len(ids)}. At most {max_reaches} are allowed per request.",
+            )
+    huc = huc.strip() if huc is not None else None
+    if not ids and not huc:
+        raise HTTPException(status_code=400, detail="Either reach_ids or huc must be provided.")
+
+    catalog = get_fim_catalog()
+    if catalog.is_loaded:
+        df = catalog.select(ids, huc)
+    else:
+        try:
+            key = f"fim-bulk:{sorted(ids) if ids else None}:{huc}"
+            df = await get_single_flight().do(key, lambda: run_bigquery(query_fim_catalog_bulk, ids, huc))
+        except Exception as e:
+            logging.error(f"Query failed: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"BigQuery operation failed: {str(e)}")
+
+    if fmt in (OutputFormats.JSON, OutputFormats.COMPACT):
+        return JSONResponse(content={column: df[column].tolist() for column in CATALOG_COLUMNS})
+    return binary_response(df[CATALOG_COLUMNS], fmt)
+
+
+@router.get("/fim/stage")
+async def get_fim_stage(
+    request: Request,
+    reach_id: str = Query(..., description="The unique NWM reach identifier.", example="8584970"),
+    flow: Union[float, None] = Query(None, description="The flow to look up in cms.", example=250.0),
+    date_time: Union[str, None] = Query(
+        None,
+        description="The reference time of a forecast to look up in UTC, in the YYYY-MM-DD HH:MM:SS format, or 'latest'. Used when flow is not provided.",
+        example="latest",
+    ),
+    forecast: str = Query(
+        "short_range",
+        description="The forecast simulation to look up. Acceptable values include 'short_range', 'medium_range, or 'long_range'",
+        example="short_range",
+    ),
+    ensemble: str = Query("0", description="The forecast ensemble member to look up (default: 0)", example="0"),
+    output_format: Union[str, None] = Query(
+        None, description="The output format of forecast lookups: 'json' (default), 'compact', 'arrow', or 'parquet'."
+    ),
+) -> Response:
+    """
+    Finds the FIM assets that bracket a flow and the interpolated stage for a given reach ID.
+    Either a single flow, or the reference time of a forecast is looked up, in which case
+    every timestep of the forecast is matched to the FIM assets of the reach.
+
+    Arguments:
+    ==========
+    reach_id: str - the NWM reach ID for which to collect data.
+    flow: float - the flow to look up in cms.
+    date_time: str - the reference time of the forecast to look up, or 'latest'.
+    forecast: str - the forecast simulation to look up (default: short_range).
+    ensemble: str - the forecast ensemble member to look up (default: 0).
+    output_format: str - the output format of forecast lookups (default: json).
+
+    Returns:
+    ========
+    Response: for a flow, a dictionary in the form {"flow_cms": ..., "stage_m": ..., "lower": {"stage_m", "flow_cms", "file"}, "upper": {...}}.
+              For a forecast, a columnar table of the same values with one row per forecast time.
+              Brackets outside of the rating table of the reach are null.
 
-        query_job = client.query(query, job_config=job_config)
+    Raises:
+    =======
+    HTTPException: if neither flow nor date_time is provided, or the lookup fails.
+    """
+    if flow is None and date_time is None:
+        raise HTTPException(status_code=400, detail="Either flow or date_time must be provided.")
+
+    fmt = negotiate_output_format(request, output_format)
+    entry = await lookup_fim(reach_id)
 
-        results = dict(files=[], flows_cms=[], stages_m=[])
+    if flow is not None:
+        row = interpolate_stage(entry, [flow]).iloc[0]
+        content = dict(flow_cms=row.flow_cms, stage_m=None if pandas.isna(row.stage_m) else row.stage_m)
+        for prefix in ("lower", "upper"):
+            content[prefix] = None
+            # missing brackets may be None or NaN, depending on the dtype pandas infers
+            if pandas.notna(row[f"{prefix}_file"]):
+                content[prefix] = {column: row[f"{prefix}_{column}"] for column in ("stage_m", "flow_cms", "file")}
+        return JSONResponse(content=jsonable_encoder(content))
 
-        for row in query_job:
-            # TODO fix the "public_url listing in bigQuery"
-            # https://cuahsi.atlassian.net/browse/CAM-797
-            results['files'].append(row['asset_url'])
-            results['stages_m'].append(row['stage'])
-            results['flows_cms'].append(row['flow'])
+    fdata = Forecasts()
+    parsed = parse_forecast_request(fdata, forecast, ensemble)
+    if isinstance(parsed, HTMLResponse):
+        return parsed
+    ftype, valid_ensemble = parsed
 
-        # replace the "gs://" prefix with "https://storage.googleapis.com/"
-        results['files'] = [url.replace("gs://", "https://storage.googleapis.com/") for url in results['files']]
+    dt = await resolve_reference_time(date_time, ftype)
 
+    try:
+        await fdata.collect_forecasts([reach_id], ftype, [dt], valid_ensemble)
     except Exception as e:
-        logging.error(f"Query failed: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"BigQuery operation failed: {str(e)}")
-    return JSONResponse(content=jsonable_encoder(results))
+        raise HTTPException(status_code=500, detail=f"Failed to fetch forecast data: {str(e)}")
+
+    df = interpolate_stage(entry, fdata.df.streamflow.to_numpy())
+    df.insert(0, "time", fdata.df.time.to_numpy())
+    return columnar_response(df, fmt)
+
+
+@router.get("/fim/tiles/{z}/{x}/{y}.png")
+async def get_fim_tile(
+    z: int = Path(..., ge=0, le=24, description="The zoom level."),
+    x: int = Path(..., ge=0, description="The tile column."),
+    y: int = Path(..., ge=0, description="The tile row."),
+    reach_id: str = Query(..., description="The unique NWM reach identifier.", example="8584970"),
+    stage: float = Query(..., description="The stage of the FIM asset to render in meters.", example=1.5),
+) -> Response:
+    """
+    Renders an XYZ map tile of the FIM asset of a reach at a given stage.
+    Only the parts of the COG that cover the tile are read, and rendered
+    tiles are cached in memory and on disk.
+
+    Arguments:
+    ==========
+    z: int - the zoom level.
+    x: int - the tile column.
+    y: int - the tile row.
+    reach_id: str - the NWM reach ID.
+    stage: float - the stage of the FIM asset in meters, as listed by /fim.
+
+    Returns:
+    ========
+    Response: a PNG tile where inundated pixels are colored and all other pixels are transparent.
+
+    Raises:
+    =======
+    HTTPException: if the tile or the FIM asset does not exist, or the tile cannot be rendered.
+    """
+    if x >= 2**z or y >= 2**z:
+        raise HTTPException(status_code=404, detail=f"Tile {z}/{x}/{y} does not exist.")
+
+    entry = await lookup_fim(reach_id)
+    matches = [f for f, s in zip(entry["files"], entry["stages_m"]) if abs(s - stage) < 1e-6]
+    if len(matches) == 0:
+        raise HTTPException(status_code=404, detail=f"No FIM asset found for reach {reach_id} at stage {stage}m.")
+    url = matches[0]
+
+    __settings = get_settings()
+    size = __settings.fim_tile_size
+    headers = {"Cache-Control": f"public, max-age={__settings.fim_tile_cache_ttl}"}
+
+    cache = get_fim_tile_cache()
+    key = f"{url}/{z}/{x}/{y}@{size}"
+    content = await cache.aget(key)
+    if content is None:
+        try:
+            # concurrent requests for the same tile share one render, which runs in a
+            # worker thread because reading the COG and encoding the PNG are blocking.
+            content = await get_single_flight().do(
+                f"fim-tile:{key}", lambda: asyncio.to_thread(render_tile, url, z, x, y, size)
+            )
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Tile rendering requires the rasterio package.")
+        except Exception as e:
+            logging.error(f"Failed to render tile {z}/{x}/{y} of {url}: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Failed to render tile: {str(e)}")
+        await cache.aset(key, content, __settings.fim_tile_cache_ttl)
+
+    return Response(content=content, media_type="image/png", headers=headers)
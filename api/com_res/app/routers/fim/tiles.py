@@ -0,0 +1,119 @@
+"""
+Server-side rendering of FIM map tiles. Tiles are rendered from the FIM
+COGs with windowed range reads, so only the COG blocks (or overviews) that
+cover a tile are downloaded, rather than the whole file. Rendered tiles are
+cached in memory and on local disk (see app.cache.get_fim_tile_cache).
+
+rasterio is imported lazily so that the API can run without it when tiles
+are not served.
+"""
+
+import warnings
+from typing import Tuple
+
+import numpy
+
+# the half-width of the web mercator (EPSG:3857) extent in meters
+ORIGIN_SHIFT = 20037508.342789244
+
+# RGBA color of inundated pixels, matching the frontend layers
+INUNDATED_COLOR = (0, 0, 255, 255)
+
+# GDAL options for reading COGs over http with as few requests as possible
+GDAL_OPTIONS = dict(
+    GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR",
+    CPL_VSIL_CURL_ALLOWED_EXTENSIONS=".cog,.tif,.tiff",
+    GDAL_HTTP_MERGE_CONSECUTIVE_RANGES="YES",
+    GDAL_HTTP_MULTIPLEX="YES",
+    VSI_CACHE="TRUE",
+)
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """
+    Returns the web mercator bounds of an XYZ tile.
+
+    Arguments:
+    ==========
+    z: int - the zoom level.
+    x: int - the tile column.
+    y: int - the tile row, counted from the top.
+
+    Returns:
+    ========
+    Tuple[float, float, float, float]: the left, bottom, right, and top bounds in EPSG:3857.
+    """
+    size = 2 * ORIGIN_SHIFT / 2**z
+    left = -ORIGIN_SHIFT + x * size
+    top = ORIGIN_SHIFT - y * size
+    return left, top - size, left + size, top
+
+
+def encode_png(rgba: numpy.ndarray) -> bytes:
+    """
+    Encodes a (4, height, width) uint8 array as a PNG.
+    """
+    import rasterio
+    from rasterio.errors import NotGeoreferencedWarning
+    from rasterio.io import MemoryFile
+
+    _, height, width = rgba.shape
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        with rasterio.Env(), MemoryFile() as memfile:
+            with memfile.open(driver="PNG", width=width, height=height, count=4, dtype="uint8") as dst:
+                dst.write(rgba)
+            return memfile.read()
+
+
+def render_tile(url: str, z: int, x: int, y: int, size: int = 256) -> bytes:
+    """
+    Renders an XYZ tile of a FIM COG as a PNG. Inundated pixels are colored and
+    all other pixels are transparent. Only the COG blocks that intersect the tile
+    are read, from the overview that best matches the tile resolution.
+
+    Arguments:
+    ==========
+    url: str - the public url of the COG.
+    z: int - the zoom level.
+    x: int - the tile column.
+    y: int - the tile row, counted from the top.
+    size: int - the width and height of the tile in pixels (default: 256).
+
+    Returns:
+    ========
+    bytes: the PNG encoded tile.
+    """
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.transform import from_bounds
+    from rasterio.vrt import WarpedVRT
+    from rasterio.warp import transform_bounds
+
+    left, bottom, right, top = tile_bounds(z, x, y)
+    rgba = numpy.zeros((4, size, size), dtype=numpy.uint8)
+
+    with rasterio.Env(**GDAL_OPTIONS):
+        with rasterio.open(f"/vsicurl/{url}") as src:
+            src_left, src_bottom, src_right, src_top = transform_bounds(src.crs, "EPSG:3857", *src.bounds)
+            intersects = src_left < right and src_right > left and src_bottom < top and src_top > bottom
+
+            if intersects:
+                # warp straight into the tile grid. GDAL picks the overview that
+                # matches the tile resolution and only reads the blocks it needs.
+                with WarpedVRT(
+                    src,
+                    crs="EPSG:3857",
+                    transform=from_bounds(left, bottom, right, top, size, size),
+                    width=size,
+                    height=size,
+                    resampling=Resampling.nearest,
+                ) as vrt:
+                    data = vrt.read(1)
+                    valid = vrt.read_masks(1) > 0
+
+                inundated = valid & (data > 0)
+                for band, value in enumerate(INUNDATED_COLOR):
+                    rgba[band][inundated] = value
+
+    return encode_png(rgba)
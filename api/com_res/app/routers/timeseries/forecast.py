@@ -8,18 +8,22 @@ Description: This script contains helper functions for collecting National
 Author(s): Tony Castronova <acastronova@cuahsi.org>
 """
 
-import concurrent.futures
-import io
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
 from enum import Enum
-from typing import List, Union
+from typing import List, Tuple, Union
 
+import numpy
 import pandas
-import requests
+from fastapi.responses import HTMLResponse
+
+from app.clients import get_http_client, get_nwm_semaphore
+from app.singleflight import get_single_flight
 
 # import environment variables from config
 from config import get_settings
 
+from .formats import read_nwm_response
+
 
 class ForecastTypes(Enum):
     """
@@ -75,48 +79,72 @@ class Forecasts:
         else:
             return [i for i in ensembles if i in valid_ensembles]
 
-    def fetch_url(self, params):
-        try:
-            response = requests.get(self.url, params=params, headers=self.header)
+    async def fetch_url(self, params):
+        # use the application-scoped client so that connections to
+        # the proxy are pooled and kept alive between requests.
+        client = get_http_client()
+
+        async def fetch():
+            response = await client.get(self.url, params=params, headers=self.header)
 
             # Raise an exception for HTTP errors
             response.raise_for_status()
             return response
 
-        except requests.exceptions.RequestException as e:
-            return f"Error fetching {self.url}: {e}"
+        # identical requests that are already in flight share a single upstream call
+        key = f"{self.url}?{sorted(params.items())}"
+        return await get_single_flight().do(key, fetch)
 
-    def fetch_async(self, params_list):
+    async def fetch_async(self, params_list):
 
         results = []
         errors = []
 
-        # Use ThreadPoolExecutor to make concurrent GET requests
-        with ThreadPoolExecutor(max_workers=5) as executor:
+        # issue the GET requests concurrently without blocking the event loop,
+        # limiting the number that are in flight against the proxy at once across
+        # all requests handled by this process.
+        semaphore = get_nwm_semaphore()
 
-            # Submit all URLs to the executor
-            future_to_url = {executor.submit(self.fetch_url, param): param for param in params_list}
+        async def fetch_limited(param):
+            async with semaphore:
+                return await self.fetch_url(param)
 
-            # Process the results as they complete
-            for future in concurrent.futures.as_completed(future_to_url):
-                url = future_to_url[future]
-                try:
-                    res = future.result()
+        responses = await asyncio.gather(
+            *[fetch_limited(param) for param in params_list],
+            return_exceptions=True,
+        )
 
-                    # attempt to get the status code.
-                    # if one is not returned, we should log
-                    # it as an error.
-                    status_code = res.status_code
+        # separate the successful responses from those that failed
+        for param, res in zip(params_list, responses):
+            if isinstance(res, Exception):
+                errors.append(f"Exception for {self.url} {param}: {res}")
+            else:
+                results.append(res)
 
-                    # otherwise, the
-                    results.append(res)
+        return results, errors
 
-                except Exception as e:
-                    errors.append(f"Exception for {url}: {e}")
+    def forecast_params(
+        self,
+        comids: List[str],
+        forecast_type: ForecastTypes,
+        reference_time: str,
+        ensembles: Union[List[int], None] = None,
+    ) -> dict:
+        """
+        Builds the query parameters that request a single forecast cycle from the API.
+        """
+        # get ensembles
+        valid_ensembles = self.filter_forecast_ensembles(forecast_type, ensembles=ensembles)
 
-            return results, errors
+        return {
+            "comids": ",".join(map(str, comids)),
+            "forecast_type": forecast_type.value,
+            "reference_time": reference_time,
+            "ensemble": ",".join(map(str, valid_ensembles)),
+            "output_format": get_settings().nwm_output_format,
+        }
 
-    def collect_forecasts(
+    async def collect_forecasts(
         self,
         comids: List[str],
         forecast_type: ForecastTypes,
@@ -127,37 +155,105 @@ class Forecasts:
         :param ensembles: list or str - A list of user-defined ensembles to filter, or 'all' to return all ensembles.
         """
 
-        # get ensembles
-        valid_ensembles = self.filter_forecast_ensembles(forecast_type, ensembles=ensembles)
-
         # build a parameters to query
-        params = [
-            {
-                "comids": ",".join(map(str, comids)),
-                "forecast_type": forecast_type.value,
-                "reference_time": reftime,
-                "ensemble": ",".join(map(str, valid_ensembles)),
-                "output_format": "csv",
-            }
-            for reftime in reference_times
-        ]
+        params = [self.forecast_params(comids, forecast_type, reftime, ensembles) for reftime in reference_times]
 
         # query the api asynchronously with the parameters defined above
-        responses, errors = self.fetch_async(params)
-        # TODO: do something if we encounter an error.
+        responses, errors = await self.fetch_async(params)
 
         # filter out only the successful responses and
         # convert them into a single pandas dataframe
         successful_responses = [resp for resp in responses if resp.status_code == 200]
-        dfs = [pandas.read_csv(io.StringIO(res.text), sep=",") for res in successful_responses]
+        dfs = [read_nwm_response(res, ["time", "reference_time"]) for res in successful_responses]
 
-        if len(dfs) > 1:
+        if len(dfs) == 0:
+            raise RuntimeError(f"Failed to collect forecast data: {errors}")
+        elif len(dfs) > 1:
             df = pandas.concat(dfs, ignore_index=True)
         else:
             df = dfs[0]
 
-        # clean datetime columns and return
-        df.time = pandas.to_datetime(df.time)
-        df.reference_time = pandas.to_datetime(df.reference_time)
-
         self.df = df
+
+    def ensemble_statistics(self, percentiles: List[float], include_members: bool = False) -> pandas.DataFrame:
+        """
+        Computes per-timestep statistics across the ensemble members of the collected forecast.
+        Members that end earlier than others (e.g. medium_range members 2-6) are ignored
+        for the timesteps they do not cover.
+
+        Arguments:
+        ==========
+        percentiles: List[float] - the percentiles to compute, between 0 and 100.
+        include_members: bool - whether to include the raw streamflow of each member (default: False).
+
+        Returns:
+        ========
+        pandas.DataFrame: one row per timestep with time, count, mean, min, max, and p<percentile>
+                          columns, plus member_<ensemble> columns when include_members is True.
+        """
+
+        # arrange the members as columns so that statistics are computed along rows
+        members = self.df.pivot_table(index="time", columns="ensemble", values="streamflow", aggfunc="first")
+        members = members.sort_index()
+        values = members.to_numpy(dtype=numpy.float64)
+
+        stats = pandas.DataFrame(
+            {
+                "time": members.index,
+                "count": numpy.count_nonzero(~numpy.isnan(values), axis=1),
+                "mean": numpy.nanmean(values, axis=1),
+                "min": numpy.nanmin(values, axis=1),
+                "max": numpy.nanmax(values, axis=1),
+            }
+        )
+
+        if len(percentiles) > 0:
+            for percentile, row in zip(percentiles, numpy.nanpercentile(values, percentiles, axis=1)):
+                stats[f"p{percentile:g}"] = row
+
+        if include_members:
+            for member in members.columns:
+                stats[f"member_{member}"] = members[member].to_numpy()
+
+        return stats
+
+
+def parse_forecast_request(
+    fdata: Forecasts, forecast: str, ensemble: str
+) -> Union[Tuple[ForecastTypes, List[int]], HTMLResponse]:
+    """
+    Validates the forecast type and ensemble member of a forecast request.
+
+    Arguments:
+    ==========
+    fdata: Forecasts - the forecast collector used to look up valid ensembles.
+    forecast: str - the forecast simulation for which to collect data.
+    ensemble: str - the forecast ensemble member for which data will be collected.
+
+    Returns:
+    ========
+    Tuple[ForecastTypes, List[int]]: the forecast type and valid ensemble, or an HTMLResponse describing the error.
+    """
+    try:
+        ftype = ForecastTypes(forecast)
+    except ValueError:
+        error_message = (
+            f'Invalid forecast type: {forecast}. Valid options are "short_range", "medium_range", or "long_range".'
+        )
+        return HTMLResponse(
+            content=f"<h1>Error 404</h1><p>{error_message}</p>",
+            status_code=404,
+        )
+
+    valid_ensemble = fdata.filter_forecast_ensembles(ftype, [int(ensemble)])
+    if len(valid_ensemble) == 0:
+        all_valid_ensembles = fdata.filter_forecast_ensembles(ftype)
+        error_message = (
+            f"Invalid ensemble member: {ensemble}. Valid options for {forecast} are {all_valid_ensembles}.",
+        )
+        return HTMLResponse(
+            content=f"<h1>Error 404</h1><p>{error_message}</p>",
+            status_code=404,
+        )
+
+    return ftype, valid_ensemble
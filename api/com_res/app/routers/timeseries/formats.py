@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+"""
+Description: This script contains helper functions for reading National Water
+             Model timeseries returned by the BigQuery API and serializing them
+             into the output formats supported by the timeseries endpoints. All
+             conversions are vectorized with pyarrow/pandas/NumPy rather than
+             looping over rows in Python.
+"""
+
+import io
+from enum import Enum
+from typing import List, Union
+
+import httpx
+import numpy
+import pandas
+import pyarrow
+import pyarrow.csv
+import pyarrow.ipc
+import pyarrow.parquet
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse, Response
+
+
+class OutputFormats(Enum):
+    """
+    Output formats supported by the timeseries endpoints.
+
+    - json: a dictionary in the form {date: streamflow, ...} (default)
+    - compact: a columnar dictionary in the form {times: [epoch seconds, ...], values: [...]}
+    - arrow: an Apache Arrow IPC stream
+    - parquet: an Apache Parquet file
+    """
+
+    JSON = "json"
+    COMPACT = "compact"
+    ARROW = "arrow"
+    PARQUET = "parquet"
+
+
+MEDIA_TYPES = {
+    OutputFormats.ARROW: "application/vnd.apache.arrow.stream",
+    OutputFormats.PARQUET: "application/vnd.apache.parquet",
+}
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def read_csv_table(body: pyarrow.Buffer, time_columns: List[str]) -> pyarrow.Table:
+    """
+    Parses CSV bytes into an Arrow table, converting the time columns to
+    timestamps while the CSV is parsed.
+    """
+    convert_options = pyarrow.csv.ConvertOptions(
+        column_types={column: pyarrow.timestamp("ns") for column in time_columns},
+    )
+    try:
+        return pyarrow.csv.read_csv(pyarrow.BufferReader(body), convert_options=convert_options)
+    except pyarrow.ArrowInvalid:
+        # times that arrow cannot parse natively, e.g. with a UTC suffix,
+        # are left as strings and converted by pandas afterwards.
+        return pyarrow.csv.read_csv(pyarrow.BufferReader(body))
+
+
+def read_nwm_response(response: httpx.Response, time_columns: List[str]) -> pandas.DataFrame:
+    """
+    Parses a BigQuery API response into a dataframe. Parquet and Arrow IPC
+    bodies are read directly; CSV bodies are parsed from the raw bytes with
+    the pyarrow CSV reader instead of being decoded into text first.
+
+    Arguments:
+    ==========
+    response: httpx.Response - a successful response from the BigQuery API.
+    time_columns: List[str] - the columns to convert to datetimes, e.g. time and reference_time.
+
+    Returns:
+    ========
+    pandas.DataFrame: the parsed data with naive UTC datetime time columns.
+    """
+    # wrap the response bytes without copying them
+    body = pyarrow.py_buffer(response.content)
+    content_type = response.headers.get("content-type", "")
+
+    if "parquet" in content_type or response.content[:4] == b"PAR1":
+        table = pyarrow.parquet.read_table(pyarrow.BufferReader(body))
+    elif "arrow" in content_type:
+        table = pyarrow.ipc.open_stream(body).read_all()
+    else:
+        table = read_csv_table(body, time_columns)
+
+    df = table.to_pandas()
+    for column in time_columns:
+        if column in df.columns:
+            df[column] = naive_utc(df[column])
+    return df
+
+
+def naive_utc(times: pandas.Series) -> pandas.Series:
+    """
+    Converts a series of times into naive datetimes in UTC, so that times
+    parsed with and without a UTC suffix can be compared with each other.
+    Times without a timezone are assumed to be in UTC already, and every
+    series is returned with the nanosecond resolution of the CSV fast path.
+    """
+    if not pandas.api.types.is_datetime64_any_dtype(times):
+        times = pandas.to_datetime(times, utc=True)
+    if times.dt.tz is not None:
+        times = times.dt.tz_convert(None)
+    return times.astype("datetime64[ns]")
+
+
+def negotiate_output_format(request: Request, output_format: Union[str, None]) -> OutputFormats:
+    """
+    Determines the output format of a timeseries response. An explicit
+    output_format query parameter takes precedence over the Accept header.
+
+    Arguments:
+    ==========
+    request: Request - the incoming request.
+    output_format: Union[str, None] - the output format requested via query parameter.
+
+    Returns:
+    ========
+    OutputFormats: the output format of the response.
+
+    Raises:
+    =======
+    HTTPException: if the requested output format is not supported.
+    """
+    if output_format is not None:
+        try:
+            return OutputFormats(output_format)
+        except ValueError:
+            valid_formats = [f.value for f in OutputFormats]
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid output format: {output_format}. Valid options are {valid_formats}.",
+            )
+
+    accept = request.headers.get("accept", "")
+    for fmt, media_type in MEDIA_TYPES.items():
+        if media_type in accept:
+            return fmt
+    return OutputFormats.JSON
+
+
+def epoch_seconds(times: pandas.Series) -> numpy.ndarray:
+    """
+    Converts a datetime series into integer seconds since the unix epoch.
+    """
+    return times.to_numpy(dtype="datetime64[s]").astype(numpy.int64)
+
+
+def compact_timeseries(df: pandas.DataFrame, value_column: str = "streamflow") -> dict:
+    """
+    Converts a timeseries into the compact columnar layout.
+
+    Arguments:
+    ==========
+    df: pandas.DataFrame - timeseries data containing time and value columns.
+    value_column: str - the name of the value column (default: streamflow).
+
+    Returns:
+    ========
+    dict: a dictionary in the form {"times": [epoch seconds, ...], "values": [...]}
+    """
+    return {
+        "times": epoch_seconds(df.time).tolist(),
+        "values": df[value_column].tolist(),
+    }
+
+
+def frame_from_compact(data: dict, value_column: str = "streamflow") -> pandas.DataFrame:
+    """
+    Converts a compact columnar timeseries back into a dataframe.
+    """
+    return pandas.DataFrame(
+        {
+            "time": pandas.to_datetime(numpy.asarray(data["times"], dtype=numpy.int64), unit="s"),
+            value_column: numpy.asarray(data["values"], dtype=numpy.float64),
+        }
+    )
+
+
+def timeseries_by_reach(df: pandas.DataFrame, reach_ids: List[str], compact: bool = False) -> dict:
+    """
+    Converts a multi-reach timeseries into a columnar dictionary keyed by reach.
+
+    Arguments:
+    ==========
+    df: pandas.DataFrame - timeseries data containing feature_id, time, and streamflow columns.
+    reach_ids: List[str] - the requested reach IDs. Reaches without data are returned with empty series.
+    compact: bool - return times as epoch seconds and values under "values" (default: False).
+
+    Returns:
+    ========
+    dict: a dictionary in the form {reach_id: {"times": [...], "streamflow": [...]}, ...}
+    """
+    value_key = "values" if compact else "streamflow"
+    data = {reach_id: {"times": [], value_key: []} for reach_id in reach_ids}
+    df = df.sort_values("time")
+    for feature_id, group in df.groupby(df.feature_id.astype(str)):
+        times = epoch_seconds(group.time) if compact else group.time.dt.strftime(TIME_FORMAT)
+        data[feature_id] = {
+            "times": times.tolist(),
+            value_key: group.streamflow.tolist(),
+        }
+    return data
+
+
+def timeseries_response(
+    df: pandas.DataFrame, output_format: OutputFormats, reach_ids: Union[List[str], None] = None
+) -> Response:
+    """
+    Serializes a timeseries into the requested output format.
+
+    Arguments:
+    ==========
+    df: pandas.DataFrame - timeseries data containing time and streamflow columns, and feature_id for batches.
+    output_format: OutputFormats - the output format of the response.
+    reach_ids: Union[List[str], None] - the requested reach IDs for batch responses, or None for a single reach.
+
+    Returns:
+    ========
+    Response: the serialized timeseries.
+    """
+    if output_format == OutputFormats.JSON:
+        if reach_ids is not None:
+            return JSONResponse(content=timeseries_by_reach(df, reach_ids))
+        data = dict(zip(df.time.dt.strftime(TIME_FORMAT).tolist(), df.streamflow.tolist()))
+        return JSONResponse(content=data)
+
+    if output_format == OutputFormats.COMPACT:
+        if reach_ids is not None:
+            return JSONResponse(content=timeseries_by_reach(df, reach_ids, compact=True))
+        return JSONResponse(content=compact_timeseries(df))
+
+    columns = ["feature_id", "time", "streamflow"] if reach_ids is not None else ["time", "streamflow"]
+    return binary_response(df[columns], output_format)
+
+
+def binary_response(df: pandas.DataFrame, output_format: OutputFormats) -> Response:
+    """
+    Serializes a dataframe into an Arrow IPC stream or a Parquet file.
+
+    Arguments:
+    ==========
+    df: pandas.DataFrame - the data to serialize. All columns are included.
+    output_format: OutputFormats - either OutputFormats.ARROW or OutputFormats.PARQUET.
+
+    Returns:
+    ========
+    Response: the serialized data.
+    """
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+
+    if output_format == OutputFormats.ARROW:
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        content = sink.getvalue().to_pybytes()
+    else:
+        buffer = io.BytesIO()
+        pyarrow.parquet.write_table(table, buffer)
+        content = buffer.getvalue()
+
+    return Response(content=content, media_type=MEDIA_TYPES[output_format])
+
+
+def columnar_response(df: pandas.DataFrame, output_format: OutputFormats) -> Response:
+    """
+    Serializes a table of per-timestep values into the requested output format.
+    JSON responses are columnar, in the form {"times": [...], column: [...], ...},
+    where missing values are returned as null.
+
+    Arguments:
+    ==========
+    df: pandas.DataFrame - the data to serialize, containing a time column.
+    output_format: OutputFormats - the output format of the response.
+
+    Returns:
+    ========
+    Response: the serialized data.
+    """
+    if output_format in (OutputFormats.JSON, OutputFormats.COMPACT):
+        times = epoch_seconds(df.time) if output_format == OutputFormats.COMPACT else df.time.dt.strftime(TIME_FORMAT)
+        data = {"times": times.tolist()}
+        for column in df.columns.drop("time"):
+            values = df[column]
+            data[column] = values.astype(object).where(values.notna(), None).tolist()
+        return JSONResponse(content=data)
+
+    return binary_response(df, output_format)
@@ -8,17 +8,22 @@ Description: This script contains helper functions for collecting National
 Author(s): Tony Castronova <acastronova@cuahsi.org>
 """
 
-import concurrent.futures
-import io
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+from datetime import date, datetime, timedelta, timezone
 from enum import Enum
+from typing import List, Tuple
 
 import pandas
-import requests
+
+from app.clients import get_http_client, get_nwm_semaphore
+from app.singleflight import get_single_flight
 
 # import environment variables from config
 from config import get_settings
 
+from .formats import naive_utc, read_nwm_response
+from .store import HistoricalStore
+
 
 class Offsets(Enum):
     """
@@ -60,76 +65,192 @@ class AnalysisAssim:
 
         return [offset for offset in offsets if id in self.OFFSETS]
 
-    def fetch_url(self, params):
-        try:
-            response = requests.get(self.url, params=params, headers=self.header)
+    async def fetch_url(self, params):
+        # use the application-scoped client so that connections to
+        # the proxy are pooled and kept alive between requests.
+        client = get_http_client()
+
+        async def fetch():
+            response = await client.get(self.url, params=params, headers=self.header)
 
             # Raise an exception for HTTP errors
             response.raise_for_status()
             return response
 
-        except requests.exceptions.RequestException as e:
-            return f"Error fetching {self.url}: {e}"
+        # identical requests that are already in flight share a single upstream call
+        key = f"{self.url}?{sorted(params.items())}"
+        return await get_single_flight().do(key, fetch)
 
-    def fetch_async(self, params_list):
+    async def fetch_async(self, params_list):
 
         results = []
         errors = []
 
-        # Use ThreadPoolExecutor to make concurrent GET requests
-        # TQDM is used to provide a nice looking progress bar
-        with ThreadPoolExecutor(max_workers=5) as executor:
-
-            # Submit all URLs to the executor
-            future_to_url = {executor.submit(self.fetch_url, param): param for param in params_list}
+        # issue the GET requests concurrently without blocking the event loop,
+        # limiting the number that are in flight against the proxy at once across
+        # all requests handled by this process.
+        semaphore = get_nwm_semaphore()
 
-            # Process the results as they complete
-            for future in concurrent.futures.as_completed(future_to_url):
-                url = future_to_url[future]
-                try:
-                    res = future.result()
-                    # attempt to get the status code.
-                    # if one is not returned, we should log
-                    # it as an error.
-                    status_code = res.status_code
+        async def fetch_limited(param):
+            async with semaphore:
+                return await self.fetch_url(param)
 
-                    # otherwise, the
-                    results.append(res)
+        responses = await asyncio.gather(
+            *[fetch_limited(param) for param in params_list],
+            return_exceptions=True,
+        )
 
-                except Exception as e:
-                    errors.append(f"Exception for {url}: {e}")
+        # separate the successful responses from those that failed
+        for param, res in zip(params_list, responses):
+            if isinstance(res, Exception):
+                errors.append(f"Exception for {self.url} {param}: {res}")
+            else:
+                results.append(res)
 
-            return results, errors
+        return results, errors
 
-    def collect_analysis_assim(self, comids, start_time, end_time, offsets="all"):
+    async def fetch_analysis_assim(self, comids, start_time, end_time, offsets="all") -> pandas.DataFrame:
+        """
+        Collects analysis and assimilation data for the given reaches and time range.
+
+        Arguments:
+        ==========
+        comids: List[str] - the NWM reach IDs for which to collect data.
+        start_time: str - the start of the time range, e.g. YYYY-MM-DD.
+        end_time: str - the end of the time range, e.g. YYYY-MM-DD.
+        offsets: list or str - the analysis_assim result time offsets.
+
+        Returns:
+        ========
+        pandas.DataFrame: the collected data with a datetime `time` column.
+        """
 
         # get ensembles
         valid_offsets = self.filter_analysis_assim_offsets(offsets)
 
-        # build a parameters to query
-        params = {
-            "comids": ",".join(map(str, comids)),
-            "start_time": start_time,
-            "end_time": end_time,
-            "offsets": ",".join(map(str, valid_offsets)),
-            "output_format": "csv",
-        }
+        # build a parameters to query. Long time ranges are split into
+        # month-sized windows so that they are collected concurrently.
+        params = [
+            {
+                "comids": ",".join(map(str, comids)),
+                "start_time": window_start,
+                "end_time": window_end,
+                "offsets": ",".join(map(str, valid_offsets)),
+                "output_format": get_settings().nwm_output_format,
+            }
+            for window_start, window_end in split_time_range(start_time, end_time)
+        ]
 
         # query the api asynchronously with the parameters defined above
-        responses, errors = self.fetch_async([params])
-        # TODO: do something if we encounter an error.
+        responses, errors = await self.fetch_async(params)
+
+        # fail if any window is missing, otherwise the timeseries would contain gaps
+        if len(errors) > 0:
+            raise RuntimeError(f"Failed to collect analysis and assimilation data: {errors}")
 
         # filter out only the successful responses and
         # convert them into a single pandas dataframe
         successful_responses = [resp for resp in responses if resp.status_code == 200]
-        dfs = [pandas.read_csv(io.StringIO(res.text), sep=",") for res in successful_responses]
+        dfs = [read_nwm_response(res, ["time"]) for res in successful_responses]
 
         if len(dfs) > 1:
             df = pandas.concat(dfs, ignore_index=True)
         else:
             df = dfs[0]
 
-        # clean datetime columns and return
-        df.time = pandas.to_datetime(df.time)
+        # reassemble the windows in time order and remove
+        # the values at the shared window boundaries.
+        df = df.sort_values("time", kind="stable").drop_duplicates(subset=["feature_id", "time"], ignore_index=True)
+
+        return df
+
+    async def collect_analysis_assim(self, comids, start_time, end_time, offsets="all"):
+
+        self.df = await self.fetch_analysis_assim(comids, start_time, end_time, offsets)
+
+    async def collect_analysis_assim_incremental(
+        self, comid: str, start_date: date, end_date: date, offset: str, store: HistoricalStore
+    ):
+        """
+        Collects analysis and assimilation data for a single reach, reading closed
+        days from the local store and only collecting the missing date ranges
+        from the API. Days that have not closed yet are always collected.
+
+        Arguments:
+        ==========
+        comid: str - the NWM reach ID for which to collect data.
+        start_date: date - the start date of the data collection.
+        end_date: date - the end date of the data collection.
+        offset: str - the analysis_assim result time offset.
+        store: HistoricalStore - the local store used to persist closed days.
+        """
+
+        closed_end = min(end_date, last_closed_day())
+        dfs = []
 
-        self.df = df
+        if start_date <= closed_end:
+            # collect each missing range concurrently. Each range is requested through the
+            # following midnight so that every hour of its last day is included. The store
+            # reads and writes Parquet files in worker threads so the event loop is not blocked.
+            gaps = await asyncio.to_thread(store.missing_ranges, comid, offset, start_date, closed_end)
+            gap_dfs = await asyncio.gather(
+                *[
+                    self.fetch_analysis_assim(
+                        [comid], gap_start.isoformat(), (gap_end + timedelta(days=1)).isoformat(), offset
+                    )
+                    for gap_start, gap_end in gaps
+                ]
+            )
+            for (gap_start, gap_end), gap_df in zip(gaps, gap_dfs):
+                await asyncio.to_thread(store.write, comid, offset, gap_df, gap_start, gap_end)
+
+            dfs.append(await asyncio.to_thread(store.read, comid, offset, start_date, closed_end))
+
+        if end_date > closed_end:
+            trailing_start = max(start_date, closed_end + timedelta(days=1))
+            dfs.append(
+                await self.fetch_analysis_assim([comid], trailing_start.isoformat(), end_date.isoformat(), offset)
+            )
+
+        df = pandas.concat([d for d in dfs if len(d) > 0] or dfs, ignore_index=True)
+
+        # stored and collected times are compared as naive UTC, like the requested dates
+        df["time"] = naive_utc(df.time)
+        df = df.drop_duplicates(subset="time", keep="last").sort_values("time", ignore_index=True)
+
+        # limit the result to the requested window, matching a direct request for it
+        df = df.loc[(df.time >= pandas.Timestamp(start_date)) & (df.time <= pandas.Timestamp(end_date))]
+
+        self.df = df.reset_index(drop=True)
+
+
+def last_closed_day() -> date:
+    """
+    Returns the most recent day (UTC) whose analysis and assimilation data is
+    complete and no longer changes.
+    """
+    return datetime.now(timezone.utc).date() - timedelta(days=2)
+
+
+def split_time_range(start_time: str, end_time: str) -> List[Tuple[str, str]]:
+    """
+    Splits a time range into month-sized windows. Consecutive windows share
+    their boundary so that no values are lost regardless of whether the API
+    treats the end of a range as inclusive.
+
+    Arguments:
+    ==========
+    start_time: str - the start of the time range, e.g. YYYY-MM-DD.
+    end_time: str - the end of the time range, e.g. YYYY-MM-DD.
+
+    Returns:
+    ========
+    List[Tuple[str, str]]: the (start_time, end_time) of each window.
+    """
+    boundaries = [
+        boundary.strftime("%Y-%m-%d")
+        for boundary in pandas.date_range(start_time, end_time, freq="MS")
+        if pandas.Timestamp(start_time) < boundary < pandas.Timestamp(end_time)
+    ]
+    edges = [start_time] + boundaries + [end_time]
+    return list(zip(edges[:-1], edges[1:]))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+"""
+Description: This script contains helper functions for discovering the most
+             recent National Water Model forecast reference time that is
+             available from the BiGQuery API. Resolved reference times are
+             cached until the next forecast cycle is expected.
+"""
+
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import List
+
+import httpx
+from fastapi import HTTPException
+from pydantic import TypeAdapter, ValidationError
+
+from app.cache import TTLCache
+
+# import environment variables from config
+from config import get_settings
+
+from .forecast import Forecasts, ForecastTypes
+from .formats import read_nwm_response
+
+# The number of hours between consecutive NWM forecast cycles
+CYCLE_HOURS = {
+    ForecastTypes.SHORT: 1,
+    ForecastTypes.MEDIUM: 6,
+    ForecastTypes.LONG: 6,
+}
+
+REFERENCE_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def expected_reference_times(forecast_type: ForecastTypes, now: datetime, count: int) -> List[datetime]:
+    """
+    Lists the most recent forecast cycles that could have been issued before now, newest first.
+
+    Arguments:
+    ==========
+    forecast_type: ForecastTypes - the forecast type.
+    now: datetime - the current time in UTC.
+    count: int - the number of cycles to list.
+
+    Returns:
+    ========
+    List[datetime]: the reference times of the cycles.
+    """
+    hours = CYCLE_HOURS[forecast_type]
+    latest = now.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+    latest -= timedelta(hours=latest.hour % hours)
+    return [latest - timedelta(hours=hours * i) for i in range(count)]
+
+
+class ReferenceTimeResolver:
+    def __init__(self):
+        __settings = get_settings()
+        self.lookback = __settings.nwm_reference_time_lookback
+        self.retry_seconds = __settings.nwm_reference_time_retry
+        self.probe_reach_id = __settings.nwm_reference_time_probe_reach_id
+        self.cache = TTLCache(maxsize=len(CYCLE_HOURS))
+
+    async def is_available(self, forecast_type: ForecastTypes, reference_time: datetime) -> bool:
+        """
+        Checks whether the API returns data for a forecast cycle. Only a 404 or an
+        empty response means that the cycle is not available; other HTTP errors
+        and transport errors are raised, so that an outage of the API is not
+        reported as a missing forecast.
+
+        Raises:
+        =======
+        httpx.HTTPStatusError: if the API responds with an error other than 404.
+        httpx.TransportError: if the API cannot be reached.
+        """
+        fdata = Forecasts()
+        params = fdata.forecast_params(
+            [self.probe_reach_id], forecast_type, reference_time.strftime(REFERENCE_TIME_FORMAT), [0]
+        )
+        try:
+            response = await fdata.fetch_url(params)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                return False
+            raise
+
+        # the API may answer with an empty body rather than a 404, which cannot be parsed
+        if len(response.content.strip()) == 0:
+            return False
+        return len(read_nwm_response(response, ["time", "reference_time"])) > 0
+
+    async def latest(self, forecast_type: ForecastTypes) -> datetime:
+        """
+        Returns the most recent reference time with available data for a forecast type.
+        The result is cached until the next cycle is expected to be published.
+
+        Arguments:
+        ==========
+        forecast_type: ForecastTypes - the forecast type.
+
+        Returns:
+        ========
+        datetime: the latest available reference time (UTC, naive).
+
+        Raises:
+        =======
+        LookupError: if none of the recent cycles are available.
+        httpx.HTTPError: if the API fails or cannot be reached (see is_available).
+        """
+        cached = self.cache.get(forecast_type.value)
+        if cached is not None:
+            return datetime.strptime(cached, REFERENCE_TIME_FORMAT)
+
+        now = datetime.now(timezone.utc)
+        candidates = expected_reference_times(forecast_type, now, self.lookback)
+        for candidate in candidates:
+            if await self.is_available(forecast_type, candidate):
+                break
+        else:
+            raise LookupError(f"No {forecast_type.value} forecast is available for the last {self.lookback} cycles.")
+
+        # keep the result until the next cycle is expected. If a newer cycle
+        # has already been issued but is not published yet, check again soon.
+        next_cycle = candidates[0] + timedelta(hours=CYCLE_HOURS[forecast_type])
+        ttl = (next_cycle - now.replace(tzinfo=None)).total_seconds()
+        if candidate != candidates[0]:
+            ttl = min(ttl, self.retry_seconds)
+
+        self.cache.set(forecast_type.value, candidate.strftime(REFERENCE_TIME_FORMAT), ttl)
+        return candidate
+
+
+@lru_cache()
+def get_reference_time_resolver() -> ReferenceTimeResolver:
+    return ReferenceTimeResolver()
+
+
+async def resolve_reference_time(date_time: str, forecast_type: ForecastTypes) -> str:
+    """
+    Resolves the reference time of a forecast request.
+
+    Arguments:
+    ==========
+    date_time: str - the reference time in UTC, or 'latest' for the most recent available forecast.
+    forecast_type: ForecastTypes - the forecast type.
+
+    Returns:
+    ========
+    str: the reference time in the YYYY-MM-DD HH:MM:SS format.
+
+    Raises:
+    =======
+    HTTPException: if the reference time is invalid, no recent forecast is available, or the API fails.
+    """
+    if date_time.strip().lower() == "latest":
+        try:
+            reference_time = await get_reference_time_resolver().latest(forecast_type)
+        except LookupError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except httpx.HTTPStatusError as e:
+            raise HTTPException(
+                status_code=502,
+                detail=f"The NWM API responded with {e.response.status_code} while resolving the latest reference time.",
+            )
+        except httpx.TransportError as e:
+            raise HTTPException(
+                status_code=503, detail=f"The NWM API is unavailable while resolving the latest reference time: {e}"
+            )
+    else:
+        try:
+            reference_time = TypeAdapter(datetime).validate_python(date_time)
+        except ValidationError:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid date_time: {date_time}. Use the YYYY-MM-DD HH:MM:SS format or 'latest'.",
+            )
+    return reference_time.strftime("%Y-%m-%d %H:%M:%S")
@@ -1,16 +1,105 @@
-from datetime import date, datetime
+from datetime import date
+from typing import List, Union
 
-from fastapi import APIRouter, HTTPException, Query
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import HTMLResponse, JSONResponse, Response
 
-from .forecast import Forecasts, ForecastTypes
-from .historical import AnalysisAssim
+from app.cache import get_timeseries_cache
+from config import get_settings
+
+from .forecast import Forecasts, parse_forecast_request
+from .formats import (
+    columnar_response,
+    compact_timeseries,
+    frame_from_compact,
+    negotiate_output_format,
+    timeseries_response,
+)
+from .historical import AnalysisAssim, last_closed_day
+from .reference_times import resolve_reference_time
+from .store import get_historical_store
 
 router = APIRouter()
 
+reach_ids_example = "5984765,5984767"
+
+
+def parse_reach_ids(reach_ids: str) -> List[str]:
+    """
+    Parses a comma separated list of reach identifiers for the batch endpoints.
+
+    Arguments:
+    ==========
+    reach_ids: str - a comma separated list of NWM reach IDs.
+
+    Returns:
+    ========
+    List[str]: the unique reach IDs in the order they were provided.
+
+    Raises:
+    =======
+    HTTPException: if no reach IDs are provided or the batch limit is exceeded.
+    """
+    ids = list(dict.fromkeys(r.strip() for r in reach_ids.split(",") if r.strip() != ""))
+    max_reaches = get_settings().timeseries_batch_max_reaches
+    if len(ids) == 0:
+        raise HTTPException(status_code=400, detail="At least one reach ID must be provided.")
+    if len(ids) > max_reaches:
+        raise HTTPException(
+            status_code=400, detail=f"Too many reach IDs: {len(ids)}. At most {max_reaches} are allowed per request."
+        )
+    return ids
+
+
+def parse_percentiles(percentiles: str) -> List[float]:
+    """
+    Parses a comma separated list of percentiles.
+
+    Arguments:
+    ==========
+    percentiles: str - a comma separated list of percentiles between 0 and 100.
+
+    Returns:
+    ========
+    List[float]: the parsed percentiles.
+
+    Raises:
+    =======
+    HTTPException: if a percentile is not a number between 0 and 100.
+    """
+    try:
+        values = [float(p) for p in percentiles.split(",") if p.strip() != ""]
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid percentiles: {percentiles}.")
+    if any(p < 0 or p > 100 for p in values):
+        raise HTTPException(status_code=400, detail=f"Percentiles must be between 0 and 100: {percentiles}.")
+    return values
+
+
+def historical_cache_ttl(end_date: date) -> int:
+    """
+    Returns the number of seconds a historical response may be cached for.
+    Analysis and assimilation data for days that have closed does not change,
+    so windows ending on a closed day are kept much longer than windows that
+    include the trailing, still-updating days.
+
+    Arguments:
+    ==========
+    end_date: date - the end date of the requested window.
+
+    Returns:
+    ========
+    int: the time-to-live in seconds.
+    """
+    __settings = get_settings()
+    if end_date <= last_closed_day():
+        return __settings.timeseries_cache_closed_ttl
+    return __settings.timeseries_cache_ttl
+
 
 @router.get("/timeseries/nwm-historical")
 async def get_historical_nwm(
+    request: Request,
     reach_id: str = Query(..., description="The unique NWM reach identifier.", example="5984765"),
     start_date: date = Query(
         ...,
@@ -27,7 +116,12 @@ async def get_historical_nwm(
         description="The simulation time offset, supported values are 1,2, and 3 (default: 3).",
         example="3",
     ),
-) -> JSONResponse:
+    output_format: Union[str, None] = Query(
+        None,
+        description="The output format: 'json' (default), 'compact', 'arrow', or 'parquet'. Arrow and Parquet may also be requested via the Accept header.",
+        example="compact",
+    ),
+) -> Response:
     """
     Collects historical NWM data for a given reach ID and time range.
     This uses the CIROH-hosted API for accessing Google BigQuery.
@@ -38,33 +132,56 @@ async def get_historical_nwm(
     start_date: datetime - the start date and time for the data collection.
     end_date: datetime - the end date and time for the data collection.
     offset: int - the analysis_assim result time offset. Supported values are 1, 2, and 3.
+    output_format: str - the output format of the response (default: json).
 
 
     Returns:
     ========
-    JSONResponse: a dictionary containing the timeseries of data for the given reach during the given time period in the form {date: streamflow, ...}
+    Response: a dictionary containing the timeseries of data for the given reach during the given time period in the form {date: streamflow, ...}, or in the requested output format
     """
 
-    # collect historical analysis and assimilation data
-    adata = AnalysisAssim()
     st = start_date.strftime("%Y-%m-%d")
     et = end_date.strftime("%Y-%m-%d")
-    adata.collect_analysis_assim([reach_id], st, et, offsets=str(offset))
 
-    data = {
-        time.strftime("%Y-%m-%d %H:%M:%S"): streamflow
-        for time, streamflow in zip(adata.df["time"], adata.df["streamflow"])
-    }
+    fmt = negotiate_output_format(request, output_format)
+
+    # return the cached response if this window was recently collected.
+    # Responses are cached in the compact layout so that they can be
+    # served in any output format.
+    cache = get_timeseries_cache()
+    cache_key = f"nwm-historical:{reach_id}:{st}:{et}:{offset}"
+    data = await cache.aget(cache_key)
+    if data is not None:
+        return timeseries_response(frame_from_compact(data), fmt)
+
+    # collect historical analysis and assimilation data
+    adata = AnalysisAssim()
+    await adata.collect_analysis_assim_incremental(reach_id, start_date, end_date, str(offset), get_historical_store())
+
+    await cache.aset(cache_key, compact_timeseries(adata.df), historical_cache_ttl(end_date))
+
+    return timeseries_response(adata.df, fmt)
+
 
-    return JSONResponse(content=data)
+@router.get("/timeseries/cache-stats")
+async def get_timeseries_cache_stats() -> JSONResponse:
+    """
+    Returns hit/miss metrics for the timeseries response cache.
+
+    Returns:
+    ========
+    JSONResponse: a dictionary containing the cache size, hits, misses, evictions, and hit ratio.
+    """
+    return JSONResponse(content=get_timeseries_cache().stats())
 
 
 @router.get("/timeseries/nwm-forecast")
 async def get_forecast_nwm(
+    request: Request,
     reach_id: str = Query(..., description="The unique NWM reach identifier.", example="5984765"),
-    date_time: datetime = Query(
+    date_time: str = Query(
         ...,
-        description="The date and time to collect forecast data for in UTC, in theYYYY-MM-DD HH:MM:SS format.",
+        description="The date and time to collect forecast data for in UTC, in theYYYY-MM-DD HH:MM:SS format, or 'latest' for the most recent available forecast.",
         example="2023-11-25 06:00:00",
     ),
     forecast: str = Query(
@@ -73,11 +190,16 @@ async def get_forecast_nwm(
         example="medium_range",
     ),
     ensemble: str = Query(
-        0,
+        "0",
         description="The model ensemble for which to collect data, acceptable values are dependent on the model forecast : short_range =[0], medium_range=[0, 1, 2, 3, 4, 5], long_range=[0, 1, 2, 3] (default: 0)",
         example="3",
     ),
-) -> JSONResponse:
+    output_format: Union[str, None] = Query(
+        None,
+        description="The output format: 'json' (default), 'compact', 'arrow', or 'parquet'. Arrow and Parquet may also be requested via the Accept header.",
+        example="compact",
+    ),
+) -> Response:
     """
     Collects forecasted NWM data for a given reach ID.
     This uses the CIROH-hosted API for accessing Google BigQuery.
@@ -85,52 +207,252 @@ async def get_forecast_nwm(
     Arguments:
     ==========
     reach_id: str - the NWM reach ID for which to collect data.
-    date_time: datetime - the date and time for the data collection.
+    date_time: str - the date and time for the data collection, or 'latest'.
     forecast: str - the forecast simulation for which to collect data.
     ensemble: str - the forecast ensemble member for which data will be collected.
+    output_format: str - the output format of the response (default: json).
 
     Returns:
     ========
-    JSONResponse: a dictionary containing the timeseries of data for the given reach during the given time period in the form {date: streamflow, ...}
+    Response: a dictionary containing the timeseries of data for the given reach during the given time period in the form {date: streamflow, ...}, or in the requested output format
     """
 
+    fmt = negotiate_output_format(request, output_format)
+
     # collect historical analysis and assimilation data
     fdata = Forecasts()
-    dt = date_time.strftime("%Y-%m-%d %H:%M:%S")
+    parsed = parse_forecast_request(fdata, forecast, ensemble)
+    if isinstance(parsed, HTMLResponse):
+        return parsed
+    ftype, valid_ensemble = parsed
+
+    dt = await resolve_reference_time(date_time, ftype)
 
     try:
-        ftype = ForecastTypes(forecast)
-    except ValueError:
-        error_message = (
-            f'Invalid forecast type: {forecast}. Valid options are "short_range", "medium_range", or "long_range".'
-        )
+        await fdata.collect_forecasts([reach_id], ftype, [dt], valid_ensemble)
+    except Exception as e:
         return HTMLResponse(
-            content=f"<h1>Error 404</h1><p>{error_message}</p>",
+            content=f"<h1>Error 500</h1><p>Failed to fetch forecast data: {str(e)}</p>",
             status_code=404,
         )
 
-    valid_ensemble = fdata.filter_forecast_ensembles(ftype, [int(ensemble)])
-    if len(valid_ensemble) == 0:
-        all_valid_ensembles = fdata.filter_forecast_ensembles(ftype)
-        error_message = (
-            f"Invalid ensemble member: {ensemble}. Valid options for {forecast} are {all_valid_ensembles}.",
-        )
+    return timeseries_response(fdata.df, fmt)
+
+
+@router.get("/timeseries/nwm-forecast/latest")
+async def get_forecast_nwm_latest(
+    forecast: str = Query(
+        ...,
+        description="The forecast simulation to look up. Acceptable values include 'short_range', 'medium_range, or 'long_range'",
+        example="medium_range",
+    ),
+) -> JSONResponse:
+    """
+    Finds the most recent reference time for which NWM forecast data is available.
+    The result is cached until the next forecast cycle is expected.
+
+    Arguments:
+    ==========
+    forecast: str - the forecast simulation to look up.
+
+    Returns:
+    ========
+    JSONResponse: a dictionary in the form {"forecast": forecast, "reference_time": "YYYY-MM-DD HH:MM:SS"}
+    """
+
+    parsed = parse_forecast_request(Forecasts(), forecast, "0")
+    if isinstance(parsed, HTMLResponse):
+        return parsed
+    ftype, _ = parsed
+
+    reference_time = await resolve_reference_time("latest", ftype)
+    return JSONResponse(content={"forecast": ftype.value, "reference_time": reference_time})
+
+
+@router.get("/timeseries/nwm-historical/batch")
+async def get_historical_nwm_batch(
+    request: Request,
+    reach_ids: str = Query(..., description="Comma separated NWM reach identifiers.", example=reach_ids_example),
+    start_date: date = Query(
+        ...,
+        description="The start date for the data collection in YYYY-MM-DD format.",
+        example="2024-10-01",
+    ),
+    end_date: date = Query(
+        ...,
+        description="The end date for the data collection in YYYY-MM-DD format.",
+        example="2024-12-31",
+    ),
+    offset: int = Query(
+        3,
+        description="The simulation time offset, supported values are 1,2, and 3 (default: 3).",
+        example="3",
+    ),
+    output_format: Union[str, None] = Query(
+        None,
+        description="The output format: 'json' (default), 'compact', 'arrow', or 'parquet'. Arrow and Parquet may also be requested via the Accept header.",
+        example="compact",
+    ),
+) -> Response:
+    """
+    Collects historical NWM data for many reaches in a single upstream request.
+    This uses the CIROH-hosted API for accessing Google BigQuery.
+
+    Arguments:
+    ==========
+    reach_ids: str - a comma separated list of NWM reach IDs for which to collect data.
+    start_date: datetime - the start date and time for the data collection.
+    end_date: datetime - the end date and time for the data collection.
+    offset: int - the analysis_assim result time offset. Supported values are 1, 2, and 3.
+    output_format: str - the output format of the response (default: json).
+
+    Returns:
+    ========
+    Response: a dictionary in the form {reach_id: {"times": [...], "streamflow": [...]}, ...}, or a table with feature_id, time, and streamflow columns for Arrow and Parquet.
+    """
+
+    ids = parse_reach_ids(reach_ids)
+    fmt = negotiate_output_format(request, output_format)
+
+    adata = AnalysisAssim()
+    st = start_date.strftime("%Y-%m-%d")
+    et = end_date.strftime("%Y-%m-%d")
+    await adata.collect_analysis_assim(ids, st, et, offsets=str(offset))
+
+    return timeseries_response(adata.df, fmt, reach_ids=ids)
+
+
+@router.get("/timeseries/nwm-forecast/batch")
+async def get_forecast_nwm_batch(
+    request: Request,
+    reach_ids: str = Query(..., description="Comma separated NWM reach identifiers.", example=reach_ids_example),
+    date_time: str = Query(
+        ...,
+        description="The date and time to collect forecast data for in UTC, in the YYYY-MM-DD HH:MM:SS format, or 'latest' for the most recent available forecast.",
+        example="2023-11-25 06:00:00",
+    ),
+    forecast: str = Query(
+        ...,
+        description="The forecast simulation to collect data for. Acceptable values include 'short_range', 'medium_range, or 'long_range'",
+        example="medium_range",
+    ),
+    ensemble: str = Query(
+        "0",
+        description="The model ensemble for which to collect data, acceptable values are dependent on the model forecast : short_range =[0], medium_range=[0, 1, 2, 3, 4, 5], long_range=[0, 1, 2, 3] (default: 0)",
+        example="3",
+    ),
+    output_format: Union[str, None] = Query(
+        None,
+        description="The output format: 'json' (default), 'compact', 'arrow', or 'parquet'. Arrow and Parquet may also be requested via the Accept header.",
+        example="compact",
+    ),
+) -> Response:
+    """
+    Collects forecasted NWM data for many reaches in a single upstream request.
+    This uses the CIROH-hosted API for accessing Google BigQuery.
+
+    Arguments:
+    ==========
+    reach_ids: str - a comma separated list of NWM reach IDs for which to collect data.
+    date_time: str - the date and time for the data collection, or 'latest'.
+    forecast: str - the forecast simulation for which to collect data.
+    ensemble: str - the forecast ensemble member for which data will be collected.
+    output_format: str - the output format of the response (default: json).
+
+    Returns:
+    ========
+    Response: a dictionary in the form {reach_id: {"times": [...], "streamflow": [...]}, ...}, or a table with feature_id, time, and streamflow columns for Arrow and Parquet.
+    """
+
+    ids = parse_reach_ids(reach_ids)
+    fmt = negotiate_output_format(request, output_format)
+
+    fdata = Forecasts()
+    parsed = parse_forecast_request(fdata, forecast, ensemble)
+    if isinstance(parsed, HTMLResponse):
+        return parsed
+    ftype, valid_ensemble = parsed
+
+    dt = await resolve_reference_time(date_time, ftype)
+
+    try:
+        await fdata.collect_forecasts(ids, ftype, [dt], valid_ensemble)
+    except Exception as e:
         return HTMLResponse(
-            content=f"<h1>Error 404</h1><p>{error_message}</p>",
+            content=f"<h1>Error 500</h1><p>Failed to fetch forecast data: {str(e)}</p>",
             status_code=404,
         )
 
+    return timeseries_response(fdata.df, fmt, reach_ids=ids)
+
+
+@router.get("/timeseries/nwm-forecast/ensemble")
+async def get_forecast_nwm_ensemble(
+    request: Request,
+    reach_id: str = Query(..., description="The unique NWM reach identifier.", example="5984765"),
+    date_time: str = Query(
+        ...,
+        description="The date and time to collect forecast data for in UTC, in the YYYY-MM-DD HH:MM:SS format, or 'latest' for the most recent available forecast.",
+        example="2023-11-25 06:00:00",
+    ),
+    forecast: str = Query(
+        ...,
+        description="The forecast simulation to collect data for. Acceptable values include 'short_range', 'medium_range, or 'long_range'",
+        example="medium_range",
+    ),
+    percentiles: str = Query(
+        "10,25,50,75,90",
+        description="A comma separated list of percentiles between 0 and 100 to compute across the ensemble members.",
+        example="10,50,90",
+    ),
+    include_members: bool = Query(
+        False,
+        description="Whether to include the streamflow of each ensemble member in the response (default: False).",
+        example="true",
+    ),
+    output_format: Union[str, None] = Query(
+        None,
+        description="The output format: 'json' (default), 'compact', 'arrow', or 'parquet'. Arrow and Parquet may also be requested via the Accept header.",
+        example="compact",
+    ),
+) -> Response:
+    """
+    Collects every ensemble member of an NWM forecast for a given reach ID in a single
+    upstream request and computes per-timestep statistics across the members.
+    This uses the CIROH-hosted API for accessing Google BigQuery.
+
+    Arguments:
+    ==========
+    reach_id: str - the NWM reach ID for which to collect data.
+    date_time: str - the date and time for the data collection, or 'latest'.
+    forecast: str - the forecast simulation for which to collect data.
+    percentiles: str - a comma separated list of percentiles to compute.
+    include_members: bool - whether to include the streamflow of each ensemble member.
+    output_format: str - the output format of the response (default: json).
+
+    Returns:
+    ========
+    Response: a dictionary in the form {"times": [...], "count": [...], "mean": [...], "min": [...], "max": [...], "p<percentile>": [...], "member_<ensemble>": [...]}, or a table with the same columns for Arrow and Parquet.
+    """
+
+    fmt = negotiate_output_format(request, output_format)
+    pcts = parse_percentiles(percentiles)
+
+    fdata = Forecasts()
+    parsed = parse_forecast_request(fdata, forecast, "0")
+    if isinstance(parsed, HTMLResponse):
+        return parsed
+    ftype, _ = parsed
+
+    dt = await resolve_reference_time(date_time, ftype)
+
+    # collect all of the valid ensemble members at once
     try:
-        fdata.collect_forecasts([reach_id], ftype, [dt], valid_ensemble)
+        await fdata.collect_forecasts([reach_id], ftype, [dt])
     except Exception as e:
         return HTMLResponse(
             content=f"<h1>Error 500</h1><p>Failed to fetch forecast data: {str(e)}</p>",
             status_code=404,
         )
 
-    data = {
-        time.strftime("%Y-%m-%d %H:%M:%S"): streamflow
-        for time, streamflow in zip(fdata.df["time"], fdata.df["streamflow"])
-    }
-
-    return JSONResponse(content=data)
+    return columnar_response(fdata.ensemble_statistics(pcts, include_members), fmt)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""
+Description: This script contains a local, per-reach store for National Water
+             Model analysis and assimilation timeseries. Data is partitioned
+             into one Parquet file per reach and month, and the store records
+             which (closed) days it already covers so that only the missing
+             date ranges need to be collected from the BigQuery API.
+"""
+
+import json
+import os
+import threading
+from datetime import date, timedelta
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Tuple
+
+import pandas
+
+# import environment variables from config
+from config import get_settings
+
+
+class HistoricalStore:
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.__locks = {}
+        self.__locks_lock = threading.Lock()
+
+    def __reach_dir(self, reach_id: str, offset: str) -> Path:
+        return self.root / f"offset={offset}" / f"reach={reach_id}"
+
+    def __coverage_path(self, reach_id: str, offset: str) -> Path:
+        return self.__reach_dir(reach_id, offset) / "coverage.json"
+
+    def __reach_lock(self, reach_id: str, offset: str) -> threading.Lock:
+        with self.__locks_lock:
+            return self.__locks.setdefault((reach_id, offset), threading.Lock())
+
+    @staticmethod
+    def __tmp_path(path: Path) -> Path:
+        # unique to the writing process and thread, so that concurrent writers never share a temporary file
+        return path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+    def coverage(self, reach_id: str, offset: str) -> List[Tuple[date, date]]:
+        """
+        Returns the sorted, non-overlapping day ranges that are stored for a reach.
+
+        Arguments:
+        ==========
+        reach_id: str - the NWM reach ID.
+        offset: str - the analysis_assim result time offset.
+
+        Returns:
+        ========
+        List[Tuple[date, date]]: inclusive (start, end) day ranges.
+        """
+        path = self.__coverage_path(reach_id, offset)
+        if not path.exists():
+            return []
+        with open(path, "r") as f:
+            return [(date.fromisoformat(s), date.fromisoformat(e)) for s, e in json.load(f)]
+
+    def missing_ranges(self, reach_id: str, offset: str, start: date, end: date) -> List[Tuple[date, date]]:
+        """
+        Computes the day ranges within [start, end] that are not yet stored.
+
+        Arguments:
+        ==========
+        reach_id: str - the NWM reach ID.
+        offset: str - the analysis_assim result time offset.
+        start: date - the first day of the requested range.
+        end: date - the last day of the requested range (inclusive).
+
+        Returns:
+        ========
+        List[Tuple[date, date]]: inclusive (start, end) day ranges that must be collected.
+        """
+        gaps = []
+        cursor = start
+        for covered_start, covered_end in self.coverage(reach_id, offset):
+            if covered_end < cursor:
+                continue
+            if covered_start > end:
+                break
+            if covered_start > cursor:
+                gaps.append((cursor, covered_start - timedelta(days=1)))
+            cursor = max(cursor, covered_end + timedelta(days=1))
+            if cursor > end:
+                break
+
+        if cursor <= end:
+            gaps.append((cursor, end))
+        return gaps
+
+    def read(self, reach_id: str, offset: str, start: date, end: date) -> pandas.DataFrame:
+        """
+        Reads the stored timeseries for the days in [start, end].
+
+        Arguments:
+        ==========
+        reach_id: str - the NWM reach ID.
+        offset: str - the analysis_assim result time offset.
+        start: date - the first day to read.
+        end: date - the last day to read (inclusive).
+
+        Returns:
+        ========
+        pandas.DataFrame: the stored rows sorted by time.
+        """
+        reach_dir = self.__reach_dir(reach_id, offset)
+        months = pandas.period_range(start, end, freq="M")
+        dfs = [
+            pandas.read_parquet(reach_dir / f"{month}.parquet")
+            for month in months
+            if (reach_dir / f"{month}.parquet").exists()
+        ]
+        if len(dfs) == 0:
+            return pandas.DataFrame(columns=["time", "streamflow"])
+
+        df = pandas.concat(dfs, ignore_index=True)
+        days = df.time.dt.date
+        return df.loc[(days >= start) & (days <= end)].sort_values("time", ignore_index=True)
+
+    def write(self, reach_id: str, offset: str, df: pandas.DataFrame, start: date, end: date) -> None:
+        """
+        Merges collected data into the monthly partitions of a reach and records
+        [start, end] as covered. The dataframe must contain every row that the
+        API returned for these days, otherwise the gaps will never be collected.
+        Writes to the same reach are serialized, since each one reads, merges, and
+        replaces its partitions and coverage. This performs blocking disk I/O and
+        should be run in a worker thread from async code.
+
+        Arguments:
+        ==========
+        reach_id: str - the NWM reach ID.
+        offset: str - the analysis_assim result time offset.
+        df: pandas.DataFrame - the collected data, containing a datetime `time` column.
+        start: date - the first day that was collected.
+        end: date - the last day that was collected (inclusive).
+        """
+        reach_dir = self.__reach_dir(reach_id, offset)
+        reach_dir.mkdir(parents=True, exist_ok=True)
+
+        # only keep rows for the days that were collected
+        days = df.time.dt.date
+        df = df.loc[(days >= start) & (days <= end)]
+
+        with self.__reach_lock(reach_id, offset):
+            for month, month_df in df.groupby(df.time.dt.to_period("M")):
+                path = reach_dir / f"{month}.parquet"
+                if path.exists():
+                    month_df = pandas.concat([pandas.read_parquet(path), month_df], ignore_index=True)
+                month_df = month_df.drop_duplicates(subset="time", keep="last").sort_values("time", ignore_index=True)
+
+                # replace atomically so that concurrent readers never see a partial file
+                tmp_path = self.__tmp_path(path)
+                month_df.to_parquet(tmp_path, index=False)
+                tmp_path.replace(path)
+
+            self.__add_coverage(reach_id, offset, start, end)
+
+    def __add_coverage(self, reach_id: str, offset: str, start: date, end: date) -> None:
+        # merge the new range with any overlapping or adjacent ranges
+        merged = []
+        for covered_start, covered_end in sorted(self.coverage(reach_id, offset) + [(start, end)]):
+            if merged and covered_start <= merged[-1][1] + timedelta(days=1):
+                merged[-1] = (merged[-1][0], max(merged[-1][1], covered_end))
+            else:
+                merged.append((covered_start, covered_end))
+
+        path = self.__coverage_path(reach_id, offset)
+        tmp_path = self.__tmp_path(path)
+        with open(tmp_path, "w") as f:
+            json.dump([(s.isoformat(), e.isoformat()) for s, e in merged], f)
+        tmp_path.replace(path)
+
+
+@lru_cache()
+def get_historical_store() -> HistoricalStore:
+    return HistoricalStore(Path(get_settings().timeseries_store_location))
@@ -0,0 +1,48 @@
+"""
+Request coalescing ("single-flight") for upstream lookups. Concurrent callers
+that ask for the same key share one in-flight upstream call instead of each
+issuing their own, which protects upstream quotas from bursts of identical
+requests, e.g. when many sessions load the same region at once.
+"""
+
+import asyncio
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict
+
+
+class SingleFlight:
+    def __init__(self):
+        self.__calls: Dict[str, asyncio.Task] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Runs fn, unless a call for the same key is already in flight, in
+        which case its result (or exception) is shared with this caller.
+
+        Arguments:
+        ==========
+        key: str - identifies the upstream call, e.g. its url and parameters.
+        fn: Callable[[], Awaitable[Any]] - creates the upstream call.
+
+        Returns:
+        ========
+        Any: the result of the upstream call.
+        """
+        task = self.__calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self.__calls[key] = task
+            task.add_done_callback(lambda done: self.__forget(key, done))
+
+        # shield the shared call so that one caller disconnecting
+        # does not cancel it for everyone else that is waiting on it.
+        return await asyncio.shield(task)
+
+    def __forget(self, key: str, task: asyncio.Task) -> None:
+        if self.__calls.get(key) is task:
+            del self.__calls[key]
+
+
+@lru_cache()
+def get_single_flight() -> SingleFlight:
+    return SingleFlight()
@@ -32,8 +32,43 @@ class Settings(BaseSettings):
 
     nwm_bigquery_key: str
     nwm_bigquery_url: str
+    nwm_http_max_connections: int = 20
+    nwm_http_timeout: float = 60.0
+    nwm_max_concurrent_requests: int = 5
+    # the output format requested from the BigQuery API. Columnar formats are
+    # parsed directly when the API supports them, otherwise csv is used.
+    nwm_output_format: str = "csv"
+    nwm_reference_time_lookback: int = 8
+    nwm_reference_time_retry: int = 600
+    nwm_reference_time_probe_reach_id: str = "5984765"
+
+    timeseries_cache_backend: str = "memory"
+    timeseries_cache_location: str = "/tmp/com_res_cache"
+    timeseries_cache_size: int = 512
+    # the maximum number of entries kept by the disk backend
+    timeseries_cache_disk_size: int = 10000
+    timeseries_cache_ttl: int = 900
+    timeseries_cache_closed_ttl: int = 604800
+    timeseries_store_location: str = "/tmp/com_res_store"
+    timeseries_batch_max_reaches: int = 100
 
     google_application_credentials_path: str
+    # the maximum number of BigQuery queries that run concurrently
+    bigquery_max_concurrency: int = 8
+
+    # the FIM catalog export written by fim/build-catalog.py. Set to an
+    # empty string to query BigQuery for every FIM lookup instead.
+    fim_catalog_source: str = "gs://com_res_fim_output/fim_catalog_index.jsonl"
+    fim_catalog_refresh_interval: int = 3600
+    fim_bulk_max_reaches: int = 2000
+
+    # rendered FIM map tiles are cached in memory and, unless the location is
+    # an empty string, in a size-bounded directory on local disk.
+    fim_tile_size: int = 256
+    fim_tile_cache_size: int = 2048
+    fim_tile_cache_disk_size: int = 50000
+    fim_tile_cache_location: str = "/tmp/com_res_cache"
+    fim_tile_cache_ttl: int = 86400
 
     cloud_run: bool = False
 
@@ -1,7 +1,11 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from app.clients import close_clients, open_clients
 from app.routers.fim import router as fim_router
+from app.routers.fim.catalog import start_fim_catalog, stop_fim_catalog
 from app.routers.timeseries import router as timeseries_router
 from app.users import cuahsi_oauth_client
 from config import get_settings
@@ -19,9 +23,21 @@ swagger_params = {
 }
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # open the shared upstream clients once so that connections
+    # are pooled across requests, and release them on shutdown.
+    await open_clients()
+    await start_fim_catalog()
+    yield
+    await stop_fim_catalog()
+    await close_clients()
+
+
 app = FastAPI(
     servers=[{"url": get_settings().vite_app_api_url}],
     swagger_ui_parameters=swagger_params,
+    lifespan=lifespan,
 )
 
 origins_from_settings = get_settings().allow_origins
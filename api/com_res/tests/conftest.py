@@ -0,0 +1,31 @@
+import os
+import sys
+from pathlib import Path
+
+# the api runs from the com_res directory (see the Dockerfile)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# the settings that have no defaults, so that the tests do not need a .env file
+for name in (
+    "ARGO_HOST",
+    "ARGO_NAMESPACE",
+    "ARGO_BEARER_TOKEN",
+    "MONGO_URL",
+    "MONGO_DATABASE",
+    "HYDROSHARE_MONGO_URL",
+    "HYDROSHARE_MONGO_DATABASE",
+    "OAUTH2_CLIENT_ID",
+    "OAUTH2_CLIENT_SECRET",
+    "OAUTH2_REDIRECT_URL",
+    "VITE_OAUTH2_REDIRECT_URL",
+    "VITE_APP_API_URL",
+    "ALLOW_ORIGINS",
+    "MINIO_ACCESS_KEY",
+    "MINIO_SECRET_KEY",
+    "NWM_BIGQUERY_KEY",
+    "GOOGLE_APPLICATION_CREDENTIALS_PATH",
+):
+    os.environ.setdefault(name, "test")
+os.environ.setdefault("MINIO_API_URL", "localhost:9000")
+os.environ.setdefault("NWM_BIGQUERY_URL", "http://nwm-api.test")
+os.environ.setdefault("OIDC_BASE_URL", "http://oidc.test/")
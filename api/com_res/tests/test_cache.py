@@ -0,0 +1,136 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from app.cache import BinaryDiskBackend, CacheBackend, DiskBackend, TTLCache, build_cache_backend
+
+
+@pytest.fixture(params=[DiskBackend, BinaryDiskBackend])
+def backend(request, tmp_path):
+    return request.param(tmp_path / "cache", maxsize=3, trim_interval=2)
+
+
+def value_for(backend, i):
+    return f"tile {i}".encode() if isinstance(backend, BinaryDiskBackend) else {"values": [i]}
+
+
+def entries(backend):
+    return sorted(p.name for p in backend.directory.iterdir() if p.name.endswith(backend.SUFFIX))
+
+
+def test_backend_round_trip(backend):
+    expires_at = time.time() + 60
+    backend.set("a", value_for(backend, 1), expires_at)
+
+    assert backend.get("a") == (value_for(backend, 1), pytest.approx(expires_at))
+    assert backend.get("missing") is None
+
+    backend.delete("a")
+    assert backend.get("a") is None
+
+
+def test_backend_removes_expired_entries(backend):
+    backend.set("a", value_for(backend, 1), time.time() - 1)
+    assert len(entries(backend)) == 1
+
+    assert backend.get("a") is None
+    assert entries(backend) == []
+
+
+def test_backend_trims_least_recently_used(backend):
+    for i in range(3):
+        backend.set(f"k{i}", value_for(backend, i), time.time() + 60)
+        time.sleep(0.01)
+
+    # reading k0 makes k1 the least recently used entry, which the
+    # fourth write evicts since the backend holds at most 3 entries.
+    assert backend.get("k0") is not None
+    time.sleep(0.01)
+    backend.set("k3", value_for(backend, 3), time.time() + 60)
+
+    assert len(entries(backend)) == 3
+    assert backend.get("k0") is not None
+    assert backend.get("k1") is None
+
+
+def test_backend_ignores_corrupt_entries(backend):
+    backend.set("a", value_for(backend, 1), time.time() + 60)
+    (path,) = backend.directory.iterdir()
+    path.write_bytes(b"{")
+
+    assert backend.get("a") is None
+
+
+def test_backend_interface_is_abstract():
+    with pytest.raises(TypeError):
+        CacheBackend()
+
+
+def test_ttl_cache_lru_and_expiry():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1, ttl=60)
+    cache.set("b", 2, ttl=60)
+    assert cache.get("a") == 1
+
+    # b is the least recently used entry
+    cache.set("c", 3, ttl=60)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+    cache.set("d", 4, ttl=-1)
+    assert cache.get("d") is None
+
+
+def test_ttl_cache_promotes_backend_entries(tmp_path):
+    DiskBackend(tmp_path).set("a", [1, 2], time.time() + 60)
+    cache = TTLCache(backend=DiskBackend(tmp_path))
+
+    assert cache.get("a") == [1, 2]
+    assert cache.get("a") == [1, 2]
+    stats = cache.stats()
+    assert stats["hits"] == 2 and stats["backend_hits"] == 1 and stats["size"] == 1
+
+
+def test_ttl_cache_async_methods_use_backend(tmp_path):
+    async def main():
+        await TTLCache(backend=DiskBackend(tmp_path)).aset("a", {"x": 1}, ttl=60)
+        cache = TTLCache(backend=DiskBackend(tmp_path))
+        return await cache.aget("a"), await cache.aget("b"), cache.stats()
+
+    value, missing, stats = asyncio.run(main())
+    assert value == {"x": 1} and missing is None
+    assert stats["backend_hits"] == 1 and stats["misses"] == 1
+
+
+class FailingBackend(CacheBackend):
+    def get(self, key):
+        raise OSError("down")
+
+    def set(self, key, value, expires_at):
+        raise OSError("down")
+
+    def delete(self, key):
+        raise OSError("down")
+
+
+def test_ttl_cache_survives_backend_failures():
+    cache = TTLCache(backend=FailingBackend())
+    cache.set("a", 1, ttl=60)
+    assert cache.get("a") == 1
+    cache.delete("a")
+    assert cache.get("a") is None
+    assert asyncio.run(cache.aget("b")) is None
+
+
+def test_build_cache_backend(tmp_path):
+    assert build_cache_backend("memory", str(tmp_path), "timeseries") is None
+
+    backend = build_cache_backend("disk", str(tmp_path), "timeseries", disk_size=7)
+    assert isinstance(backend, DiskBackend)
+    assert backend.directory == tmp_path / "timeseries" and backend.maxsize == 7
+
+    with pytest.raises(ValueError):
+        build_cache_backend("memcached", str(tmp_path), "timeseries")
@@ -0,0 +1,47 @@
+import numpy
+import pandas
+import pytest
+
+from app.routers.timeseries.forecast import Forecasts
+
+
+@pytest.fixture
+def forecast():
+    times = pandas.date_range("2024-01-01", periods=4, freq="h")
+    rows = []
+    # member 0 covers every timestep, member 1 ends early, and member 2 is missing one value
+    for ensemble, values in {0: [1, 2, 3, 4], 1: [3, 4], 2: [5, numpy.nan, 7, 8]}.items():
+        rows += [{"time": t, "ensemble": ensemble, "streamflow": v} for t, v in zip(times, values)]
+    forecast = Forecasts()
+    # rows arrive unordered from the concurrent member requests
+    forecast.df = pandas.DataFrame(rows).sample(frac=1, random_state=0)
+    return forecast
+
+
+def test_statistics_ignore_missing_members(forecast):
+    stats = forecast.ensemble_statistics([50])
+
+    assert list(stats.columns) == ["time", "count", "mean", "min", "max", "p50"]
+    assert stats.time.is_monotonic_increasing
+    assert stats["count"].tolist() == [3, 2, 2, 2]
+    assert stats["mean"].tolist() == [3.0, 3.0, 5.0, 6.0]
+    assert stats["min"].tolist() == [1.0, 2.0, 3.0, 4.0]
+    assert stats["max"].tolist() == [5.0, 4.0, 7.0, 8.0]
+    assert stats["p50"].tolist() == [3.0, 3.0, 5.0, 6.0]
+
+
+def test_percentile_columns(forecast):
+    stats = forecast.ensemble_statistics([0, 12.5, 100])
+
+    assert [c for c in stats.columns if c.startswith("p")] == ["p0", "p12.5", "p100"]
+    assert stats["p0"].equals(stats["min"])
+    assert stats["p100"].equals(stats["max"])
+    assert stats["p12.5"].iloc[0] == pytest.approx(1.5)
+
+
+def test_members_are_included_on_request(forecast):
+    stats = forecast.ensemble_statistics([], include_members=True)
+
+    assert list(stats.columns) == ["time", "count", "mean", "min", "max", "member_0", "member_1", "member_2"]
+    assert stats["member_1"].tolist()[:2] == [3.0, 4.0]
+    assert stats["member_1"].isna().tolist() == [False, False, True, True]
@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+from app.routers.fim.catalog import FimCatalog
+
+BUCKET = "gs://com-res/flood_12090301/12090301_inundation"
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    rows = [
+        # rows are written out of stage order, as BigQuery exports them
+        dict(reach_id=5781369, stage=1.0, flow=20.0, asset_url=f"{BUCKET}/5781369/1.cog"),
+        dict(reach_id=5781369, stage=0.5, flow=10.0, asset_url=f"{BUCKET}/5781369/0.5.cog"),
+        dict(reach_id=5781369, stage=2.0, flow=50.0, asset_url=f"{BUCKET}/5781369/2.cog"),
+        dict(reach_id=5781370, stage=0.5, flow=4.0, asset_url=f"{BUCKET}/5781370/0.5.cog"),
+    ]
+    source = tmp_path / "catalog.jsonl"
+    source.write_text("\n".join(json.dumps(row) for row in rows))
+
+    catalog = FimCatalog(str(source))
+    assert not catalog.is_loaded
+    catalog.load()
+    assert catalog.is_loaded
+    return catalog
+
+
+def test_lookup_is_ordered_by_stage(catalog):
+    entry = catalog.lookup(" 5781369 ")
+    assert entry["stages_m"] == [0.5, 1.0, 2.0]
+    assert entry["flows_cms"] == [10.0, 20.0, 50.0]
+    assert (
+        entry["files"][0] == "https://storage.googleapis.com/com-res/flood_12090301/12090301_inundation/5781369/0.5.cog"
+    )
+
+
+def test_unknown_reach_is_empty(catalog):
+    assert catalog.lookup("1") == dict(files=[], flows_cms=[], stages_m=[])
+
+
+def test_failed_reload_keeps_the_index(catalog, tmp_path):
+    catalog.source = str(tmp_path / "missing.jsonl")
+    with pytest.raises(Exception):
+        catalog.load()
+    assert catalog.lookup("5781370")["stages_m"] == [0.5]
@@ -0,0 +1,104 @@
+import io
+import json
+
+import httpx
+import pandas
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from app.routers.timeseries.formats import (
+    MEDIA_TYPES,
+    OutputFormats,
+    compact_timeseries,
+    frame_from_compact,
+    negotiate_output_format,
+    read_nwm_response,
+    timeseries_response,
+)
+
+
+def request(accept: str = "") -> Request:
+    headers = [(b"accept", accept.encode())] if accept else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers, "query_string": b""})
+
+
+@pytest.fixture
+def timeseries():
+    return pandas.DataFrame(
+        {"time": pandas.date_range("2024-01-01", periods=4, freq="h"), "streamflow": [1.0, 2.5, 3.25, 0.0]}
+    )
+
+
+def test_default_format_is_json():
+    assert negotiate_output_format(request(), None) == OutputFormats.JSON
+    assert negotiate_output_format(request("application/json"), None) == OutputFormats.JSON
+
+
+@pytest.mark.parametrize("fmt", [OutputFormats.ARROW, OutputFormats.PARQUET])
+def test_accept_header_selects_binary_formats(fmt):
+    assert negotiate_output_format(request(f"{MEDIA_TYPES[fmt]}, */*"), None) == fmt
+
+
+def test_query_parameter_takes_precedence():
+    accept = MEDIA_TYPES[OutputFormats.ARROW]
+    assert negotiate_output_format(request(accept), "compact") == OutputFormats.COMPACT
+
+
+def test_invalid_format_is_rejected():
+    with pytest.raises(HTTPException) as e:
+        negotiate_output_format(request(), "xml")
+    assert e.value.status_code == 400
+
+
+def test_compact_round_trip(timeseries):
+    data = compact_timeseries(timeseries)
+    assert data["times"][:2] == [1704067200, 1704070800]
+    # the compact layout must survive a JSON round trip, e.g. through the response cache
+    restored = frame_from_compact(json.loads(json.dumps(data)))
+    pandas.testing.assert_frame_equal(restored, timeseries, check_dtype=False)
+    assert restored.time.tolist() == timeseries.time.tolist()
+
+
+def test_json_response(timeseries):
+    body = json.loads(timeseries_response(timeseries, OutputFormats.JSON).body)
+    assert body == {
+        "2024-01-01 00:00:00": 1.0,
+        "2024-01-01 01:00:00": 2.5,
+        "2024-01-01 02:00:00": 3.25,
+        "2024-01-01 03:00:00": 0.0,
+    }
+
+
+def test_batch_compact_response_includes_empty_reaches(timeseries):
+    df = pandas.concat([timeseries.assign(feature_id=101), timeseries.head(1).assign(feature_id=202)])
+    body = json.loads(timeseries_response(df, OutputFormats.COMPACT, ["101", "202", "303"]).body)
+    assert body["101"]["values"] == [1.0, 2.5, 3.25, 0.0]
+    assert body["202"] == {"times": [1704067200], "values": [1.0]}
+    assert body["303"] == {"times": [], "values": []}
+
+
+def test_binary_responses_round_trip(timeseries):
+    arrow = timeseries_response(timeseries, OutputFormats.ARROW)
+    assert arrow.media_type == MEDIA_TYPES[OutputFormats.ARROW]
+    table = pyarrow.ipc.open_stream(arrow.body).read_all()
+    pandas.testing.assert_frame_equal(table.to_pandas(), timeseries, check_dtype=False)
+
+    parquet = timeseries_response(timeseries, OutputFormats.PARQUET)
+    table = pyarrow.parquet.read_table(io.BytesIO(parquet.body))
+    pandas.testing.assert_frame_equal(table.to_pandas(), timeseries, check_dtype=False)
+
+
+def test_read_nwm_response_normalizes_times():
+    csv = b"time,streamflow\n2024-01-01 00:00:00+00:00,1.5\n2024-01-01T01:00:00Z,2.0\n"
+    df = read_nwm_response(httpx.Response(200, content=csv, headers={"content-type": "text/csv"}), ["time"])
+    assert df.time.dt.tz is None
+    assert df.time.tolist() == [pandas.Timestamp("2024-01-01 00:00"), pandas.Timestamp("2024-01-01 01:00")]
+
+    buffer = io.BytesIO()
+    pyarrow.parquet.write_table(pyarrow.Table.from_pandas(df), buffer)
+    parquet = read_nwm_response(httpx.Response(200, content=buffer.getvalue()), ["time"])
+    pandas.testing.assert_frame_equal(parquet, df)
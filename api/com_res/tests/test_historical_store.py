@@ -0,0 +1,73 @@
+import json
+from datetime import date
+
+import pandas
+import pytest
+
+from app.routers.timeseries.store import HistoricalStore
+
+
+def hourly(start: str, end: str, value: float = 1.0) -> pandas.DataFrame:
+    time = pandas.date_range(start, end, freq="h", inclusive="left")
+    return pandas.DataFrame({"time": time, "streamflow": value})
+
+
+@pytest.fixture
+def store(tmp_path):
+    return HistoricalStore(tmp_path)
+
+
+def test_empty_store_is_missing_everything(store):
+    assert store.missing_ranges("1", "1", date(2024, 1, 1), date(2024, 1, 31)) == [
+        (date(2024, 1, 1), date(2024, 1, 31))
+    ]
+    assert len(store.read("1", "1", date(2024, 1, 1), date(2024, 1, 31))) == 0
+
+
+def test_missing_ranges_around_coverage(store):
+    store.write("1", "1", hourly("2024-01-05", "2024-01-11"), date(2024, 1, 5), date(2024, 1, 10))
+    store.write("1", "1", hourly("2024-01-20", "2024-01-23"), date(2024, 1, 20), date(2024, 1, 22))
+
+    assert store.missing_ranges("1", "1", date(2024, 1, 1), date(2024, 1, 31)) == [
+        (date(2024, 1, 1), date(2024, 1, 4)),
+        (date(2024, 1, 11), date(2024, 1, 19)),
+        (date(2024, 1, 23), date(2024, 1, 31)),
+    ]
+    assert store.missing_ranges("1", "1", date(2024, 1, 6), date(2024, 1, 9)) == []
+    assert store.missing_ranges("1", "1", date(2024, 1, 8), date(2024, 1, 12)) == [
+        (date(2024, 1, 11), date(2024, 1, 12))
+    ]
+    # other reaches and offsets have their own coverage
+    assert store.missing_ranges("2", "1", date(2024, 1, 6), date(2024, 1, 9)) == [(date(2024, 1, 6), date(2024, 1, 9))]
+    assert store.missing_ranges("1", "2", date(2024, 1, 6), date(2024, 1, 9)) == [(date(2024, 1, 6), date(2024, 1, 9))]
+
+
+def test_adjacent_coverage_is_merged(store):
+    store.write("1", "1", hourly("2024-01-01", "2024-01-03"), date(2024, 1, 1), date(2024, 1, 2))
+    store.write("1", "1", hourly("2024-01-03", "2024-01-05"), date(2024, 1, 3), date(2024, 1, 4))
+
+    assert store.coverage("1", "1") == [(date(2024, 1, 1), date(2024, 1, 4))]
+
+
+def test_write_merges_partitions_across_months(store):
+    store.write("1", "1", hourly("2024-01-30", "2024-02-02"), date(2024, 1, 30), date(2024, 2, 1))
+    # rows outside the collected days, e.g. the midnight after the last day, are not stored
+    df = store.read("1", "1", date(2024, 1, 1), date(2024, 2, 29))
+    assert len(df) == 72
+    assert df.time.is_monotonic_increasing
+
+    # newer values replace stored ones for the same time
+    store.write("1", "1", hourly("2024-01-31", "2024-02-01", value=2.0), date(2024, 1, 31), date(2024, 1, 31))
+    df = store.read("1", "1", date(2024, 1, 31), date(2024, 1, 31))
+    assert len(df) == 24 and (df.streamflow == 2.0).all()
+
+    reach_dir = store.root / "offset=1" / "reach=1"
+    assert sorted(p.name for p in reach_dir.iterdir()) == ["2024-01.parquet", "2024-02.parquet", "coverage.json"]
+    assert json.loads((reach_dir / "coverage.json").read_text()) == [["2024-01-30", "2024-02-01"]]
+
+
+def test_read_limits_days(store):
+    store.write("1", "1", hourly("2024-01-01", "2024-01-11"), date(2024, 1, 1), date(2024, 1, 10))
+
+    df = store.read("1", "1", date(2024, 1, 3), date(2024, 1, 4))
+    assert df.time.min() == pandas.Timestamp("2024-01-03") and df.time.max() == pandas.Timestamp("2024-01-04 23:00")
@@ -0,0 +1,51 @@
+import numpy
+import pandas
+
+from app.routers.fim.catalog import BRACKET_COLUMNS, interpolate_stage
+
+ENTRY = dict(files=["a.cog", "b.cog", "c.cog"], flows_cms=[10.0, 20.0, 50.0], stages_m=[0.5, 1.0, 2.0])
+
+
+def test_stage_is_interpolated_between_brackets():
+    df = interpolate_stage(ENTRY, numpy.array([15.0, 35.0]))
+
+    assert df.stage_m.tolist() == [0.75, 1.5]
+    assert df.lower_file.tolist() == ["a.cog", "b.cog"]
+    assert df.upper_file.tolist() == ["b.cog", "c.cog"]
+    assert df.lower_flow_cms.tolist() == [10.0, 20.0]
+    assert df.upper_stage_m.tolist() == [1.0, 2.0]
+
+
+def test_flows_matching_assets():
+    df = interpolate_stage(ENTRY, numpy.array([10.0, 20.0, 50.0]))
+
+    assert df.stage_m.tolist() == [0.5, 1.0, 2.0]
+    assert df.lower_file.tolist() == ["a.cog", "b.cog", "c.cog"]
+    # the highest asset has no upper bracket, but its stage is still known
+    assert df.upper_file.tolist()[:2] == ["b.cog", "c.cog"]
+    assert df.upper_file.isna().tolist() == [False, False, True]
+
+
+def test_flows_outside_the_rating_table():
+    df = interpolate_stage(ENTRY, numpy.array([5.0, 80.0]))
+
+    assert df.stage_m.isna().all()
+    assert df.lower_file.isna().tolist() == [True, False]
+    assert df.upper_file.isna().tolist() == [False, True]
+    assert df.lower_file[1] == "c.cog" and df.upper_file[0] == "a.cog"
+
+
+def test_reach_without_assets():
+    df = interpolate_stage(dict(files=[], flows_cms=[], stages_m=[]), numpy.array([1.0, 2.0]))
+
+    assert list(df.columns) == ["flow_cms", "stage_m"] + BRACKET_COLUMNS
+    assert df.stage_m.isna().all()
+    assert df[BRACKET_COLUMNS].isna().all().all()
+
+
+def test_large_batches_match_numpy_interp():
+    flows = numpy.linspace(10.0, 50.0, 1001)
+    df = interpolate_stage(ENTRY, flows)
+
+    expected = numpy.interp(flows, ENTRY["flows_cms"], ENTRY["stages_m"])
+    pandas.testing.assert_series_equal(df.stage_m, pandas.Series(expected, name="stage_m"))
@@ -0,0 +1,103 @@
+import asyncio
+from datetime import datetime, timezone
+
+import httpx
+import pytest
+
+from app.routers.timeseries import reference_times
+from app.routers.timeseries.forecast import Forecasts, ForecastTypes
+from app.routers.timeseries.reference_times import ReferenceTimeResolver, expected_reference_times
+
+NOW = datetime(2024, 5, 1, 14, 35, tzinfo=timezone.utc)
+
+CSV = b"time,reference_time,feature_id,streamflow\n2024-05-01 13:00:00,2024-05-01 12:00:00,5984765,1.5\n"
+
+
+class FixedDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return NOW
+
+
+def response(status_code: int, content: bytes = b"") -> httpx.Response:
+    request = httpx.Request("GET", "https://nwm.example.org/forecast")
+    return httpx.Response(status_code, content=content, request=request)
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """
+    Serves the responses for each reference time from a dictionary, returning
+    404 for cycles that are not listed, and records the requested cycles.
+    """
+    responses = {}
+    requested = []
+
+    async def fetch_url(self, params):
+        requested.append(params["reference_time"])
+        res = responses.get(params["reference_time"], response(404))
+        if isinstance(res, Exception):
+            raise res
+        res.raise_for_status()
+        return res
+
+    monkeypatch.setattr(reference_times, "datetime", FixedDatetime)
+    monkeypatch.setattr(Forecasts, "fetch_url", fetch_url)
+    return responses, requested
+
+
+def test_expected_reference_times():
+    assert expected_reference_times(ForecastTypes.SHORT, NOW, 3) == [
+        datetime(2024, 5, 1, 14),
+        datetime(2024, 5, 1, 13),
+        datetime(2024, 5, 1, 12),
+    ]
+    assert expected_reference_times(ForecastTypes.MEDIUM, NOW, 3) == [
+        datetime(2024, 5, 1, 12),
+        datetime(2024, 5, 1, 6),
+        datetime(2024, 5, 1, 0),
+    ]
+
+
+def test_latest_falls_back_to_published_cycle(upstream):
+    responses, requested = upstream
+    responses["2024-05-01 12:00:00"] = response(200, CSV)
+    resolver = ReferenceTimeResolver()
+
+    assert asyncio.run(resolver.latest(ForecastTypes.SHORT)) == datetime(2024, 5, 1, 12)
+    assert requested == ["2024-05-01 14:00:00", "2024-05-01 13:00:00", "2024-05-01 12:00:00"]
+
+    # the result is cached, so the API is not asked again
+    assert asyncio.run(resolver.latest(ForecastTypes.SHORT)) == datetime(2024, 5, 1, 12)
+    assert len(requested) == 3
+
+
+def test_empty_response_is_not_available(upstream):
+    responses, _ = upstream
+    responses["2024-05-01 14:00:00"] = response(200)
+    responses["2024-05-01 13:00:00"] = response(200, CSV)
+
+    assert asyncio.run(ReferenceTimeResolver().latest(ForecastTypes.SHORT)) == datetime(2024, 5, 1, 13)
+
+
+def test_no_available_cycle(upstream):
+    resolver = ReferenceTimeResolver()
+    with pytest.raises(LookupError):
+        asyncio.run(resolver.latest(ForecastTypes.MEDIUM))
+    assert len(upstream[1]) == resolver.lookback
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        httpx.HTTPStatusError("error", request=response(502).request, response=response(502)),
+        httpx.ConnectError("unreachable"),
+    ],
+)
+def test_upstream_errors_are_raised(upstream, error):
+    responses, requested = upstream
+    responses["2024-05-01 12:00:00"] = error
+
+    with pytest.raises(type(error)):
+        asyncio.run(ReferenceTimeResolver().latest(ForecastTypes.MEDIUM))
+    assert requested == ["2024-05-01 12:00:00"]
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from app.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_upstream_call():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    async def run():
+        flight = SingleFlight()
+        return await asyncio.gather(*[flight.do("a", fetch) for _ in range(5)])
+
+    assert asyncio.run(run()) == [1] * 5
+    assert len(calls) == 1
+
+
+def test_different_keys_are_not_shared():
+    async def run():
+        flight = SingleFlight()
+
+        async def fetch(value):
+            await asyncio.sleep(0.01)
+            return value
+
+        return await asyncio.gather(flight.do("a", lambda: fetch("a")), flight.do("b", lambda: fetch("b")))
+
+    assert asyncio.run(run()) == ["a", "b"]
+
+
+def test_completed_calls_are_not_reused():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return len(calls)
+
+    async def run():
+        flight = SingleFlight()
+        return [await flight.do("a", fetch), await flight.do("a", fetch)]
+
+    assert asyncio.run(run()) == [1, 2]
+
+
+def test_exceptions_are_shared_and_forgotten():
+    calls = []
+
+    async def fail():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    async def run():
+        flight = SingleFlight()
+        results = await asyncio.gather(*[flight.do("a", fail) for _ in range(3)], return_exceptions=True)
+        assert len(calls) == 1 and all(isinstance(r, ValueError) for r in results)
+
+        # a failed call is not cached, so the next caller retries
+        with pytest.raises(ValueError):
+            await flight.do("a", fail)
+        assert len(calls) == 2
+
+    asyncio.run(run())
+
+
+def test_cancelled_caller_does_not_cancel_others():
+    async def run():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def fetch():
+            await release.wait()
+            return "done"
+
+        first = asyncio.ensure_future(flight.do("a", fetch))
+        second = asyncio.ensure_future(flight.do("a", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+
+        assert await second == "done"
+        assert first.cancelled()
+
+    asyncio.run(run())
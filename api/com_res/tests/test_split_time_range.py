@@ -0,0 +1,55 @@
+import asyncio
+
+from app import clients
+from app.routers.timeseries.historical import AnalysisAssim, split_time_range
+from config import get_settings
+
+
+def test_range_within_a_month_is_not_split():
+    assert split_time_range("2024-01-05", "2024-01-20") == [("2024-01-05", "2024-01-20")]
+
+
+def test_range_is_split_at_month_starts():
+    assert split_time_range("2024-01-15", "2024-03-10") == [
+        ("2024-01-15", "2024-02-01"),
+        ("2024-02-01", "2024-03-01"),
+        ("2024-03-01", "2024-03-10"),
+    ]
+
+
+def test_boundaries_on_month_starts_are_not_repeated():
+    assert split_time_range("2024-01-01", "2024-03-01") == [
+        ("2024-01-01", "2024-02-01"),
+        ("2024-02-01", "2024-03-01"),
+    ]
+
+
+def test_windows_are_contiguous():
+    windows = split_time_range("2023-11-20", "2024-06-03")
+    assert windows[0][0] == "2023-11-20" and windows[-1][1] == "2024-06-03"
+    assert all(a[1] == b[0] for a, b in zip(windows[:-1], windows[1:]))
+
+
+def test_concurrent_fetches_share_the_request_limit(monkeypatch):
+    monkeypatch.setattr(clients, "_nwm_semaphore", None)
+    limit = get_settings().nwm_max_concurrent_requests
+    in_flight = 0
+    peak = 0
+
+    async def fetch_url(self, params):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return params
+
+    monkeypatch.setattr(AnalysisAssim, "fetch_url", fetch_url)
+
+    async def run():
+        nwm = AnalysisAssim()
+        return await asyncio.gather(*[nwm.fetch_async(list(range(limit))) for _ in range(3)])
+
+    for results, errors in asyncio.run(run()):
+        assert len(results) == limit and errors == []
+    assert peak == limit
@@ -0,0 +1,39 @@
+import io
+
+import numpy
+import pytest
+
+from app.routers.fim.tiles import ORIGIN_SHIFT, encode_png, tile_bounds
+
+
+def test_world_tile():
+    assert tile_bounds(0, 0, 0) == pytest.approx((-ORIGIN_SHIFT, -ORIGIN_SHIFT, ORIGIN_SHIFT, ORIGIN_SHIFT))
+
+
+def test_rows_are_counted_from_the_top():
+    left, bottom, right, top = tile_bounds(1, 0, 0)
+    assert (left, bottom, right, top) == pytest.approx((-ORIGIN_SHIFT, 0, 0, ORIGIN_SHIFT))
+    assert tile_bounds(1, 1, 1) == pytest.approx((0, -ORIGIN_SHIFT, ORIGIN_SHIFT, 0))
+
+
+def test_children_cover_their_parent():
+    z, x, y = 10, 300, 384
+    left, bottom, right, top = tile_bounds(z, x, y)
+    children = [tile_bounds(z + 1, 2 * x + dx, 2 * y + dy) for dx in (0, 1) for dy in (0, 1)]
+
+    assert min(c[0] for c in children) == pytest.approx(left)
+    assert min(c[1] for c in children) == pytest.approx(bottom)
+    assert max(c[2] for c in children) == pytest.approx(right)
+    assert max(c[3] for c in children) == pytest.approx(top)
+    assert right - left == pytest.approx(2 * ORIGIN_SHIFT / 2**z)
+
+
+def test_encode_png():
+    rasterio = pytest.importorskip("rasterio")
+    rgba = numpy.zeros((4, 8, 8), dtype=numpy.uint8)
+    rgba[:, 2:4, 2:4] = 255
+
+    content = encode_png(rgba)
+    assert content[:8] == b"\x89PNG\r\n\x1a\n"
+    with rasterio.open(io.BytesIO(content)) as src:
+        assert (src.read() == rgba).all()
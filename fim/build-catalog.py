@@ -45,7 +45,8 @@ def build_stac():
     blobs = client.list_blobs(bucket, prefix=prefix)
     matching_files = []
     for blob in blobs:
-        if blob.name.endswith(extension):
+        # stage stacks combine all stages of a reach and are not catalog items
+        if blob.name.endswith(extension) and not blob.name.endswith("stage_stack.cog"):
             matching_files.append(f"gs://{gcs_bucket}/{blob.name}")
     print("done")
 
@@ -10,12 +10,56 @@ import typer
 import numpy
 import pandas
 from pathlib import Path
+from functools import lru_cache
 from typing import Tuple, Union
-from scipy import interpolate
+
+from inundation_engine import default_cache_dir, load_hydrotable
 
 app = typer.Typer()
 
 
+def interpolate_many(
+    df: pandas.DataFrame,
+    x_column: str,
+    y_column: str,
+    x_values: Union[float, numpy.ndarray],
+) -> numpy.ndarray:
+    """
+    Performs vectorized 1D linear interpolation on two columns of a Dataframe.
+    The data is sorted once and all X-axis values are interpolated in a single
+    call, rather than once per value.
+
+    Parameters
+    ==========
+    df: pandas.DataFrame
+        DataFrame containing data that will be used in the interpolation.
+    x_column: str
+        Name of the column that represents the X-axis data.
+    y_column: str
+        Name of the column that represents the Y-axis data.
+    x_values: float | numpy.ndarray
+        Numeric X-axis values for which to interpolate Y-axis data. Values
+        that are outside of the range of the X-axis data resolve to -9999.
+
+    Returns
+    =======
+    y_values: numpy.ndarray
+        Numeric Y-axis values corresponding to the input X-axis values, with
+        the same shape as x_values.
+
+    """
+    # Sort the DataFrame by the 'x' column to ensure interpolation works correctly
+    df_sorted = df.sort_values(by=x_column)
+    x = df_sorted[x_column].to_numpy(dtype=float)
+    y = df_sorted[y_column].to_numpy(dtype=float)
+
+    x_values = numpy.asarray(x_values, dtype=float)
+    y_values = numpy.interp(x_values, x, y)
+
+    # x_values that are out of range cannot be interpolated
+    return numpy.where((x_values < x[0]) | (x_values > x[-1]), -9999.0, y_values)
+
+
 def interpolate_y(
     df: pandas.DataFrame, x_column: str, y_column: str, x_value: float
 ) -> float:
@@ -40,30 +84,29 @@ def interpolate_y(
         Numeric Y-axis value corresponding to the input X-axis value.
 
     """
-    # Sort the DataFrame by the 'x' column to ensure interpolation works correctly
-    df_sorted = df.sort_values(by=x_column)
+    return interpolate_many(df, x_column, y_column, x_value).item()
 
-    # Check if the x_value is within the range of the DataFrame
-    if x_value < df_sorted[x_column].min() or x_value > df_sorted[x_column].max():
-        return -9999  # x_value is out of range, cannot interpolate
 
-    # Perform linear interpolation
-    f = interpolate.interp1d(df_sorted[x_column], df_sorted[y_column], kind="linear")
-
-    # Return the interpolated y value for the given x value
-    return f(x_value).item()
+def __as_result(values: numpy.ndarray) -> Union[float, numpy.ndarray]:
+    # return scalars for scalar inputs, e.g. from the command line
+    return values.item() if values.ndim == 0 else values
 
 
+@lru_cache(maxsize=1024)
 def __load_rating_curve(huc_id: str, reach_id: str) -> Union[pandas.DataFrame, None]:
 
     # create the path to the rating curve file
     # based on the huc_id. This assumes that the
     # data has already been downloaded.
-    huc_data_path = Path(f"output/flood_{huc_id}/{huc_id}/branches/0")
+    huc_data_path = Path(f"output/flood_{huc_id}/{huc_id}")
 
-    # load the rating curve data
-    df = pandas.read_csv(huc_data_path / "hydroTable_0.csv", low_memory=False)
-    dat = df.loc[df.feature_id == int(reach_id)]
+    # load the rating curve data from the feature_id-sorted copy of the
+    # hydrotable, which is created once in the local cache of the HUC
+    # (shared with the inundation engine) and reused by all lookups.
+    hydrotable = load_hydrotable(
+        huc_data_path / "branches/0/hydroTable_0.csv", default_cache_dir(huc_id) / "0"
+    )
+    dat = hydrotable.select([int(reach_id)])
 
     # exit early if no data is found for the reach
     if len(dat) == 0:
@@ -79,10 +122,12 @@ def __load_rating_curve(huc_id: str, reach_id: str) -> Union[pandas.DataFrame, N
 @app.command(name="get_stage")
 def get_stage(
     huc_id: str, reach_id: str, flow: float, verbose: bool = False
-) -> Union[float, None]:
+) -> Union[float, numpy.ndarray, None]:
     """
     Interpolates river stage based on user-provided river flow using the
-    synthetically generated rating curve for the specified reach.
+    synthetically generated rating curve for the specified reach. The flow
+    can also be an array of flows, which are interpolated in a single pass
+    and returned as an array of stages.
     """
 
     dat = __load_rating_curve(huc_id, reach_id)
@@ -96,7 +141,9 @@ def get_stage(
         list(dat.groupby("HydroID").groups.keys())[0]
     )
 
-    interpolated_stage = interpolate_y(group, "discharge_cms", "stage", flow)
+    interpolated_stage = __as_result(
+        interpolate_many(group, "discharge_cms", "stage", flow)
+    )
 
     if verbose:
         print(f"HUC ID: {huc_id}")
@@ -112,10 +159,12 @@ def get_stage(
 @app.command(name="get_flow")
 def get_flow(
     huc_id: str, reach_id: str, stage: float, verbose: bool = False
-) -> Union[float, None]:
+) -> Union[float, numpy.ndarray, None]:
     """
     Interpolates river flow based on user-provided river stage using the
-    synthetically generated rating curve for the specified reach.
+    synthetically generated rating curve for the specified reach. The stage
+    can also be an array of stages, which are interpolated in a single pass
+    and returned as an array of flows.
     """
 
     dat = __load_rating_curve(huc_id, reach_id)
@@ -129,7 +178,9 @@ def get_flow(
         list(dat.groupby("HydroID").groups.keys())[0]
     )
 
-    interpolated_flow = interpolate_y(group, "stage", "discharge_cms", stage)
+    interpolated_flow = __as_result(
+        interpolate_many(group, "stage", "discharge_cms", stage)
+    )
 
     if verbose:
         print(f"HUC ID: {huc_id}")
@@ -175,11 +226,9 @@ def compute_rating_increments(
     # of our search extent
     stage_list = numpy.arange(group.stage.min(), group.stage.max(), increment)
 
-    interpolated = []
-    for s in stage_list:
-        interpolated_flow = interpolate_y(group, "stage", "discharge_cms", s)
-
-        interpolated.append((round(s, 2), round(interpolated_flow, 2)))
+    # interpolate the flows of all stages at once
+    flow_list = interpolate_many(group, "stage", "discharge_cms", stage_list)
+    interpolated = list(zip(numpy.round(stage_list, 2), numpy.round(flow_list, 2)))
 
     if verbose:
         print(f"HUC ID: {huc_id}")
@@ -1,25 +1,35 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import typer
 import numpy
 import shutil
 import pandas
+import tempfile
+import contextlib
 from pathlib import Path
-from typing import List, Union
+from typing import Dict, List, Tuple, Union
 
 import rasterio
+import rasterio.windows
 from rasterio import Affine
+from rasterio.enums import Resampling
 
 from typing_extensions import Annotated
 
 from fimserve import datadownload as fm
 from fimserve import runFIM
 import compute_rating_increments as cr
-
-from concurrent.futures import ProcessPoolExecutor
-
-import subprocess
+from inundation_engine import HucInundationEngine
+from huc_cache import HucInputCache
+
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 
 
 app = typer.Typer(
@@ -67,25 +77,36 @@ def __write_flow_input_file(
 
 def __download_huc_fim(huc_id: str, fim_data_dir: Path) -> None:
     """
-    Downloads the FIM map for a specific HUC identifier.
+    Downloads the FIM map for a specific HUC identifier. The HUC input data is
+    kept in a cache that is shared between jobs (see huc_cache.py), which is
+    configured with the following environment variables:
+
+      FIM_HUC_CACHE_DIR - the root of the cache, e.g. a bucket or volume mount (default: /home/output).
+      FIM_HUC_CACHE_MAX_GB - evict the least recently used HUCs above this size (default: 0, no eviction).
+      FIM_HUC_CACHE_VERIFY - set to 1 to verify file checksums on every use (default: 0, sizes only).
 
     Arguments:
         huc_id - str: The HUC identifier for the watershed.
+        fim_data_dir - Path: The path where the HUC input data is expected.
     Returns:
         None
     """
 
-    if not fim_data_dir.exists():
-        # Download the HUC input data if it does not exist.
-        fm.DownloadHUC8(huc_id)
-    else:
-        print("FIM Data Already Exists. Skipping download.")
+    def setup():
         # if the data already exists, perfom the remaining
         # setup tasks outlined in the DownloadHUC8 function.
-
         code_dir, data_dir, output_dir = fm.setup_directories()
         fm.EnvFile(code_dir)
 
+    cache = HucInputCache(
+        os.environ.get("FIM_HUC_CACHE_DIR", "/home/output"),
+        max_bytes=int(float(os.environ.get("FIM_HUC_CACHE_MAX_GB", "0")) * 1e9),
+        verify_checksums=os.environ.get("FIM_HUC_CACHE_VERIFY", "0") == "1",
+    )
+    cache.ensure(
+        huc_id, fim_data_dir, download=lambda: fm.DownloadHUC8(huc_id), setup=setup
+    )
+
 
 #        HUC_dir = os.path.join(output_dir, f"flood_{huc_id}")
 #        hydrotable_dir = os.path.join(HUC_dir, str(huc_id), "hydrotable.csv")
@@ -93,93 +114,239 @@ def __download_huc_fim(huc_id: str, fim_data_dir: Path) -> None:
 #        fm.uniqueFID(hydrotable_dir, featureID_dir)
 
 
-def __generate_fim(huc_id, flow_rate_filepath, label="") -> None:
+def __generate_fim(huc_id, flow_rate_filepath, label="", inundation_dir=None) -> None:
     """
     Generates a FIM map for a specific HUC and input flow rate file.
 
     Arguments:
         huc_id - str: The HUC identifier for the watershed.
         flow_rate_filepath - pathlib.Path: The path to the flow rate file.
+        label - str: The output subdirectory of the map in the inundation directory of the HUC.
+        inundation_dir - Path: The directory to write the map to instead, e.g. a working directory.
     Returns:
         pathlib.Path: The path to the generated FIM map.
     """
 
     code_dir = "/home/code/inundation-mapping"
     output_dir = "/home/output"
-    runFIM.runfim(code_dir, output_dir, huc_id, flow_rate_filepath, label)
+    runFIM.runfim(
+        code_dir,
+        output_dir,
+        huc_id,
+        flow_rate_filepath,
+        label,
+        inundation_dir=inundation_dir,
+    )
 
 
-def __crop_data(array, geotiff_profile):
+def __row_windows(
+    src, row_off: int, col_off: int, height: int, width: int, chunk_rows: int
+):
+    """
+    Splits a region of a raster into windows of whole rows, aligned
+    with the block height of the raster so that blocks are read once.
+    """
+
+    block_rows = src.block_shapes[0][0]
+    step = max(block_rows, (chunk_rows // block_rows) * block_rows)
+    for r in range(row_off, row_off + height, step):
+        yield rasterio.windows.Window(
+            col_off, r, width, min(step, row_off + height - r)
+        )
+
+
+def __crop_mask(mask: numpy.ndarray, transform: Affine):
+    """
+    Crops an inundation mask to the bounding box of its inundated pixels.
 
-    # Identify the bounding box where values == 1
-    rows, cols = numpy.where(array == 1)
+    Arguments:
+        mask - numpy.ndarray: A uint8 mask where inundated pixels are 1.
+        transform - Affine: The transform of the mask.
+    Returns:
+        Tuple[numpy.ndarray, Affine]: The cropped mask and its transform.
+    """
 
+    rows = numpy.flatnonzero(mask.any(axis=1))
+    cols = numpy.flatnonzero(mask.any(axis=0))
     if rows.size == 0 or cols.size == 0:
         raise ValueError("No values equal to 1 in the dataset.")
 
-    # Calculate new bounding box
-    row_min, row_max = rows.min(), rows.max()
-    col_min, col_max = cols.min(), cols.max()
+    cropped = mask[rows[0] : rows[-1] + 1, cols[0] : cols[-1] + 1]
+    return cropped, transform * Affine.translation(cols[0], rows[0])
 
-    # crop the data to the new extent
-    cropped_data = array[row_min : row_max + 1, col_min : col_max + 1]
 
-    # Update the transform to reflect the new bounding box
-    transform = geotiff_profile["transform"]
-    new_transform = transform * Affine.translation(col_min, row_min)
+def __read_inundation_mask(src, chunk_rows: int = 1024):
+    """
+    Reads a FIM raster once, in strips of rows, and returns a uint8 mask of the
+    inundated (> 0) pixels cropped to their bounding box. The bounding box is
+    computed from per-row and per-column any() reductions of each strip, and
+    only the strips that contain inundated rows are kept in memory.
 
-    geotiff_profile.update(
-        {
-            "height": cropped_data.shape[0],
-            "width": cropped_data.shape[1],
-            "transform": new_transform,
-            "dtype": "float32",
-        }
-    )
+    Arguments:
+        src - rasterio.DatasetReader: The open FIM raster.
+        chunk_rows - int: The number of rows to read at a time.
+    Returns:
+        Tuple[numpy.ndarray, Affine]: The cropped mask, where inundated pixels are 1
+        and all others are 0, and the transform of the cropped extent.
+    """
 
-    return cropped_data, geotiff_profile
+    strips = []
+    col_any = numpy.zeros(src.width, dtype=bool)
+    for window in __row_windows(src, 0, 0, src.height, src.width, chunk_rows):
+        inundated = src.read(1, window=window) > 0
+        rows = numpy.flatnonzero(inundated.any(axis=1))
+        if rows.size == 0:
+            continue
 
+        # keep the rows between the first and last inundated row of the strip
+        strips.append((window.row_off + rows[0], inundated[rows[0] : rows[-1] + 1]))
+        col_any |= inundated.any(axis=0)
 
-def __clean_fim_geotiff(
-    geotiff_path: Path,
-) -> None:
+    if len(strips) == 0:
+        raise ValueError("No values equal to 1 in the dataset.")
+
+    cols = numpy.flatnonzero(col_any)
+    col_min, col_max = cols[0], cols[-1]
+    row_min = strips[0][0]
+    row_max = strips[-1][0] + len(strips[-1][1]) - 1
+
+    mask = numpy.zeros((row_max - row_min + 1, col_max - col_min + 1), numpy.uint8)
+    for row, strip in strips:
+        mask[row - row_min : row - row_min + len(strip)] = strip[
+            :, col_min : col_max + 1
+        ]
+
+    return mask, src.transform * Affine.translation(col_min, row_min)
+
+
+def __clean_fim_to_cog(
+    geotiff_path: Path, output_path: Path, chunk_rows: int = 1024
+) -> Path:
     """
-    Clean the geotiff created by the FIM mosaic process.
-    Replace all values greater than 0 with 1 and set all
-    values less than or equal to 0 to 0.
+    Cleans the geotiff created by the FIM mosaic process and writes it directly
+    as a COG with overviews, in a single pass over the input. The output is a
+    uint8 mask, where inundated pixels are 1 and all others are 0 (nodata).
 
     Arguments:
-        geotiff_path: Path - Path to the geotiff file
+        geotiff_path: Path - Path to the geotiff created by the FIM mosaic process.
+        output_path: Path - Path of the output COG.
+        chunk_rows: int - The number of rows to read at a time.
     Returns:
-        None
+        pathlib.Path: The path to the COG.
     """
 
-    # Load the geotiff into memory
-    cleaned_data = None
     with rasterio.open(geotiff_path) as src:
-        # read the first band. Only one band should be present.
-        data = src.read(1)
-        profile = src.profile
+        mask, transform = __read_inundation_mask(src, chunk_rows)
+        crs = src.crs
 
-        try:
-            # set all values greater than 0 to 1, otherwise NaN
-            cleaned_data = numpy.where(data <= 0, numpy.nan, 1)
-        except Exception as e:
-            raise RuntimeError(f"Numpy: {e}, i.e. no flooding event found")
+    profile = dict(crs=crs, transform=transform, dtype="uint8", nodata=0)
+    __write_cog(output_path, mask, profile)
+    return output_path
 
-    # crop the data and set a new bounding box
-    cropped_data, cropped_profile = __crop_data(cleaned_data, profile)
 
-    # set datya type to float32 to account for nan values, -9999.0
-    cropped_profile.update(dtype=rasterio.float32, count=1)
+def __compute_fim_scenario(
+    i, huc_id, reach_id, flow_rate_filepath, label, inundation_dir=None
+):
+    print(f"Computing FIM for {huc_id}:{reach_id} - {flow_rate_filepath} \t [{i+1}]")
+    __generate_fim(huc_id, flow_rate_filepath, label, inundation_dir)
 
-    with rasterio.open(geotiff_path, "w", **cropped_profile) as dst:
-        dst.write(cropped_data.astype(rasterio.float32), 1)
 
+def __clean_fim_file(fpath: Path, directory: Path) -> str:
+    """
+    Cleans a single FIM geotiff into a COG in the output directory.
 
-def __compute_fim_scenario(i, huc_id, reach_id, flow_rate_filepath, label):
-    print(f"Computing FIM for {huc_id}:{reach_id} - {flow_rate_filepath} \t [{i+1}]")
-    __generate_fim(huc_id, flow_rate_filepath, label)
+    Arguments:
+        fpath - Path: The geotiff created by the FIM mosaic process.
+        directory - Path: The directory where the COG will be saved.
+    Returns:
+        str: A log message describing the outcome.
+    Raises:
+        ValueError: if the geotiff does not contain any inundation.
+    """
+
+    print(f"Cleaning FIM Results for {fpath.name}...", end="")
+    __clean_fim_to_cog(fpath, directory / f"{fpath.stem}.cog")
+    print("done")
+    return f"{fpath.name} processing SUCCESS."
+
+
+def __process_fim_scenario(
+    i, huc_id, reach_id, flow_rate_filepath, label, scenario_dir: Path, directory: Path
+) -> List[str]:
+    """
+    Computes the FIM of a single scenario and immediately cleans and converts
+    its output into a COG, so that post-processing runs in the same process
+    pool as the FIM computations instead of serially after all of them.
+
+    Arguments:
+        i - int: The index of the scenario.
+        huc_id - str: The HUC identifier for the watershed.
+        reach_id - str: The NWM reach identifier.
+        flow_rate_filepath - pathlib.Path: The path to the flow rate file.
+        label - str: The output label of the scenario, relative to the inundation directory.
+        scenario_dir - Path: The directory where the FIM mosaic process writes the scenario.
+        directory - Path: The directory where the final COG will be saved.
+    Returns:
+        List[str]: Log messages for the scenario.
+    Raises:
+        RuntimeError: if the FIM computation did not produce any output.
+    """
+
+    try:
+        __compute_fim_scenario(i, huc_id, reach_id, flow_rate_filepath, label)
+
+        fpaths = list(scenario_dir.glob("**/*.tif"))
+        if len(fpaths) == 0:
+            raise RuntimeError(f"No FIM output was produced in {scenario_dir}")
+
+        output_messages = []
+        for fpath in fpaths:
+            try:
+                output_messages.append(__clean_fim_file(fpath, directory))
+            except ValueError as e:
+                # stages that do not inundate anything are expected
+                # for the lowest increments and are not an error.
+                output_messages.append(f"{fpath.name} processing FAIL. -> {e}")
+                print(f"No inundation found for {fpath.name}.")
+        return output_messages
+
+    finally:
+        # remove the intermediate outputs, including those of failed
+        # scenarios so that they are recomputed by the next run.
+        shutil.rmtree(scenario_dir, ignore_errors=True)
+
+
+def __inundate_fim_scenario(
+    engine: HucInundationEngine, i, reach_id, flow, label, directory: Path
+) -> List[str]:
+    """
+    Computes the FIM of a single scenario with the in-process inundation
+    engine and writes it directly as a cleaned COG.
+
+    Arguments:
+        engine - HucInundationEngine: The engine, prepared for the reach.
+        i - int: The index of the scenario.
+        reach_id - str: The NWM reach identifier.
+        flow - float: The flow rate of the scenario in cubic meters per second.
+        label - str: The output label of the scenario.
+        directory - Path: The directory where the COG will be saved.
+    Returns:
+        List[str]: Log messages for the scenario.
+    """
+
+    print(f"Computing FIM for {reach_id} - {label} \t [{i+1}]")
+    name = f"{label}_inundation"
+    try:
+        mask, transform = __crop_mask(
+            engine.inundate({int(reach_id): flow}), engine.transform
+        )
+    except ValueError as e:
+        print(f"No inundation found for {name}.")
+        return [f"{name} processing FAIL. -> {e}"]
+
+    profile = dict(crs=engine.crs, transform=transform, dtype="uint8", nodata=0)
+    __write_cog(directory / f"{name}.cog", mask, profile)
+    return [f"{name} processing SUCCESS."]
 
 
 def __clean_fims(
@@ -193,7 +360,7 @@ def __clean_fims(
 ) -> None:
     """
     Cleans FIM maps by eliminating all negative values. This searches for all geotiff files that
-    exist in subdirectories of the input directory and places the cleaned files in the "input directory"
+    exist in subdirectories of the input directory and places the cleaned files, as COGs, in the "input directory"
 
     Arguments:
     ==========
@@ -207,18 +374,13 @@ def __clean_fims(
 
     # clean the geotiff that was created by replacing
     # all values less than or equal to 0 with 0 and all
-    # others with 1. Move the processed files up to the
-    # parent directory and remove all temp directories.
+    # others with 1, and write it as a COG in the parent
+    # directory. Then remove all temp directories.
     output_messages = []
     dirs_to_remove = []
     for fpath in Path(directory).glob("**/*.tif"):
         try:
-            print(f"Cleaning FIM Results for {fpath.name}...", end="")
-            __clean_fim_geotiff(fpath)
-            print("done")
-
-            output_messages.append(f"{fpath.name} processing SUCCESS.")
-            shutil.move(fpath, directory / fpath.name)
+            output_messages.append(__clean_fim_file(fpath, directory))
 
         except Exception as e:
             output_messages.append(f"{fpath.name} processing FAIL. -> {e}")
@@ -240,45 +402,253 @@ def __clean_fims(
             log_file.write(f"{output_message}\n")
 
 
-def __convert_to_cog(root_dir: Path) -> None:
+# written to the output directory of a reach once all of its FIM maps are complete
+COMPLETE_MARKER = ".complete"
 
-    failed_conversions = []
-    for input_tif in Path(root_dir).glob("**/*.tif"):
-        output_cog = input_tif.with_suffix(".cog")
+# matches the names of the per-stage FIM maps, e.g. 8584888__10_5_m__2497_cms_inundation.cog
+FIM_NAME_PATTERN = re.compile(r"^(\d+)__(\d+)_(\d+)_m__(\d+)_cms")
 
-        try:
-            cmd = [
-                "gdal_translate",
-                str(input_tif),
-                str(output_cog),
-                "-of",
-                "COG",
-                "-co",
-                "COMPRESS=DEFLATE",
-                "-co",
-                "BLOCKSIZE=512",
-                "-co",
-                "OVERVIEW_RESAMPLING=NEAREST",
-            ]
-            subprocess.run(
-                cmd,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-            )
 
-        # os.remove(input_tif)
-        # print(f"Converted to COG and deleted original: {input_tif}")
+def __write_cog(path: Path, data: numpy.ndarray, profile: dict, **tags) -> None:
+    """
+    Writes a single band array to a Cloud Optimized GeoTIFF, using the same
+    creation options as the gdal_translate based conversion.
+
+    Arguments:
+        path - Path: The path of the output COG.
+        data - numpy.ndarray: The 2D array to write.
+        profile - dict: The rasterio profile of the data, e.g. crs, transform, dtype, and nodata.
+        tags - str: Optional metadata tags to store in the COG.
+    Returns:
+        None
+    """
+
+    cog_profile = {
+        k: v for k, v in profile.items() if k in ("crs", "transform", "dtype", "nodata")
+    }
+    cog_profile.update(
+        driver="COG",
+        count=1,
+        height=data.shape[0],
+        width=data.shape[1],
+        compress="DEFLATE",
+        blocksize=512,
+        overview_resampling=Resampling.nearest.name.upper(),
+    )
 
-        except subprocess.CalledProcessError as e:
-            msg = f"Error converting {input_tif} to COG: {e}. STDOUT: {e.stdout}. STDERR: {e.stderr}"
-            failed_conversions.append(msg)
+    # write to a temporary file first so that a failed
+    # write never leaves a partial COG behind.
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with rasterio.open(tmp_path, "w", **cog_profile) as dst:
+        dst.write(data, 1)
+        if tags:
+            dst.update_tags(**tags)
+    os.replace(tmp_path, path)
 
-    if len(failed_conversions) > 0:
-        raise Exception(
-            "One or more COG conversions failed:\n" + "\n".join(failed_conversions)
+
+def __build_stage_stack(directory: Path, reach_id: str) -> Union[Path, None]:
+    """
+    Combines the per-stage FIM maps of a reach into a single "minimum inundating
+    stage" COG. Since inundation is monotonic in stage, each pixel holds the 1-based
+    index of the lowest stage that floods it, and 0 where no stage floods it. A pixel
+    is inundated at stage index k when 0 < value <= k. The stage and flow of each
+    index are stored in the STAGES_M and FLOWS_CMS tags of the output file.
+
+    Arguments:
+        directory - Path: The directory containing the per-stage COGs of the reach.
+        reach_id - str: The NWM reach identifier.
+    Returns:
+        pathlib.Path: The path to the stage stack COG, or None if no FIM maps were found.
+    """
+
+    # collect the FIM maps of the reach ordered by stage
+    scenarios = []
+    for fpath in Path(directory).glob(f"{reach_id}__*_inundation.cog"):
+        match = FIM_NAME_PATTERN.match(fpath.name)
+        if match is None:
+            continue
+        stage = float(f"{match.group(2)}.{match.group(3)}")
+        scenarios.append((stage, float(match.group(4)), fpath))
+    scenarios.sort()
+
+    if len(scenarios) == 0:
+        print(f"No FIM maps found for {reach_id} in {directory}")
+        return None
+
+    # all FIM maps of a HUC share the same grid and only differ
+    # in their cropped extent, so the stack covers their union.
+    profiles = []
+    for _, _, fpath in scenarios:
+        with rasterio.open(fpath) as src:
+            profiles.append(src.profile)
+
+    res_x = profiles[0]["transform"].a
+    res_y = -profiles[0]["transform"].e
+    left = min(p["transform"].c for p in profiles)
+    top = max(p["transform"].f for p in profiles)
+    right = max(p["transform"].c + p["width"] * res_x for p in profiles)
+    bottom = min(p["transform"].f - p["height"] * res_y for p in profiles)
+    width = int(round((right - left) / res_x))
+    height = int(round((top - bottom) / res_y))
+
+    dtype = numpy.uint8 if len(scenarios) <= 255 else numpy.uint16
+    stack = numpy.zeros((height, width), dtype=dtype)
+
+    for index, (_, _, fpath) in enumerate(scenarios, start=1):
+        with rasterio.open(fpath) as src:
+            data = src.read(1, masked=True)
+            row = int(round((top - src.transform.f) / res_y))
+            col = int(round((src.transform.c - left) / res_x))
+
+        inundated = numpy.ma.filled(data > 0, False)
+        window = stack[row : row + data.shape[0], col : col + data.shape[1]]
+
+        # only pixels that are not flooded by a lower stage take this index
+        window[inundated & (window == 0)] = index
+
+    profile = dict(
+        crs=profiles[0]["crs"],
+        transform=Affine(res_x, 0, left, 0, -res_y, top),
+        dtype=numpy.dtype(dtype).name,
+        nodata=0,
+    )
+    output_path = Path(directory) / f"{reach_id}__stage_stack.cog"
+    __write_cog(
+        output_path,
+        stack,
+        profile,
+        STAGES_M=",".join(str(s[0]) for s in scenarios),
+        FLOWS_CMS=",".join(str(s[1]) for s in scenarios),
+    )
+    print(f"Wrote stage stack for {len(scenarios)} stages to {output_path}")
+    return output_path
+
+
+def __rating_scenarios(
+    huc_id: str, reach_id: str, stage_increment: float
+) -> pandas.DataFrame:
+    """
+    Subdivides the rating curve of a reach into the stage scenarios that FIM
+    maps are generated for.
+
+    Arguments:
+        huc_id - str: The HUC identifier for the watershed.
+        reach_id - str: The NWM reach identifier.
+        stage_increment - float: The stage increment in meters.
+    Returns:
+        pandas.DataFrame: The stage_m, cms, and output label of each scenario.
+    """
+
+    print("Computing rating increments...", end="")
+    stage, flow = cr.compute_rating_increments(
+        huc_id=huc_id, reach_id=reach_id, increment=stage_increment, verbose=False
+    )
+    print("done")
+
+    # omit the first stage and flow values if the first stage
+    # is equal to 0, since there's no point in computing a FIM.
+    if stage[0] == 0:
+        df = pandas.DataFrame({"stage_m": stage[1:], "cms": flow[1:]})
+    else:
+        df = pandas.DataFrame({"stage_m": stage[:], "cms": flow[:]})
+
+    flow_labels = [f"{str(int(v))}_cms" for v in df.cms.values]
+    stage_labels = [
+        f"{str(round(v, 1)).replace('.','_')}_m" for v in df["stage_m"].values
+    ]
+    df["label"] = [
+        f"{reach_id}__{stage_labels[i]}__{flow_labels[i]}"
+        for i in range(0, len(flow_labels))
+    ]
+
+    print(f"Generating FIM for the following scenarios of {reach_id}:")
+    print(df)
+    return df
+
+
+def __submit_reach_scenarios(
+    executor,
+    huc_id: str,
+    reach_id: str,
+    scenarios: pandas.DataFrame,
+    root_path: Path,
+    root_label: str,
+    engine: Union[HucInundationEngine, None] = None,
+) -> Dict[Future, Tuple[str, int, str]]:
+    """
+    Submits the scenarios of a reach that have not been computed yet to the pool.
+
+    Arguments:
+        executor - Executor: The pool that computes the scenarios.
+        huc_id - str: The HUC identifier for the watershed.
+        reach_id - str: The NWM reach identifier.
+        scenarios - pandas.DataFrame: The scenarios of the reach (see __rating_scenarios).
+        root_path - Path: The directory where the FIM maps of the reach are saved.
+        root_label - str: The output label of root_path, relative to the inundation directory.
+        engine - HucInundationEngine: The engine prepared for the reach, or None to run OWP mosaic subprocesses.
+    Returns:
+        Dict[Future, Tuple[str, int, str]]: The reach, scenario index, and label of each submitted scenario.
+    """
+
+    futures = {}
+    for i, (flow, label) in enumerate(zip(scenarios.cms.values, scenarios.label)):
+
+        # skip scenarios that have already been computed
+        if (root_path / f"{label}_inundation.cog").exists():
+            print(f"Skipping scenario {i} for {huc_id}:{reach_id} - already exists.")
+            continue
+
+        if engine is not None:
+            future = executor.submit(
+                __inundate_fim_scenario, engine, i, reach_id, flow, label, root_path
+            )
+            futures[future] = (reach_id, i, label)
+            continue
+
+        # build the output path and output label specific to the scenario
+        # these extend the root_path and root_label objects to account for
+        # the optional sub_dir argument. Intermediate outputs that were left
+        # by an interrupted run are removed so that they are recomputed.
+        p = root_path / f"scenario_{i}"
+        shutil.rmtree(p, ignore_errors=True)
+
+        # write the input file that will be used to generate the FIM
+        flow_rate_filepath = __write_flow_input_file([reach_id], [flow], label)
+        future = executor.submit(
+            __process_fim_scenario,
+            i,
+            huc_id,
+            reach_id,
+            flow_rate_filepath,
+            f"{root_label}scenario_{i}",
+            p,
+            root_path,
         )
+        futures[future] = (reach_id, i, label)
+
+    return futures
+
+
+def __finalize_reach(
+    root_path: Path, reach_id: str, output_messages: List[str], stage_stack: bool
+) -> None:
+    """
+    Saves the log of a reach, cleans any leftover outputs, and builds its stage stack.
+    """
+
+    # save log messages for future reference
+    with open(root_path / "logs.txt", "a") as log_file:
+        for output_message in output_messages:
+            log_file.write(f"{output_message}\n")
+
+    # clean any outputs of skipped scenarios that were
+    # computed but not post-processed by a previous run.
+    __clean_fims(root_path)
+
+    # combine the per-stage maps into a single raster that
+    # can be thresholded to display any of the stages.
+    if stage_stack:
+        __build_stage_stack(root_path, reach_id)
 
 
 @app.command(name="reachfim_interval")
@@ -318,6 +688,20 @@ def generate_reach_fim_at_intervals(
             help="The subdirectory where the FIM maps will be saved. This is used to avoid overwriting existing FIM maps.",
         ),
     ] = None,
+    stage_stack: Annotated[
+        bool,
+        typer.Option(
+            "--stage-stack/--no-stage-stack",
+            help="Also combine the FIM maps into a single minimum inundating stage COG.",
+        ),
+    ] = True,
+    in_process: Annotated[
+        bool,
+        typer.Option(
+            "--in-process/--subprocess",
+            help="Compute all scenarios with the in-process inundation engine, which loads the HUC inputs once, instead of one OWP mosaic subprocess per scenario.",
+        ),
+    ] = False,
 ) -> None:
     """
     Generates a FIM maps for a specific HUC and nwm reach identifier using
@@ -328,6 +712,8 @@ def generate_reach_fim_at_intervals(
         huc_id - str: The HUC-8 identifier for the watershed.
         reach_ids - str: A comma separated list of NWM reach identifier for the reaches of interest.
         stage_increment - float: The stage increment in meteres that will be used to subdivide the rating curve into flows
+        stage_stack - bool: Also write a minimum inundating stage COG for the reach.
+        in_process - bool: Use the in-process inundation engine instead of OWP mosaic subprocesses.
 
     Returns:
     ========
@@ -342,43 +728,7 @@ def generate_reach_fim_at_intervals(
     __download_huc_fim(huc_id, Path(fim_data_dir))
 
     # compute flow from stage increments
-    print("Computing rating increments...", end="")
-    stage, flow = cr.compute_rating_increments(
-        huc_id=huc_id, reach_id=reach_id, increment=stage_increment, verbose=False
-    )
-    print("done")
-
-    # omit the first stage and flow values if the first stage
-    # is equal to 0, since there's no point in computing a FIM.
-    if stage[0] == 0:
-        df = pandas.DataFrame({"stage_m": stage[1:], "cms": flow[1:]})
-    else:
-        df = pandas.DataFrame({"stage_m": stage[:], "cms": flow[:]})
-    print("Generating FIM for the following scenarios:")
-    print(df)
-
-    # Generate Labels
-    print("Generating output labels...", end="")
-    flow_labels = [f"{str(int(v))}_cms" for v in df.cms.values]
-    flows = df.cms.values
-
-    stage_labels = [
-        f"{str(round(v, 1)).replace('.','_')}_m" for v in df["stage_m"].values
-    ]
-    labels = [
-        f"{reach_id}__{stage_labels[i]}__{flow_labels[i]}"
-        for i in range(0, len(flow_labels))
-    ]
-    print("done")
-
-    # write the input files that will be used to generate the FIM
-    print("Writing input files...", end="")
-    flow_rate_filepaths = []
-    for i in range(0, len(labels)):
-        flow_rate_filepaths.append(
-            __write_flow_input_file([reach_id], [flows[i]], labels[i])
-        )
-    print("done")
+    scenarios = __rating_scenarios(huc_id, reach_id, stage_increment)
 
     # define the root path where the final FIM maps will be saved.
     root_path = f"/home/output/flood_{huc_id}/{huc_id}_inundation"
@@ -387,42 +737,522 @@ def generate_reach_fim_at_intervals(
         root_path = f"/home/output/flood_{huc_id}/{huc_id}_inundation/{subdir}"
         root_label = f"{subdir}/"
 
-    with ProcessPoolExecutor(max_workers=max_procs) as executor:
+    # compute, clean, and convert each scenario in the process pool. Scenarios
+    # are post-processed as soon as their FIM finishes, and errors are
+    # collected per scenario rather than stopping the remaining scenarios.
+    #
+    # The in-process engine loads the HUC inputs once and shares them
+    # between threads, instead of running the OWP mosaic wrapper in a new
+    # subprocess, which reloads them, for every scenario.
+    Path(root_path).mkdir(parents=True, exist_ok=True)
+    engine = None
+    if in_process:
+        engine = HucInundationEngine(Path(fim_data_dir))
+        engine.prepare([reach_id])
+        pool = ThreadPoolExecutor(max_workers=max_procs)
+    else:
+        pool = ProcessPoolExecutor(max_workers=max_procs)
 
-        futures = []
-        for i in range(len(flow_rate_filepaths)):
+    output_messages = []
+    errors = {}
+    with pool as executor:
+        futures = __submit_reach_scenarios(
+            executor, huc_id, reach_id, scenarios, Path(root_path), root_label, engine
+        )
 
-            # build the output path and output label specifdic to the scenario
-            # these extend the root_path and root_label objects to account for
-            # the optional sub_dir argument.
-            p = f"{root_path}/scenario_{i}"
-            label = f"{root_label}scenario_{i}"
+        for future in as_completed(futures):
+            _, i, label = futures[future]
+            try:
+                output_messages.extend(future.result())
+            except Exception as e:
+                errors[i] = str(e)
+                output_messages.append(f"scenario_{i} ({label}) FAIL. -> {e}")
+                print(f"Error computing FIM for scenario {i} ({label}).\n{e}")
 
-            # skip files that already exist
-            if Path(p).exists():
-                print(
-                    f"Skipping scenario {i} for {huc_id}:{reach_id} - already exists."
-                )
+    __finalize_reach(Path(root_path), reach_id, output_messages, stage_stack)
+
+    if len(errors) > 0:
+        raise Exception(
+            f"{len(errors)} of {len(futures)} FIM scenarios failed:\n"
+            + "\n".join(f"scenario_{i}: {e}" for i, e in sorted(errors.items()))
+        )
+
+
+def __reach_footprint(
+    huc_engine: HucInundationEngine, reach_id: str
+) -> Tuple[numpy.ndarray, Affine]:
+    """
+    Computes the pixels where a reach can be inundated, i.e. its catchments in
+    every branch of the HUC, cropped to their bounding box.
+
+    Arguments:
+        huc_engine - HucInundationEngine: An engine of the HUC that has indexed the reach.
+        reach_id - str: The NWM reach identifier.
+    Returns:
+        Tuple[numpy.ndarray, Affine]: A boolean mask of the catchments and its transform.
+    """
+
+    engine = huc_engine.subset([reach_id])
+    return __crop_mask(engine.footprint(), engine.transform)
+
+
+def __pack_reaches(
+    footprints: Dict[str, Tuple[numpy.ndarray, Affine]]
+) -> List[List[str]]:
+    """
+    Greedily groups reaches whose footprints do not share any pixel. The
+    inundation of a group can be computed in a single mosaic run and split
+    back into the reaches by their footprints, since a pixel is only ever
+    inundated by the reach of its catchment.
+
+    Arguments:
+        footprints - Dict[str, Tuple]: The footprint of each reach (see __reach_footprint).
+    Returns:
+        List[List[str]]: The groups of reaches that do not interfere with each other.
+    """
+
+    # place the footprints on the pixel grid of the HUC, which
+    # is shared by the rasters of every branch.
+    if len(footprints) == 0:
+        return []
+    reference = next(iter(footprints.values()))[1]
+    placed = {}
+    for reach_id, (mask, transform) in footprints.items():
+        row = int(round((reference.f - transform.f) / -reference.e))
+        col = int(round((transform.c - reference.c) / reference.a))
+        placed[reach_id] = (row, col, mask)
+
+    def overlaps(a, b):
+        (row_a, col_a, mask_a), (row_b, col_b, mask_b) = a, b
+        top, left = max(row_a, row_b), max(col_a, col_b)
+        bottom = min(row_a + mask_a.shape[0], row_b + mask_b.shape[0])
+        right = min(col_a + mask_a.shape[1], col_b + mask_b.shape[1])
+        if top >= bottom or left >= right:
+            return False
+        return bool(
+            (
+                mask_a[top - row_a : bottom - row_a, left - col_a : right - col_a]
+                & mask_b[top - row_b : bottom - row_b, left - col_b : right - col_b]
+            ).any()
+        )
+
+    groups = []
+    for reach_id in placed:
+        for group in groups:
+            if not any(overlaps(placed[reach_id], placed[r]) for r in group):
+                group.append(reach_id)
+                break
+        else:
+            groups.append([reach_id])
+    return groups
+
+
+def __split_packed_fim(
+    src, footprint: numpy.ndarray, transform: Affine, output_path: Path
+) -> Path:
+    """
+    Extracts the inundation of a single reach from the FIM mosaic of a packed
+    scenario and writes it as a COG.
+
+    Arguments:
+        src - rasterio.DatasetReader: The open FIM mosaic of the packed scenario.
+        footprint - numpy.ndarray: The footprint of the reach (see __reach_footprint).
+        transform - Affine: The transform of the footprint.
+        output_path - Path: The path of the output COG.
+    Returns:
+        pathlib.Path: The path to the COG.
+    Raises:
+        ValueError: if the reach is not inundated.
+    """
+
+    col, row = ~src.transform * (transform.c, transform.f)
+    window = rasterio.windows.Window(
+        int(round(col)), int(round(row)), footprint.shape[1], footprint.shape[0]
+    )
+    data = src.read(1, window=window, boundless=True, fill_value=0)
+
+    mask = ((data > 0) & footprint).astype(numpy.uint8)
+    mask, mask_transform = __crop_mask(mask, transform)
+
+    profile = dict(crs=src.crs, transform=mask_transform, dtype="uint8", nodata=0)
+    __write_cog(output_path, mask, profile)
+    return output_path
+
+
+def __process_packed_scenario(
+    i,
+    huc_id,
+    flow_rate_filepath,
+    scenario_dir: Path,
+    members: List[Tuple[str, str, Tuple[numpy.ndarray, Affine]]],
+    directory: Path,
+) -> Dict[str, List[str]]:
+    """
+    Computes the FIM of a packed scenario, which holds the flows of several
+    non-interfering reaches, and splits it into a COG per reach.
+
+    Arguments:
+        i - int: The index of the scenario.
+        huc_id - str: The HUC identifier for the watershed.
+        flow_rate_filepath - pathlib.Path: The path to the flow rate file of all reaches.
+        scenario_dir - Path: The working directory where the FIM mosaic process writes the scenario.
+        members - List[Tuple]: The reach identifier, output label, and footprint of each reach.
+        directory - Path: The inundation directory, where each reach has its own subdirectory.
+    Returns:
+        Dict[str, List[str]]: Log messages for each reach.
+    Raises:
+        RuntimeError: if the FIM computation did not produce a single output.
+    """
+
+    try:
+        __compute_fim_scenario(
+            i,
+            huc_id,
+            f"{len(members)} packed reaches",
+            flow_rate_filepath,
+            scenario_dir.name,
+            inundation_dir=scenario_dir,
+        )
+
+        fpaths = list(scenario_dir.glob("**/*.tif"))
+        if len(fpaths) != 1:
+            raise RuntimeError(
+                f"Expected a single FIM output in {scenario_dir}, found {len(fpaths)}"
+            )
+
+        output_messages = {}
+        with rasterio.open(fpaths[0]) as src:
+            for reach_id, reach_label, (footprint, transform) in members:
+                name = f"{reach_label}_inundation"
+                try:
+                    __split_packed_fim(
+                        src, footprint, transform, directory / reach_id / f"{name}.cog"
+                    )
+                    message = f"{name} processing SUCCESS."
+                except ValueError as e:
+                    print(f"No inundation found for {name}.")
+                    message = f"{name} processing FAIL. -> {e}"
+                output_messages.setdefault(reach_id, []).append(message)
+        return output_messages
+
+    finally:
+        shutil.rmtree(scenario_dir, ignore_errors=True)
+
+
+def __submit_packed_scenarios(
+    executor,
+    huc_id: str,
+    reach_scenarios: Dict[str, pandas.DataFrame],
+    footprints: Dict[str, Tuple[numpy.ndarray, Affine]],
+    directory: Path,
+    work_dir: Path,
+) -> Dict[Future, List[Tuple[str, int, str]]]:
+    """
+    Packs the scenarios of non-interfering reaches into shared flow files, so that
+    the i-th scenario of every reach in a group is computed by one mosaic run.
+
+    Arguments:
+        executor - Executor: The pool that computes the scenarios.
+        huc_id - str: The HUC identifier for the watershed.
+        reach_scenarios - Dict[str, pandas.DataFrame]: The scenarios of each reach (see __rating_scenarios).
+        footprints - Dict[str, Tuple]: The footprint of each reach (see __reach_footprint).
+        directory - Path: The inundation directory, where each reach has its own subdirectory.
+        work_dir - Path: The working directory of the packed scenarios, which must not be shared with other jobs.
+    Returns:
+        Dict[Future, List[Tuple[str, int, str]]]: The reach, scenario index, and label of the reaches in each submitted scenario.
+    """
+
+    groups = __pack_reaches(footprints)
+    print(f"Packed {len(footprints)} reaches into {len(groups)} groups")
+
+    futures = {}
+    for g, group in enumerate(groups):
+        for i in range(max(len(reach_scenarios[r]) for r in group)):
+            members = []
+            for reach_id in group:
+                scenarios = reach_scenarios[reach_id]
+                if i >= len(scenarios):
+                    continue
+
+                # skip scenarios that have already been computed
+                label = scenarios.label.iloc[i]
+                if (directory / reach_id / f"{label}_inundation.cog").exists():
+                    print(
+                        f"Skipping scenario {i} for {huc_id}:{reach_id} - already exists."
+                    )
+                    continue
+                members.append((reach_id, label, scenarios.cms.iloc[i]))
+
+            if len(members) == 0:
                 continue
 
-            futures.append(
-                executor.submit(
-                    __compute_fim_scenario,
-                    i,
+            # write the input file that holds the flows of all reaches of the scenario.
+            # The names of the input file and the working directory are unique to
+            # this job, so that concurrent jobs of the same HUC do not collide.
+            name = f"group_{g}__scenario_{i}"
+            flow_rate_filepath = __write_flow_input_file(
+                [m[0] for m in members],
+                [m[2] for m in members],
+                f"{work_dir.name}__{name}",
+            )
+
+            future = executor.submit(
+                __process_packed_scenario,
+                i,
+                huc_id,
+                flow_rate_filepath,
+                work_dir / name,
+                [(m[0], m[1], footprints[m[0]]) for m in members],
+                directory,
+            )
+            futures[future] = [(m[0], i, m[1]) for m in members]
+
+    return futures
+
+
+@app.command(name="hucfim_interval")
+def generate_huc_fim_at_intervals(
+    huc_id: Annotated[
+        str,
+        typer.Argument(
+            ...,
+            help="The HUC-8 identifier for the watershed.",
+        ),
+    ] = "03020202",
+    reach_ids: Annotated[
+        str,
+        typer.Argument(
+            ...,
+            help="A comma separated list of NWM identifiers for the reaches of interest, all within the HUC.",
+        ),
+    ] = "11239409",
+    stage_increment: Annotated[
+        float,
+        typer.Argument(
+            ...,
+            help="The stage increment in meteres that will be used to subdivide the rating curve into flows",
+        ),
+    ] = 0.5,
+    max_procs: Annotated[
+        int,
+        typer.Argument(
+            ...,
+            help="The number of cuncorrent processes that we execute",
+        ),
+    ] = 1,
+    stage_stack: Annotated[
+        bool,
+        typer.Option(
+            "--stage-stack/--no-stage-stack",
+            help="Also combine the FIM maps of each reach into a single minimum inundating stage COG.",
+        ),
+    ] = False,
+    in_process: Annotated[
+        bool,
+        typer.Option(
+            "--in-process/--subprocess",
+            help="Compute all scenarios with the in-process inundation engine, which loads the HUC inputs once, instead of one OWP mosaic subprocess per scenario.",
+        ),
+    ] = False,
+    pack: Annotated[
+        bool,
+        typer.Option(
+            "--pack/--no-pack",
+            help="Compute the scenarios of reaches whose catchments do not overlap in shared OWP mosaic runs, and split the outputs by catchment.",
+        ),
+    ] = False,
+) -> None:
+    """
+    Generates FIM maps at stage intervals for many reaches of the same HUC in a
+    single job. This is equivalent to running reachfim_interval for each reach
+    with the reach identifier as its subdir, but the HUC data is set up once and
+    the scenarios of all reaches share one process pool.
+
+    The maps of each reach are saved in {huc_id}_inundation/{reach_id}. Once all
+    scenarios of a reach succeed, a resume marker is written to its directory
+    and the reach is skipped when the job is run again.
+
+    With pack, reaches whose catchments do not share any pixel are grouped, and
+    the i-th scenario of every reach in a group is computed by one OWP mosaic run
+    from a shared flow file. Since a pixel is only inundated by the reach of its
+    catchment, the mosaic is split back into the maps of each reach by their
+    catchments. This reduces the number of full HUC mosaic runs from one per
+    scenario of every reach to one per scenario of every group.
+
+    Arguments:
+    ==========
+        huc_id - str: The HUC-8 identifier for the watershed.
+        reach_ids - str: A comma separated list of NWM reach identifiers for the reaches of interest.
+        stage_increment - float: The stage increment in meteres that will be used to subdivide the rating curve into flows
+        max_procs - int: The number of scenarios that are computed concurrently.
+        stage_stack - bool: Also write a minimum inundating stage COG for each reach (default: False).
+        in_process - bool: Use the in-process inundation engine instead of OWP mosaic subprocesses.
+        pack - bool: Pack the scenarios of non-interfering reaches into shared OWP mosaic runs.
+
+    Returns:
+    ========
+        None
+
+    """
+
+    # the in-process engine only computes the catchments of each
+    # reach, so it does not benefit from packing reaches together.
+    if pack and in_process:
+        print("Packing only applies to OWP mosaic subprocesses and will be ignored.")
+        pack = False
+
+    # TODO: This is hardcoded for now, but should be an important parameter in the future.
+    fim_data_dir = f"/home/output/flood_{huc_id}/{huc_id}"
+    inundation_dir = Path(f"/home/output/flood_{huc_id}/{huc_id}_inundation")
+
+    # download HUC data if it doesn't exist
+    __download_huc_fim(huc_id, Path(fim_data_dir))
+
+    # skip the reaches that were completed by a previous run
+    r_ids = []
+    for reach_id in dict.fromkeys(r.strip() for r in reach_ids.split(",")):
+        if reach_id == "":
+            continue
+        if (inundation_dir / reach_id / COMPLETE_MARKER).exists():
+            print(f"Skipping {huc_id}:{reach_id} - already complete.")
+            continue
+        r_ids.append(reach_id)
+    print(f"Generating FIM for {len(r_ids)} reaches in {huc_id}")
+
+    # locate the catchments of all reaches with a single pass over the rasters of
+    # each branch. The engine of each reach shares this index and is prepared
+    # when its first scenario runs, so only the reaches that are being computed
+    # hold their inputs in memory.
+    # Packing uses the same index to compute the footprints of the reaches.
+    huc_engine = None
+    if in_process or pack:
+        huc_engine = HucInundationEngine(Path(fim_data_dir))
+        huc_engine.index(r_ids)
+    if in_process:
+        pool = ThreadPoolExecutor(max_workers=max_procs)
+    else:
+        pool = ProcessPoolExecutor(max_workers=max_procs)
+
+    # the packed scenarios are computed in a working directory on local scratch
+    # that belongs to this job, and that is removed once the pool has finished.
+    if pack:
+        scratch_dir = Path(os.environ.get("FIM_SCRATCH_DIR", "/home/data/scratch"))
+        scratch_dir.mkdir(parents=True, exist_ok=True)
+        work_dir_context = tempfile.TemporaryDirectory(
+            prefix=f"packed_{huc_id}_{os.getpid()}_", dir=scratch_dir
+        )
+    else:
+        work_dir_context = contextlib.nullcontext()
+
+    output_messages = {reach_id: [] for reach_id in r_ids}
+    errors = {}
+
+    def complete(reach_id):
+        root_path = inundation_dir / reach_id
+        try:
+            __finalize_reach(
+                root_path, reach_id, output_messages[reach_id], stage_stack
+            )
+        except Exception as e:
+            errors.setdefault(reach_id, []).append(f"finalize: {e}")
+            print(f"Error finalizing FIM for {huc_id}:{reach_id}.\n{e}")
+            return
+
+        if reach_id not in errors:
+            with open(root_path / COMPLETE_MARKER, "w") as f:
+                f.write(f"stage_increment={stage_increment}\n")
+
+    with work_dir_context as work_dir, pool as executor:
+
+        # submit the scenarios of every reach, so that the pool starts
+        # working on the first reaches while the others are submitted.
+        futures = {}
+        reach_scenarios = {}
+        footprints = {}
+        for reach_id in r_ids:
+            root_path = inundation_dir / reach_id
+            try:
+                scenarios = __rating_scenarios(huc_id, reach_id, stage_increment)
+                root_path.mkdir(parents=True, exist_ok=True)
+
+                if pack:
+                    # packed scenarios are submitted once all reaches are known
+                    footprints[reach_id] = __reach_footprint(huc_engine, reach_id)
+                    reach_scenarios[reach_id] = scenarios
+                    continue
+
+                engine = None
+                if in_process:
+                    engine = huc_engine.subset([reach_id])
+
+                reach_futures = __submit_reach_scenarios(
+                    executor,
                     huc_id,
                     reach_id,
-                    flow_rate_filepaths[i],
-                    label,
+                    scenarios,
+                    root_path,
+                    f"{reach_id}/",
+                    engine,
                 )
-            )
+            except Exception as e:
+                errors[reach_id] = [f"setup: {e}"]
+                print(f"Error preparing FIM scenarios for {huc_id}:{reach_id}.\n{e}")
+                continue
 
-    # clean the generated fim maps to remove negative values. The
-    # output will be geotiffs containing 0's where no inundation
-    # exists and 1's where inundation exists.
-    __clean_fims(Path(root_path))
+            reach_scenarios[reach_id] = scenarios
+            futures.update({f: [member] for f, member in reach_futures.items()})
+
+        if pack:
+            futures = __submit_packed_scenarios(
+                executor,
+                huc_id,
+                reach_scenarios,
+                footprints,
+                inundation_dir,
+                Path(work_dir),
+            )
 
-    # convert the output into COG format
-    __convert_to_cog(Path(root_path))
+        # count the scenarios that are pending for each reach
+        remaining = {reach_id: 0 for reach_id in reach_scenarios}
+        for members in futures.values():
+            for reach_id, _, _ in members:
+                remaining[reach_id] += 1
+
+        # finalize reaches as soon as all of their scenarios finish, so that
+        # their outputs and resume markers survive an interrupted job. Reaches
+        # whose scenarios were all computed by a previous run finish first.
+        for reach_id, count in remaining.items():
+            if count == 0:
+                complete(reach_id)
+
+        for future in as_completed(futures):
+            members = futures[future]
+            try:
+                result = future.result()
+                if not pack:
+                    result = {members[0][0]: result}
+                for reach_id, messages in result.items():
+                    output_messages[reach_id].extend(messages)
+            except Exception as e:
+                for reach_id, i, label in members:
+                    errors.setdefault(reach_id, []).append(f"scenario_{i}: {e}")
+                    output_messages[reach_id].append(
+                        f"scenario_{i} ({label}) FAIL. -> {e}"
+                    )
+                    print(f"Error computing FIM for scenario {i} ({label}).\n{e}")
+
+            for reach_id, _, _ in members:
+                remaining[reach_id] -= 1
+                if remaining[reach_id] == 0:
+                    complete(reach_id)
+
+    if len(errors) > 0:
+        raise Exception(
+            f"FIM generation failed for {len(errors)} of {len(r_ids)} reaches:\n"
+            + "\n".join(
+                f"{reach_id}: {'; '.join(e)}" for reach_id, e in sorted(errors.items())
+            )
+        )
 
 
 @app.command(name="reachfim")
@@ -507,7 +1337,7 @@ def generate_reach_fim(
         # by NOAA OWP.
         #
         # clean the generated fim maps to remove negative values. The
-        # output will be geotiffs containing 0's where no inundation
+        # output will be COGs containing 0's (nodata) where no inundation
         # exists and 1's where inundation exists.
         p = f"/home/output/flood_{huc_id}/{huc_id}_inundation"
         if subdir is not None:
@@ -517,7 +1347,6 @@ def generate_reach_fim(
             __generate_fim(huc_id, flow_rate_filepaths[i])
 
         __clean_fims(Path(p))
-        __convert_to_cog(Path(p))
 
 
 @app.command(name="clean")
@@ -532,7 +1361,7 @@ def clean_fims_cmd(
 ) -> None:
     """
     Cleans FIM maps by eliminating all negative values. This searches for all geotiff files that
-    exist in subdirectories of the input directory and places the cleaned files in the "input directory"
+    exist in subdirectories of the input directory and places the cleaned files, as COGs, in the "input directory"
 
     Arguments:
     ==========
@@ -551,5 +1380,41 @@ def clean_fims_cmd(
     __clean_fims(directory)
 
 
+@app.command(name="stagestack")
+def stage_stack_cmd(
+    directory: Annotated[
+        Path,
+        typer.Argument(
+            ...,
+            help="Path to the directory which contains the FIM COGs of the reach",
+        ),
+    ],
+    reach_id: Annotated[
+        str,
+        typer.Argument(
+            ...,
+            help="The NWM identifier of the reach.",
+        ),
+    ],
+) -> None:
+    """
+    Combines the per-stage FIM COGs of a reach into a single minimum inundating
+    stage COG, where each pixel holds the 1-based index of the lowest stage that
+    floods it.
+
+    Arguments:
+    ==========
+        directory - Path: The directory containing the FIM COGs of the reach.
+        reach_id - str: The NWM reach identifier.
+
+    Returns:
+    ========
+        None
+
+    """
+
+    __build_stage_stack(directory, reach_id)
+
+
 if __name__ == "__main__":
     app()
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+
+"""
+The purpose of this script is to manage the HUC input data (HAND rasters,
+catchments, hydrotables, etc.) that is downloaded for FIM generation as a
+cache that is shared between jobs, e.g. on the bucket or volume that is
+mounted at /home/output.
+
+- A HUC is only considered complete once its manifest has been written. The
+  manifest lists the size and sha256 checksum of every downloaded file and is
+  written atomically as the last step of a download, so a half-finished
+  download is detected and downloaded again rather than used.
+- Jobs that need the same HUC take a lock file, so that parallel jobs wait
+  for one download instead of duplicating it. Lock files are created
+  exclusively rather than with flock, which is not supported by gcsfuse.
+- Every job that uses a HUC holds a lease file in {root}/.leases/{huc} until
+  it exits. Locks and leases are refreshed in the background, and those that
+  have not been refreshed for a while are considered abandoned.
+- The least recently used HUCs are evicted once the cache exceeds its size
+  limit, except for HUCs that are locked or leased by a job.
+- HUC data that already exists without a manifest, e.g. from jobs that ran
+  before the cache was introduced, is adopted by writing its manifest. Only
+  data that the cache downloaded itself is ever deleted. A marker file in
+  {root}/.incomplete records the HUCs that the cache is still downloading or
+  evicting, so that their partial data is never mistaken for existing data.
+"""
+
+import os
+import json
+import uuid
+import atexit
+import time
+import shutil
+import socket
+import hashlib
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Tuple, Union
+
+MANIFEST_NAME = ".manifest.json"
+LAST_USED_NAME = ".last_used"
+
+
+def sha256sum(path: Path, chunk_size: int = 8 * 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def directory_size(directory: Path) -> int:
+    """
+    Computes the total size of the files in a directory, including files that
+    are not listed in its manifest, e.g. caches that were written next to the data.
+    """
+
+    size = 0
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            try:
+                size += os.stat(os.path.join(dirpath, filename)).st_size
+            except FileNotFoundError:
+                continue
+    return size
+
+
+def build_manifest(directory: Path) -> Dict[str, dict]:
+    """
+    Lists the size and sha256 checksum of every file in a directory.
+
+    Arguments:
+        directory - Path: The directory to list.
+    Returns:
+        Dict[str, dict]: The size and sha256 of each file, keyed by its path relative to the directory.
+    """
+
+    manifest = {}
+    for path in sorted(Path(directory).rglob("*")):
+        if not path.is_file() or path.name in (MANIFEST_NAME, LAST_USED_NAME):
+            continue
+        manifest[str(path.relative_to(directory))] = dict(
+            size=path.stat().st_size, sha256=sha256sum(path)
+        )
+    return manifest
+
+
+class HucInputCache:
+    """
+    A cache of HUC input data shared between FIM jobs.
+
+    Arguments:
+        root - Path: The root of the cache. HUCs are stored in {root}/flood_{huc}/{huc},
+                     which matches the layout expected by FIMserv under /home/output.
+        max_bytes - int: Evict the least recently used HUCs once the cache is larger than this (0 disables eviction).
+        verify_checksums - bool: Verify the checksums of every file on each use, rather than only their sizes.
+        lock_timeout - float: The number of seconds to wait for another job's download.
+        stale_lock - float: Locks and leases that have not been refreshed for this many seconds are considered abandoned.
+    """
+
+    def __init__(
+        self,
+        root: Union[str, Path],
+        max_bytes: int = 0,
+        verify_checksums: bool = False,
+        lock_timeout: float = 3 * 3600,
+        stale_lock: float = 600,
+    ):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.verify_checksums = verify_checksums
+        self.lock_timeout = lock_timeout
+        self.stale_lock = stale_lock
+        self.__leases = {}
+        atexit.register(self.release)
+
+    def entry_path(self, huc_id: str) -> Path:
+        return self.root / f"flood_{huc_id}" / huc_id
+
+    def __lock_path(self, huc_id: str) -> Path:
+        return self.root / ".locks" / f"{huc_id}.lock"
+
+    def __lease_dir(self, huc_id: str) -> Path:
+        return self.root / ".leases" / huc_id
+
+    def __incomplete_marker(self, huc_id: str) -> Path:
+        return self.root / ".incomplete" / huc_id
+
+    def __mark_incomplete(self, huc_id: str) -> None:
+        marker = self.__incomplete_marker(huc_id)
+        marker.parent.mkdir(parents=True, exist_ok=True)
+        marker.touch()
+
+    def __try_lock(self, lock_path: Path) -> bool:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # retry once the lock of a job that stopped refreshing it is removed
+            if self.__take_over_stale_lock(lock_path):
+                return self.__try_lock(lock_path)
+            return False
+
+        with os.fdopen(fd, "w") as f:
+            json.dump(
+                dict(host=socket.gethostname(), pid=os.getpid(), id=uuid.uuid4().hex),
+                f,
+            )
+        return True
+
+    def __read_lock(self, lock_path: Path) -> Tuple[float, str]:
+        with open(lock_path, "r") as f:
+            owner = f.read()
+        return time.time() - lock_path.stat().st_mtime, owner
+
+    def __take_over_stale_lock(self, lock_path: Path) -> bool:
+        """
+        Removes a lock whose owner stopped refreshing it. The lock is renamed aside
+        before it is removed, which only one of the jobs that found it stale can do.
+        If the lock that was renamed is not the stale one, because another job took
+        it over and locked again in the meantime, it is put back.
+
+        Returns:
+            bool: True if the stale lock was removed.
+        """
+
+        try:
+            age, owner = self.__read_lock(lock_path)
+        except OSError:
+            return False
+        if age <= self.stale_lock:
+            return False
+
+        aside_path = lock_path.with_name(f"{lock_path.name}.{uuid.uuid4().hex}.stale")
+        try:
+            os.rename(lock_path, aside_path)
+        except FileNotFoundError:
+            return False
+
+        try:
+            _, aside_owner = self.__read_lock(aside_path)
+        except OSError:
+            aside_owner = None
+        if aside_owner != owner:
+            os.rename(aside_path, lock_path)
+            return False
+
+        print(f"Removing stale lock {lock_path} ({int(age)}s old)")
+        aside_path.unlink(missing_ok=True)
+        return True
+
+    def __heartbeat(self, path: Path) -> Callable[[], None]:
+        """
+        Refreshes a lock or lease in the background, and returns a function that
+        stops refreshing it. A file that was taken over is never recreated.
+        """
+
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.stale_lock / 4):
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    print(f"{path} was taken over by another job")
+                    return
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+
+        def stop_heartbeat():
+            stop.set()
+            thread.join()
+
+        return stop_heartbeat
+
+    @contextmanager
+    def lock(self, huc_id: str, poll_interval: float = 5) -> Iterator[None]:
+        """
+        Holds the lock of a HUC, waiting for other jobs to release it. The lock
+        is refreshed in the background so that long downloads are not taken over.
+        """
+
+        lock_path = self.__lock_path(huc_id)
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+
+        deadline = time.time() + self.lock_timeout
+        while not self.__try_lock(lock_path):
+            if time.time() > deadline:
+                raise TimeoutError(f"Timed out waiting for the lock on HUC {huc_id}")
+            print(f"Waiting for another job to finish preparing HUC {huc_id}...")
+            time.sleep(poll_interval)
+
+        stop_heartbeat = self.__heartbeat(lock_path)
+        try:
+            yield
+        finally:
+            stop_heartbeat()
+            lock_path.unlink(missing_ok=True)
+
+    def __acquire_lease(self, huc_id: str) -> None:
+        if any(lease_path.parent.name == huc_id for lease_path in self.__leases):
+            return
+        lease_path = (
+            self.__lease_dir(huc_id)
+            / f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        )
+        lease_path.parent.mkdir(parents=True, exist_ok=True)
+        lease_path.touch()
+        self.__leases[lease_path] = self.__heartbeat(lease_path)
+
+    def release(self) -> None:
+        """
+        Releases the leases of the HUCs used by this job, so that they can be
+        evicted. This is called automatically when the process exits.
+        """
+
+        for lease_path, stop_heartbeat in list(self.__leases.items()):
+            stop_heartbeat()
+            lease_path.unlink(missing_ok=True)
+            del self.__leases[lease_path]
+
+    def is_leased(self, huc_id: str) -> bool:
+        """
+        Checks whether a HUC is in use by any job. Leases that have not been
+        refreshed, e.g. those of jobs that were killed, are removed.
+        """
+
+        leased = False
+        for lease_path in self.__lease_dir(huc_id).glob("*"):
+            try:
+                age = time.time() - lease_path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if age <= self.stale_lock:
+                leased = True
+            else:
+                print(f"Removing stale lease {lease_path} ({int(age)}s old)")
+                lease_path.unlink(missing_ok=True)
+        return leased
+
+    def is_complete(self, huc_id: str, verify_checksums: bool = False) -> bool:
+        """
+        Checks that a HUC has been downloaded completely, i.e. that its manifest
+        exists and every file in it is present with the recorded size (and checksum).
+        """
+
+        entry = self.entry_path(huc_id)
+        try:
+            with open(entry / MANIFEST_NAME, "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        for name, attrs in manifest.items():
+            path = entry / name
+            if not path.is_file() or path.stat().st_size != attrs["size"]:
+                print(f"HUC {huc_id} is incomplete: {name} is missing or truncated")
+                return False
+            if verify_checksums and sha256sum(path) != attrs["sha256"]:
+                print(f"HUC {huc_id} is corrupt: checksum mismatch for {name}")
+                return False
+        return True
+
+    def is_unmanaged(self, huc_id: str) -> bool:
+        """
+        Checks whether a HUC holds data that the cache did not download, i.e.
+        it has neither a manifest nor a partial download or eviction by the cache.
+        """
+
+        entry = self.entry_path(huc_id)
+        if (entry / MANIFEST_NAME).exists():
+            return False
+        if self.__incomplete_marker(huc_id).exists():
+            return False
+        return entry.is_dir() and any(entry.iterdir())
+
+    def finalize(self, huc_id: str) -> None:
+        """
+        Marks a downloaded HUC as complete by writing its manifest atomically.
+        """
+
+        entry = self.entry_path(huc_id)
+        manifest = build_manifest(entry)
+        tmp_path = entry / f"{MANIFEST_NAME}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, entry / MANIFEST_NAME)
+        self.__incomplete_marker(huc_id).unlink(missing_ok=True)
+
+    def touch(self, huc_id: str) -> None:
+        (self.entry_path(huc_id) / LAST_USED_NAME).touch(exist_ok=True)
+
+    def ensure(
+        self,
+        huc_id: str,
+        target: Path,
+        download: Callable[[], None],
+        setup: Callable[[], None],
+    ) -> bool:
+        """
+        Makes the input data of a HUC available at the target path, downloading
+        it into the cache unless a complete copy already exists. The HUC is leased
+        to this job until release() is called or the process exits, so that it is
+        not evicted while the job is still reading it.
+
+        Arguments:
+            huc_id - str: The HUC identifier for the watershed.
+            target - Path: The path where FIMserv expects the HUC data, e.g. /home/output/flood_{huc}/{huc}.
+            download - Callable: Downloads the HUC data into the target path and performs the setup tasks.
+            setup - Callable: Performs the setup tasks that are needed when the data is not downloaded.
+        Returns:
+            bool: True if the data was downloaded, False if the cached or existing copy was used.
+        """
+
+        entry = self.entry_path(huc_id)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        if not self.__link(Path(target), entry):
+            print(
+                f"{target} contains data that is not managed by the HUC cache. Using it as is."
+            )
+            setup()
+            return False
+
+        with self.lock(huc_id):
+            downloaded = False
+            if self.is_unmanaged(huc_id):
+                print(f"Adopting the existing data of HUC {huc_id} into the cache")
+                self.finalize(huc_id)
+            elif not self.is_complete(huc_id, self.verify_checksums):
+                if entry.exists():
+                    print(f"Removing incomplete data for HUC {huc_id}")
+                    shutil.rmtree(entry)
+                self.__mark_incomplete(huc_id)
+                # the target may be a link to the entry, so it must exist before downloading
+                entry.mkdir(parents=True, exist_ok=True)
+                download()
+                self.finalize(huc_id)
+                downloaded = True
+            self.touch(huc_id)
+
+            # the lease is taken while holding the lock, which evict
+            # also needs, so the HUC cannot be removed in between.
+            self.__acquire_lease(huc_id)
+
+        if not downloaded:
+            print("FIM Data Already Exists. Skipping download.")
+            setup()
+
+        self.evict(keep=huc_id)
+        return downloaded
+
+    def __link(self, target: Path, entry: Path) -> bool:
+        """
+        Links the path where FIMserv expects the data to the cache entry. Data
+        at the target that the cache did not create is never removed.
+
+        Returns:
+            bool: False if the target holds data of its own and was left untouched.
+        """
+
+        # the cache is mounted where FIMserv expects the data
+        if target.absolute() == entry.absolute():
+            return True
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if target.is_symlink():
+            if target.resolve() == entry.resolve():
+                return True
+            target.unlink()
+        elif target.is_dir():
+            # only an empty directory is replaced by the link
+            try:
+                target.rmdir()
+            except OSError:
+                return False
+        elif target.exists():
+            return False
+        target.symlink_to(entry, target_is_directory=True)
+        return True
+
+    def evict(self, keep: Union[str, None] = None) -> None:
+        """
+        Removes the least recently used HUCs until the cache fits within max_bytes.
+        HUCs that are locked or leased by a job are never removed. The size of a
+        HUC includes every file in its directory, not only those in its manifest.
+
+        Arguments:
+            keep - str: A HUC that must not be evicted, e.g. the one that is about to be used.
+        Returns:
+            None
+        """
+
+        if self.max_bytes <= 0:
+            return
+
+        entries = []
+        for manifest_path in self.root.glob(f"flood_*/*/{MANIFEST_NAME}"):
+            entry = manifest_path.parent
+            try:
+                size = directory_size(entry)
+                last_used_path = entry / LAST_USED_NAME
+                last_used = (
+                    (last_used_path if last_used_path.exists() else manifest_path)
+                    .stat()
+                    .st_mtime
+                )
+            except (OSError, ValueError):
+                continue
+            entries.append((last_used, entry.name, size))
+
+        total = sum(e[2] for e in entries)
+        for _, huc_id, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if huc_id == keep:
+                continue
+
+            lock_path = self.__lock_path(huc_id)
+            if not self.__try_lock(lock_path):
+                continue
+            try:
+                if self.is_leased(huc_id):
+                    continue
+                entry = self.entry_path(huc_id)
+                print(f"Evicting HUC {huc_id} from the cache ({size / 1e9:.1f} GB)")
+                # invalidate the entry first so that a partial removal is never used
+                self.__mark_incomplete(huc_id)
+                (entry / MANIFEST_NAME).unlink(missing_ok=True)
+                shutil.rmtree(entry, ignore_errors=True)
+                if not entry.exists():
+                    self.__incomplete_marker(huc_id).unlink(missing_ok=True)
+                total -= size
+            finally:
+                lock_path.unlink(missing_ok=True)
@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+
+"""
+The purpose of this script is to compute HAND based inundation for many
+flow scenarios of the same HUC in a single process. This follows the
+approach of the NOAA OWP inundation-mapping tools (inundate_mosaic_wrapper.py),
+where a pixel is inundated when the stage of its catchment, interpolated
+from the hydrotable, exceeds its height above nearest drainage (HAND), and
+the results of all branches are mosaicked. Unlike running the wrapper once
+per flow file, the HAND and catchment rasters and the hydrotables of the HUC
+are loaded once, memory-mapped from a local cache, and reused for every
+scenario. The catchments of all reaches of interest are located with a single
+pass over the rasters of each branch, which is shared by the engines of each reach.
+"""
+
+import os
+import json
+import threading
+import numpy
+import pandas
+import rasterio
+import rasterio.windows
+from pathlib import Path
+from functools import lru_cache
+from rasterio import Affine
+from typing import Dict, Iterable, List, Tuple, Union
+
+
+def default_cache_dir(huc_id: str) -> Path:
+    """
+    Returns the directory where memory-mappable copies of the inputs of a HUC are
+    kept. The copies are large and uncompressed, so they are kept on local disk
+    rather than next to the HUC data on the /home/output bucket mount. The root
+    can be changed with the FIM_NPY_CACHE_DIR environment variable.
+
+    Arguments:
+        huc_id - str: The HUC identifier for the watershed.
+    Returns:
+        Path: The cache directory of the HUC.
+    """
+
+    return Path(os.environ.get("FIM_NPY_CACHE_DIR", "/home/data/npy_cache")) / huc_id
+
+
+def __raster_to_npy(raster_path: Path, npy_path: Path, chunk_rows: int = 1024) -> None:
+    """
+    Converts the first band of a raster into a .npy file that can be memory-mapped,
+    along with a .json sidecar that holds its transform, crs, and nodata value.
+    The raster is copied in strips of rows so that it never has to fit in memory.
+
+    Arguments:
+        raster_path - Path: The raster to convert.
+        npy_path - Path: The path of the output .npy file.
+        chunk_rows - int: The number of rows to copy at a time.
+    Returns:
+        None
+    """
+
+    npy_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = npy_path.with_name(f".{npy_path.name}.{os.getpid()}.tmp")
+    with rasterio.open(raster_path) as src:
+        array = numpy.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=src.dtypes[0], shape=(src.height, src.width)
+        )
+        for row in range(0, src.height, chunk_rows):
+            window = rasterio.windows.Window(
+                0, row, src.width, min(chunk_rows, src.height - row)
+            )
+            array[row : row + window.height] = src.read(1, window=window)
+        array.flush()
+        del array
+
+        metadata = dict(
+            transform=list(src.transform)[:6],
+            crs=src.crs.to_wkt() if src.crs else None,
+            nodata=src.nodata,
+        )
+
+    json_tmp_path = npy_path.with_name(f".{npy_path.stem}.{os.getpid()}.json.tmp")
+    with open(json_tmp_path, "w") as f:
+        json.dump(metadata, f)
+    os.replace(json_tmp_path, npy_path.with_suffix(".json"))
+
+    # finalize the array last, since its existence marks the cache entry as complete
+    os.replace(tmp_path, npy_path)
+
+
+def load_raster(
+    raster_path: Path, cache_dir: Path
+) -> Tuple[numpy.ndarray, Affine, Union[str, None], Union[float, None]]:
+    """
+    Loads the first band of a raster as a read-only memory-mapped array. The
+    raster is converted into the cache directory the first time it is loaded
+    (or when it changes).
+
+    Arguments:
+        raster_path - Path: The raster to load.
+        cache_dir - Path: The directory where memory-mappable copies are kept.
+    Returns:
+        Tuple: The array, its transform, its crs as WKT, and its nodata value.
+    """
+
+    npy_path = Path(cache_dir) / f"{Path(raster_path).stem}.npy"
+    if (
+        not npy_path.exists()
+        or npy_path.stat().st_mtime < Path(raster_path).stat().st_mtime
+    ):
+        __raster_to_npy(Path(raster_path), npy_path)
+
+    with open(npy_path.with_suffix(".json"), "r") as f:
+        metadata = json.load(f)
+
+    array = numpy.load(npy_path, mmap_mode="r")
+    return (
+        array,
+        Affine(*metadata["transform"]),
+        metadata["crs"],
+        metadata["nodata"],
+    )
+
+
+# the hydrotable columns that are used to compute inundation and rating increments
+HYDROTABLE_COLUMNS = ("feature_id", "HydroID", "stage", "discharge_cms", "LakeID")
+
+
+def __hydrotable_to_npy(hydrotable_path: Path, npy_path: Path) -> None:
+    """
+    Converts a hydrotable into a .npy file that can be memory-mapped. The rows
+    are sorted by feature_id, so that the rows of a reach are contiguous and can
+    be found with a binary search instead of parsing and filtering the table.
+
+    Arguments:
+        hydrotable_path - Path: The hydroTable_{branch}.csv file to convert.
+        npy_path - Path: The path of the output .npy file.
+    Returns:
+        None
+    """
+
+    df = pandas.read_csv(
+        hydrotable_path, usecols=lambda c: c in HYDROTABLE_COLUMNS, low_memory=False
+    )
+    if "LakeID" not in df.columns:
+        df["LakeID"] = -999
+
+    # sort by feature_id, then HydroID, keeping the order of the rating curves
+    order = numpy.lexsort((df.HydroID.to_numpy(), df.feature_id.to_numpy()))
+    table = numpy.empty(
+        len(df),
+        dtype=[
+            ("feature_id", numpy.int64),
+            ("HydroID", numpy.int64),
+            ("stage", numpy.float64),
+            ("discharge_cms", numpy.float64),
+            ("LakeID", numpy.int64),
+        ],
+    )
+    for column in HYDROTABLE_COLUMNS:
+        table[column] = df[column].to_numpy()[order]
+
+    npy_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = npy_path.with_name(f".{npy_path.stem}.{os.getpid()}.tmp.npy")
+    numpy.save(tmp_path, table)
+    os.replace(tmp_path, npy_path)
+
+
+class HydroTable:
+    """
+    A hydrotable that is memory-mapped from its feature_id-sorted .npy copy.
+    """
+
+    def __init__(self, table: numpy.ndarray):
+        self.table = table
+        self.feature_ids = table["feature_id"]
+
+    def select(self, feature_ids: Iterable[int]) -> pandas.DataFrame:
+        """
+        Returns the rows of the hydrotable for the given feature_ids.
+
+        Arguments:
+            feature_ids - Iterable[int]: The NWM feature_ids of the reaches of interest.
+        Returns:
+            pandas.DataFrame: The rows of the reaches, with the HYDROTABLE_COLUMNS columns.
+        """
+
+        feature_ids = numpy.unique(numpy.asarray(list(feature_ids), dtype=numpy.int64))
+        starts = numpy.searchsorted(self.feature_ids, feature_ids, side="left")
+        ends = numpy.searchsorted(self.feature_ids, feature_ids, side="right")
+        rows = [numpy.arange(start, end) for start, end in zip(starts, ends)]
+        rows = numpy.concatenate(rows) if len(rows) > 0 else numpy.empty(0, int)
+        return pandas.DataFrame(self.table[rows])
+
+
+@lru_cache(maxsize=256)
+def load_hydrotable(hydrotable_path: Path, cache_dir: Path) -> HydroTable:
+    """
+    Loads a hydrotable for repeated lookups by feature_id. The table is converted
+    into the cache directory the first time it is loaded (or when it changes), and
+    loaded tables are kept in memory, so lookups do not parse the table again.
+
+    Arguments:
+        hydrotable_path - Path: The hydroTable_{branch}.csv file to load.
+        cache_dir - Path: The directory where memory-mappable copies are kept.
+    Returns:
+        HydroTable: The memory-mapped hydrotable.
+    """
+
+    npy_path = Path(cache_dir) / f"{Path(hydrotable_path).stem}.npy"
+    if (
+        not npy_path.exists()
+        or npy_path.stat().st_mtime < Path(hydrotable_path).stat().st_mtime
+    ):
+        __hydrotable_to_npy(Path(hydrotable_path), npy_path)
+
+    return HydroTable(numpy.load(npy_path, mmap_mode="r"))
+
+
+def index_catchments(
+    catchments: numpy.ndarray, hydroids: numpy.ndarray, chunk_rows: int = 256
+) -> numpy.ndarray:
+    """
+    Finds the bounding box of the catchment of each HydroID in a single pass
+    over a catchment raster, which is read in strips of rows.
+
+    Arguments:
+        catchments - numpy.ndarray: The (memory-mapped) catchment raster of a branch.
+        hydroids - numpy.ndarray: The sorted, unique HydroIDs to find.
+        chunk_rows - int: The number of rows to read at a time.
+    Returns:
+        numpy.ndarray: The row_min, row_max, col_min, and col_max (exclusive) of each
+        HydroID, with row_min >= row_max for HydroIDs that are not in the raster.
+    """
+
+    height, width = catchments.shape
+    row_min = numpy.full(len(hydroids), height, dtype=numpy.int64)
+    row_max = numpy.zeros(len(hydroids), dtype=numpy.int64)
+    col_min = numpy.full(len(hydroids), width, dtype=numpy.int64)
+    col_max = numpy.zeros(len(hydroids), dtype=numpy.int64)
+
+    for row in range(0, height, chunk_rows):
+        strip = numpy.asarray(catchments[row : row + chunk_rows])
+        index = numpy.searchsorted(hydroids, strip)
+        index = numpy.clip(index, 0, len(hydroids) - 1)
+        rows, cols = numpy.nonzero(hydroids[index] == strip)
+        if rows.size == 0:
+            continue
+
+        index = index[rows, cols]
+        numpy.minimum.at(row_min, index, rows + row)
+        numpy.maximum.at(row_max, index, rows + row + 1)
+        numpy.minimum.at(col_min, index, cols)
+        numpy.maximum.at(col_max, index, cols + 1)
+
+    return numpy.stack([row_min, row_max, col_min, col_max], axis=1)
+
+
+class Branch:
+    """
+    The inputs of a single HUC branch, restricted to the catchments of the
+    reaches of interest. The rasters are memory-mapped and only the window that
+    covers these catchments is used, so each scenario touches a small part of them.
+    """
+
+    def __init__(self, branch_dir: Path, branch_id: str, cache_dir: Path):
+        self.branch_dir = Path(branch_dir)
+        self.branch_id = branch_id
+        self.cache_dir = Path(cache_dir)
+
+    def prepare(
+        self,
+        hydrotable: pandas.DataFrame,
+        indexed_hydroids: numpy.ndarray,
+        bounds: numpy.ndarray,
+    ) -> bool:
+        """
+        Loads the rasters of the branch and indexes the catchments of the
+        HydroIDs in the hydrotable.
+
+        Arguments:
+            hydrotable - pandas.DataFrame: The hydrotable rows of the branch for the reaches of interest.
+            indexed_hydroids - numpy.ndarray: The sorted HydroIDs that were located by index_catchments.
+            bounds - numpy.ndarray: The bounding boxes of indexed_hydroids (see index_catchments).
+        Returns:
+            bool: True if any catchment of the reaches exists in the branch rasters.
+        """
+
+        # the rating curve of each HydroID, ordered by discharge
+        hydrotable = hydrotable.sort_values(["HydroID", "discharge_cms"])
+        self.hydroids = hydrotable.HydroID.unique()
+        self.feature_ids = (
+            hydrotable.groupby("HydroID", sort=True).feature_id.first().to_numpy()
+        )
+        self.curves = [
+            (group.discharge_cms.to_numpy(), group.stage.to_numpy())
+            for _, group in hydrotable.groupby("HydroID", sort=True)
+        ]
+
+        # find the window that covers the catchments of the reaches
+        bounds = bounds[numpy.searchsorted(indexed_hydroids, self.hydroids)]
+        bounds = bounds[bounds[:, 0] < bounds[:, 1]]
+        if len(bounds) == 0:
+            return False
+
+        rem, self.transform, self.crs, rem_nodata = load_raster(
+            self.branch_dir / f"rem_zeroed_masked_{self.branch_id}.tif", self.cache_dir
+        )
+        catchments, _, _, _ = load_raster(
+            self.branch_dir
+            / f"gw_catchments_reaches_filtered_addedAttributes_{self.branch_id}.tif",
+            self.cache_dir,
+        )
+
+        row_min, col_min = bounds[:, 0].min(), bounds[:, 2].min()
+        row_max, col_max = bounds[:, 1].max(), bounds[:, 3].max()
+        window = (slice(row_min, row_max), slice(col_min, col_max))
+        self.row_off, self.col_off = int(row_min), int(col_min)
+        self.shape = (int(row_max - row_min), int(col_max - col_min))
+
+        # index every pixel of the window into the list of HydroIDs once,
+        # so that each scenario only needs to look up the stages.
+        self.rem = numpy.asarray(rem[window], dtype=numpy.float32)
+        window_catchments = catchments[window]
+        index = numpy.searchsorted(self.hydroids, window_catchments)
+        index = numpy.clip(index, 0, len(self.hydroids) - 1)
+        self.index = index.astype(numpy.int32)
+        self.valid = self.hydroids[self.index] == window_catchments
+        if rem_nodata is not None:
+            self.valid &= self.rem != rem_nodata
+        self.valid &= numpy.isfinite(self.rem)
+
+        return True
+
+    def inundate(self, flows: Dict[int, float]) -> numpy.ndarray:
+        """
+        Computes the inundated pixels of the branch window for a flow scenario.
+
+        Arguments:
+            flows - Dict[int, float]: The discharge in cms of each NWM feature_id.
+        Returns:
+            numpy.ndarray: A boolean array of the inundated pixels in the branch window.
+        """
+
+        stages = numpy.zeros(len(self.hydroids), dtype=numpy.float32)
+        for i, (feature_id, (discharge, stage)) in enumerate(
+            zip(self.feature_ids, self.curves)
+        ):
+            flow = flows.get(int(feature_id))
+            if flow is not None:
+                stages[i] = numpy.interp(flow, discharge, stage)
+
+        return self.valid & (stages[self.index] > self.rem)
+
+
+class HucInundationEngine:
+    """
+    Computes inundation for many flow scenarios of a HUC, loading the
+    HUC inputs once.
+
+    Arguments:
+        huc_dir - Path: The directory of the HUC hydrofabric, e.g. /home/output/flood_{huc}/{huc}.
+        cache_dir - Path: The directory where memory-mappable copies of the inputs are kept (see default_cache_dir).
+    """
+
+    def __init__(self, huc_dir: Path, cache_dir: Union[Path, None] = None):
+        self.huc_dir = Path(huc_dir)
+        self.cache_dir = (
+            Path(cache_dir)
+            if cache_dir is not None
+            else default_cache_dir(self.huc_dir.name)
+        )
+        self.branches: List[Branch] = []
+        self.__index: Dict[str, Tuple[numpy.ndarray, numpy.ndarray]] = {}
+        self.__indexed = set()
+        self.__pending: Union[List[int], None] = None
+        self.__lock = threading.Lock()
+
+    def __branch_hydrotables(self, feature_ids: List[int]):
+        # the hydrotable rows of the reaches in each branch
+        for branch_dir in sorted((self.huc_dir / "branches").iterdir()):
+            branch_id = branch_dir.name
+            hydrotable_path = branch_dir / f"hydroTable_{branch_id}.csv"
+            if not hydrotable_path.exists():
+                continue
+
+            hydrotable = load_hydrotable(
+                hydrotable_path, self.cache_dir / branch_id
+            ).select(feature_ids)
+
+            # lake catchments are not mapped with HAND
+            hydrotable = hydrotable.loc[hydrotable.LakeID == -999]
+            if len(hydrotable) > 0:
+                yield branch_dir, branch_id, hydrotable
+
+    def index(self, feature_ids: Iterable[int]) -> None:
+        """
+        Locates the catchments of the reaches of interest in every branch, with a
+        single pass over the catchment raster of each branch. Engines for subsets
+        of these reaches (see subset) share the index, so that the rasters are not
+        scanned again for every reach.
+
+        Arguments:
+            feature_ids - Iterable[int]: The NWM feature_ids of all reaches of interest.
+        Returns:
+            None
+        """
+
+        feature_ids = [int(f) for f in feature_ids]
+        index = {}
+        for branch_dir, branch_id, hydrotable in self.__branch_hydrotables(feature_ids):
+            catchments, _, _, _ = load_raster(
+                branch_dir
+                / f"gw_catchments_reaches_filtered_addedAttributes_{branch_id}.tif",
+                self.cache_dir / branch_id,
+            )
+            hydroids = numpy.unique(hydrotable.HydroID.to_numpy())
+            index[branch_id] = (hydroids, index_catchments(catchments, hydroids))
+
+        # replace rather than update the index, since subsets share it
+        self.__index = index
+        self.__indexed = set(feature_ids)
+
+    def subset(self, feature_ids: Iterable[int]) -> "HucInundationEngine":
+        """
+        Creates an engine for a subset of the indexed reaches, which shares the
+        index of this engine. The engine is prepared when it is first used (see
+        inundate and footprint), so that engines can be created for many reaches
+        while only those that are being computed hold their inputs in memory.
+
+        Arguments:
+            feature_ids - Iterable[int]: The NWM feature_ids of the subset.
+        Returns:
+            HucInundationEngine: The engine of the subset.
+        """
+
+        engine = HucInundationEngine(self.huc_dir, self.cache_dir)
+        engine.__index = self.__index
+        engine.__indexed = self.__indexed
+        engine.__pending = [int(f) for f in feature_ids]
+        return engine
+
+    def __ensure_prepared(self) -> None:
+        if self.__pending is None:
+            return
+        with self.__lock:
+            if self.__pending is not None:
+                self.prepare(self.__pending)
+                self.__pending = None
+
+    def prepare(self, feature_ids: Iterable[int]) -> None:
+        """
+        Loads the inputs of every branch that contains the reaches of interest.
+
+        Arguments:
+            feature_ids - Iterable[int]: The NWM feature_ids that scenarios will provide flows for.
+        Returns:
+            None
+        """
+
+        feature_ids = [int(f) for f in feature_ids]
+        if not self.__indexed.issuperset(feature_ids):
+            self.index(feature_ids)
+
+        self.branches = []
+        for branch_dir, branch_id, hydrotable in self.__branch_hydrotables(feature_ids):
+            if branch_id not in self.__index:
+                continue
+            branch = Branch(branch_dir, branch_id, self.cache_dir / branch_id)
+            if branch.prepare(hydrotable, *self.__index[branch_id]):
+                self.branches.append(branch)
+
+        if len(self.branches) == 0:
+            raise ValueError(f"No catchments found for feature_ids {feature_ids}")
+
+        # mosaic the branches onto the union of their windows
+        res_x = self.branches[0].transform.a
+        res_y = -self.branches[0].transform.e
+        bounds = []
+        for branch in self.branches:
+            left, top = branch.transform * (branch.col_off, branch.row_off)
+            bounds.append(
+                (
+                    left,
+                    top,
+                    left + branch.shape[1] * res_x,
+                    top - branch.shape[0] * res_y,
+                )
+            )
+        left = min(b[0] for b in bounds)
+        top = max(b[1] for b in bounds)
+        right = max(b[2] for b in bounds)
+        bottom = min(b[3] for b in bounds)
+
+        self.shape = (
+            int(round((top - bottom) / res_y)),
+            int(round((right - left) / res_x)),
+        )
+        self.transform = Affine(res_x, 0, left, 0, -res_y, top)
+        self.crs = self.branches[0].crs
+        self.offsets = [
+            (int(round((top - b[1]) / res_y)), int(round((b[0] - left) / res_x)))
+            for b in bounds
+        ]
+
+    def inundate(self, flows: Dict[int, float]) -> numpy.ndarray:
+        """
+        Computes the inundation of a flow scenario, mosaicked across branches.
+
+        Arguments:
+            flows - Dict[int, float]: The discharge in cms of each NWM feature_id.
+        Returns:
+            numpy.ndarray: A uint8 mask on the engine grid (see transform and crs),
+            where inundated pixels are 1 and all others are 0.
+        """
+
+        self.__ensure_prepared()
+        mask = numpy.zeros(self.shape, dtype=numpy.uint8)
+        for branch, (row, col) in zip(self.branches, self.offsets):
+            window = mask[row : row + branch.shape[0], col : col + branch.shape[1]]
+            window |= branch.inundate(flows)
+        return mask
+
+    def footprint(self) -> numpy.ndarray:
+        """
+        Returns the pixels where the reaches of interest can be inundated, i.e.
+        their catchments in any branch, on the engine grid.
+
+        Returns:
+            numpy.ndarray: A boolean array on the engine grid (see transform and crs).
+        """
+
+        self.__ensure_prepared()
+        mask = numpy.zeros(self.shape, dtype=bool)
+        for branch, (row, col) in zip(self.branches, self.offsets):
+            window = mask[row : row + branch.shape[0], col : col + branch.shape[1]]
+            window |= branch.valid
+        return mask
@@ -8,11 +8,17 @@ from dotenv import load_dotenv
 from .datadownload import setup_directories
 
 
-def runfim(code_dir, output_dir, HUC_code, data_dir, label="", depth=False):
+def runfim(
+    code_dir, output_dir, HUC_code, data_dir, label="", depth=False, inundation_dir=None
+):
     """
     TC: 06/21/25 The label parameter was added to this function so that unique output directories
         could be created for running FIM operations in parallel. This prevents the moasic
         FIM operations from merging outputs from multuple runs of the same HUC code.
+
+    The inundation_dir parameter places the output in the given directory instead of
+    {output_dir}/flood_{HUC_code}/{HUC_code}_inundation/{label}, e.g. in a working
+    directory on local disk that belongs to a single job.
     """
 
     original_dir = os.getcwd()
@@ -30,7 +36,9 @@ def runfim(code_dir, output_dir, HUC_code, data_dir, label="", depth=False):
         csv_path = data_dir
 
         discharge_basename = os.path.basename(data_dir).split(".")[0]
-        inundation_dir = os.path.join(HUC_dir, f"{HUC_code}_inundation", label)
+        if inundation_dir is None:
+            inundation_dir = os.path.join(HUC_dir, f"{HUC_code}_inundation", label)
+        inundation_dir = str(inundation_dir)
         temp_dir = os.path.join(inundation_dir, "temp")
         print("Inundation directory:", inundation_dir)
         print("TEMP directory:", temp_dir)
@@ -15,7 +15,7 @@ import re
 import time
 import json
 import typer
-from typing import List
+from typing import List, Tuple
 from pathlib import Path
 from rich.live import Live
 from rich.table import Table
@@ -97,13 +97,13 @@ def show_progress_long(run_client, jobs):
                     )
 
                     if job["status"] == "FAILED":
-                        failed.append(job["args"].split(",")[2])
+                        failed.extend(job["reach_ids"])
 
                 # add data to the table
                 table.add_row(
                     job["execution"].split("/")[-1],
-                    job["args"].split(",")[1],  # HUC8
-                    job["args"].split(",")[2],  # ReachID
+                    job["huc"],  # HUC8
+                    ",".join(job["reach_ids"]),  # ReachID
                     job["status"],
                     job["elapsed_time"],
                 )
@@ -142,7 +142,7 @@ def show_progress_short(run_client, jobs):
                     job["status"] = get_execution_status(run_client, job["execution"])
 
                     if job["status"] == "FAILED":
-                        failed.append(job["args"].split(",")[2])
+                        failed.extend(job["reach_ids"])
                         count_running -= 1
                     elif job["status"] == "SUCCEEDED":
                         count_succeeded += 1
@@ -167,8 +167,58 @@ def show_progress_short(run_client, jobs):
     return failed
 
 
+def batch_jobs(
+    pending: List[List[str]], batch_size: int
+) -> List[Tuple[List[str], str, List[str]]]:
+    """
+    Converts the lines of a cloudrun-inputs file into the arguments of the jobs
+    to submit. With a batch_size above 1, the reachfim_interval lines of the same
+    HUC and settings are grouped into hucfim_interval jobs of up to batch_size
+    reaches, which set up the HUC once and save each reach in a subdirectory
+    named after the reachid, like the single reach jobs.
+
+    Arguments:
+        pending - List[List[str]]: The comma separated arguments of each line, e.g.
+                                   [reachfim_interval, huc, reachid, stage_increment, ...].
+        batch_size - int: The maximum number of reaches in a hucfim_interval job.
+    Returns:
+        List[Tuple[List[str], str, List[str]]]: The arguments, HUC, and reachids of each job.
+    """
+
+    batches = []
+    if batch_size > 1:
+        groups = {}
+        for args in pending:
+            if args[0] == "reachfim_interval":
+                key = (args[1], *args[3:])
+                groups.setdefault(key, []).append(args[2])
+            else:
+                batches.append((args, args[1], [args[2]]))
+        for (huc, *settings), reach_ids in groups.items():
+            for i in range(0, len(reach_ids), batch_size):
+                chunk = reach_ids[i : i + batch_size]
+                args = ["hucfim_interval", huc, ",".join(chunk), *settings]
+                batches.append((args, huc, chunk))
+    else:
+        for args in pending:
+            # pass the reachid as an argument so that outputs are saved in
+            # a subdirectory named after the reachid
+            batches.append((args + [args[2]], args[1], [args[2]]))
+    return batches
+
+
 @app.command()
-def run(file: Path, verbose: Annotated[bool, typer.Option("--verbose")] = False):
+def run(
+    file: Path,
+    verbose: Annotated[bool, typer.Option("--verbose")] = False,
+    batch_size: Annotated[
+        int,
+        typer.Option(
+            "--batch-size",
+            help="Submit reachfim_interval lines of the same HUC as hucfim_interval jobs of up to this many reaches.",
+        ),
+    ] = 1,
+):
 
     # Use ADC
     credentials, _ = default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
@@ -193,8 +243,8 @@ def run(file: Path, verbose: Annotated[bool, typer.Option("--verbose")] = False)
         with open(Path("failed_reachids.txt"), "r") as f:
             failed_reachids = f.read().splitlines()
 
-    # Start all jobs
-    submitted_job_count = 0
+    # collect the jobs that still need to run
+    pending = []
     for line in lines:
         args = line.split(",")
 
@@ -207,14 +257,19 @@ def run(file: Path, verbose: Annotated[bool, typer.Option("--verbose")] = False)
         if args[2] in failed_reachids:
             continue
 
-        # pass the reachid as an argument so that outputs are saved in
-        # a subdirectory named after the reachid
-        args.append(f"{args[2]}")
+        pending.append(args)
+
+    batches = batch_jobs(pending, batch_size)
 
+    # Start all jobs
+    submitted_job_count = 0
+    for args, huc, reach_ids in batches:
         execution_id = execute_job(run_client, args)
         jobs.append(
             {
-                "args": line,
+                "args": ",".join(args),
+                "huc": huc,
+                "reach_ids": reach_ids,
                 "execution": execution_id,
                 "status": "Starting",
                 "start_time": datetime.now(),
@@ -0,0 +1,90 @@
+import sys
+from pathlib import Path
+
+import numpy
+import pandas
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+# the FIM scripts are run from the fim directory and import each other as top-level modules
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+TRANSFORM = from_origin(0, 200, 10, 10)
+SHAPE = (20, 30)
+REM_NODATA = -9999.0
+
+
+def write_raster(path: Path, data: numpy.ndarray, nodata) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=data.shape[0],
+        width=data.shape[1],
+        count=1,
+        dtype=data.dtype,
+        crs="EPSG:5070",
+        transform=TRANSFORM,
+        nodata=nodata,
+    ) as dst:
+        dst.write(data, 1)
+
+
+def rating_curve(
+    feature_id: int, hydroid: int, lake_id: int = -999
+) -> pandas.DataFrame:
+    stages = numpy.arange(0, 3.01, 0.5)
+    return pandas.DataFrame(
+        dict(
+            HydroID=hydroid,
+            feature_id=feature_id,
+            stage=stages,
+            discharge_cms=stages * 10,
+            LakeID=lake_id,
+        )
+    )
+
+
+@pytest.fixture
+def huc_dir(tmp_path) -> Path:
+    """
+    A synthetic HUC with two branches on a 20 x 30 grid:
+
+      branch 0 - reaches 1 and 2 (HydroIDs 101 and 102), and lake reach 3 (HydroID 103)
+      branch 1 - reach 2 (HydroID 201), covering the top rows of reach 2's catchment in branch 0
+
+    The REM increases by 0.1 m per row, with a nodata pixel in each catchment of branch 0.
+    """
+
+    huc_dir = tmp_path / "12345678"
+    rem = numpy.repeat(
+        numpy.arange(SHAPE[0], dtype="float32")[:, None] * 0.1, SHAPE[1], axis=1
+    )
+
+    branch = huc_dir / "branches" / "0"
+    catchments = numpy.zeros(SHAPE, dtype="int32")
+    catchments[:, 0:10] = 101
+    catchments[:, 10:20] = 102
+    catchments[:, 20:30] = 103
+    rem_0 = rem.copy()
+    rem_0[5, [5, 15, 25]] = REM_NODATA
+    write_raster(branch / "rem_zeroed_masked_0.tif", rem_0, REM_NODATA)
+    write_raster(
+        branch / "gw_catchments_reaches_filtered_addedAttributes_0.tif", catchments, 0
+    )
+    pandas.concat(
+        [rating_curve(1, 101), rating_curve(2, 102), rating_curve(3, 103, lake_id=7)]
+    ).to_csv(branch / "hydroTable_0.csv", index=False)
+
+    branch = huc_dir / "branches" / "1"
+    catchments = numpy.zeros(SHAPE, dtype="int32")
+    catchments[0:5, 12:18] = 201
+    write_raster(branch / "rem_zeroed_masked_1.tif", rem * 0.5, REM_NODATA)
+    write_raster(
+        branch / "gw_catchments_reaches_filtered_addedAttributes_1.tif", catchments, 0
+    )
+    rating_curve(2, 201).to_csv(branch / "hydroTable_1.csv", index=False)
+
+    return huc_dir
@@ -0,0 +1,46 @@
+import numpy
+import pandas
+import pytest
+
+from compute_rating_increments import interpolate_many, interpolate_y
+
+
+@pytest.fixture
+def curve():
+    # unsorted on purpose, interpolation must sort by the x column
+    return pandas.DataFrame(
+        dict(stage=[1.0, 0.0, 2.0, 0.5], discharge_cms=[20.0, 0.0, 60.0, 5.0])
+    )
+
+
+def test_interpolate_many_matches_scalar_interpolation(curve):
+    stages = numpy.array([0.0, 0.25, 0.5, 0.75, 1.5, 2.0])
+    discharges = interpolate_many(curve, "stage", "discharge_cms", stages)
+
+    numpy.testing.assert_allclose(discharges, [0.0, 2.5, 5.0, 12.5, 40.0, 60.0])
+    for stage, discharge in zip(stages, discharges):
+        assert interpolate_y(curve, "stage", "discharge_cms", stage) == pytest.approx(
+            discharge
+        )
+
+
+def test_interpolate_many_is_inverse_of_rating_curve(curve):
+    discharges = numpy.array([0.0, 2.5, 12.5, 40.0])
+    numpy.testing.assert_allclose(
+        interpolate_many(curve, "discharge_cms", "stage", discharges),
+        [0.0, 0.25, 0.75, 1.5],
+    )
+
+
+def test_interpolate_many_out_of_range(curve):
+    result = interpolate_many(
+        curve, "stage", "discharge_cms", numpy.array([-0.1, 1.0, 2.1])
+    )
+    numpy.testing.assert_allclose(result, [-9999.0, 20.0, -9999.0])
+
+
+def test_interpolate_many_keeps_shape(curve):
+    assert interpolate_many(curve, "stage", "discharge_cms", 0.25).shape == ()
+    assert interpolate_many(
+        curve, "stage", "discharge_cms", numpy.zeros((2, 3))
+    ).shape == (2, 3)
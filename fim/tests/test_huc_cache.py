@@ -0,0 +1,256 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from huc_cache import MANIFEST_NAME, HucInputCache
+
+
+@pytest.fixture
+def cache_root(tmp_path):
+    return tmp_path / "cache"
+
+
+def download_into(cache, huc_id, size=1000, calls=None):
+    def download():
+        if calls is not None:
+            calls.append(huc_id)
+        entry = cache.entry_path(huc_id)
+        (entry / "branches" / "0").mkdir(parents=True, exist_ok=True)
+        (entry / "branches" / "0" / "rem.tif").write_bytes(b"x" * size)
+        time.sleep(0.05)
+
+    return download
+
+
+def run_job(cache_root, huc_id, size=1000, calls=None, **kwargs):
+    """
+    Ensures a HUC like a FIM job would, returning the cache that holds its lease.
+    """
+    cache = HucInputCache(cache_root, stale_lock=2, **kwargs)
+    cache.ensure(
+        huc_id,
+        cache.entry_path(huc_id),
+        download_into(cache, huc_id, size, calls),
+        setup=lambda: None,
+    )
+    return cache
+
+
+def test_incomplete_download_is_repeated(cache_root):
+    cache = HucInputCache(cache_root)
+
+    def failing_download():
+        (cache.entry_path("1") / "partial.tif").write_bytes(b"x")
+        raise RuntimeError("interrupted")
+
+    with pytest.raises(RuntimeError):
+        cache.ensure("1", cache.entry_path("1"), failing_download, setup=lambda: None)
+    assert not cache.is_complete("1")
+
+    calls = []
+    run_job(cache_root, "1", calls=calls).release()
+    assert calls == ["1"]
+    assert cache.is_complete("1", verify_checksums=True)
+    assert not (cache.entry_path("1") / "partial.tif").exists()
+
+
+def test_corrupt_file_is_detected(cache_root):
+    run_job(cache_root, "1").release()
+    cache = HucInputCache(cache_root)
+
+    (cache.entry_path("1") / "branches" / "0" / "rem.tif").write_bytes(b"y" * 1000)
+    assert cache.is_complete("1")
+    assert not cache.is_complete("1", verify_checksums=True)
+
+
+def test_concurrent_jobs_download_once(cache_root):
+    calls = []
+    jobs = [
+        threading.Thread(target=run_job, args=(cache_root, "1", 1000, calls))
+        for _ in range(3)
+    ]
+    for job in jobs:
+        job.start()
+    for job in jobs:
+        job.join()
+
+    assert calls == ["1"]
+
+
+def test_evicts_least_recently_used(cache_root):
+    for huc_id in ("1", "2"):
+        run_job(cache_root, huc_id).release()
+        time.sleep(0.05)
+
+    # using HUC 1 again makes HUC 2 the least recently used one
+    run_job(cache_root, "1").release()
+    run_job(cache_root, "3", max_bytes=2500).release()
+
+    cache = HucInputCache(cache_root)
+    assert cache.is_complete("1") and cache.is_complete("3")
+    assert not cache.entry_path("2").exists()
+
+
+def test_size_includes_files_outside_the_manifest(cache_root):
+    run_job(cache_root, "1", size=100).release()
+    run_job(cache_root, "2", size=100).release()
+
+    # e.g. a cache written next to the HUC data after the manifest
+    extra = HucInputCache(cache_root).entry_path("1") / "npy_cache" / "rem.npy"
+    extra.parent.mkdir()
+    extra.write_bytes(b"x" * 1000)
+
+    run_job(cache_root, "2", size=100, max_bytes=1000).release()
+    assert not HucInputCache(cache_root).entry_path("1").exists()
+
+
+def test_leased_huc_is_not_evicted(cache_root):
+    job = run_job(cache_root, "1")
+    time.sleep(0.05)
+    run_job(cache_root, "2", max_bytes=1500).release()
+
+    cache = HucInputCache(cache_root)
+    assert cache.is_complete("1")
+
+    # the lease is refreshed beyond stale_lock while the job is running
+    time.sleep(2.5)
+    assert cache.is_leased("1")
+
+    job.release()
+    assert not cache.is_leased("1")
+    run_job(cache_root, "2", max_bytes=1500).release()
+    assert not cache.entry_path("1").exists()
+
+
+def test_stale_lease_is_removed(cache_root):
+    lease_path = cache_root / ".leases" / "1" / "killed-job"
+    lease_path.parent.mkdir(parents=True)
+    lease_path.touch()
+    os.utime(lease_path, (0, 0))
+
+    assert not HucInputCache(cache_root, stale_lock=2).is_leased("1")
+    assert not lease_path.exists()
+
+
+def test_stale_lock_is_taken_over(cache_root):
+    lock_path = cache_root / ".locks" / "1.lock"
+    lock_path.parent.mkdir(parents=True)
+    lock_path.write_text(json.dumps(dict(host="killed", pid=1, id="stale")))
+    os.utime(lock_path, (0, 0))
+
+    start = time.time()
+    run_job(cache_root, "1").release()
+
+    assert time.time() - start < 5
+    assert not lock_path.exists()
+    assert (HucInputCache(cache_root).entry_path("1") / MANIFEST_NAME).exists()
+
+
+def test_fresh_lock_is_not_taken_over(cache_root):
+    cache = HucInputCache(cache_root, stale_lock=2, lock_timeout=0.5)
+    lock_path = cache_root / ".locks" / "1.lock"
+    lock_path.parent.mkdir(parents=True)
+    lock_path.write_text(json.dumps(dict(host="other", pid=1, id="fresh")))
+
+    with pytest.raises(TimeoutError):
+        with cache.lock("1", poll_interval=0.1):
+            pass
+    assert json.loads(lock_path.read_text())["id"] == "fresh"
+
+
+def test_takeover_does_not_steal_a_replaced_lock(cache_root, monkeypatch):
+    cache = HucInputCache(cache_root, stale_lock=2)
+    lock_path = cache_root / ".locks" / "1.lock"
+    lock_path.parent.mkdir(parents=True)
+    lock_path.write_text(json.dumps(dict(id="stale")))
+    os.utime(lock_path, (0, 0))
+
+    # another job takes over the stale lock and locks again right after it is checked
+    read_lock = cache._HucInputCache__read_lock
+    reads = []
+
+    def racing_read_lock(path):
+        result = read_lock(path)
+        reads.append(path)
+        if len(reads) == 1:
+            lock_path.write_text(json.dumps(dict(id="replaced")))
+        return result
+
+    monkeypatch.setattr(cache, "_HucInputCache__read_lock", racing_read_lock)
+
+    assert not cache._HucInputCache__try_lock(lock_path)
+    assert json.loads(lock_path.read_text())["id"] == "replaced"
+    assert list(lock_path.parent.glob("*.stale")) == []
+
+
+def test_existing_data_is_adopted(cache_root):
+    # e.g. a HUC that was downloaded to /home/output before the cache was used
+    cache = HucInputCache(cache_root)
+    rem = cache.entry_path("1") / "branches" / "0" / "rem.tif"
+    rem.parent.mkdir(parents=True)
+    rem.write_bytes(b"x" * 1000)
+
+    calls = []
+    setups = []
+    downloaded = cache.ensure(
+        "1",
+        cache.entry_path("1"),
+        download_into(cache, "1", calls=calls),
+        setup=lambda: setups.append("1"),
+    )
+    cache.release()
+
+    assert not downloaded and calls == [] and setups == ["1"]
+    assert rem.exists()
+    assert cache.is_complete("1", verify_checksums=True)
+
+
+def test_interrupted_eviction_is_not_adopted(cache_root, monkeypatch):
+    run_job(cache_root, "1").release()
+    run_job(cache_root, "2").release()
+
+    # the removal of the least recently used HUC fails halfway
+    monkeypatch.setattr("shutil.rmtree", lambda path, ignore_errors=False: None)
+    run_job(cache_root, "2", max_bytes=1500).release()
+    monkeypatch.undo()
+
+    calls = []
+    run_job(cache_root, "1", calls=calls).release()
+    assert calls == ["1"]
+
+
+def test_unmanaged_target_is_not_removed(cache_root, tmp_path):
+    target = tmp_path / "output" / "flood_1" / "1"
+    (target / "hydrotable.csv").parent.mkdir(parents=True)
+    (target / "hydrotable.csv").write_text("HydroID")
+
+    cache = HucInputCache(cache_root)
+    calls = []
+    setups = []
+    downloaded = cache.ensure(
+        "1",
+        target,
+        download_into(cache, "1", calls=calls),
+        setup=lambda: setups.append("1"),
+    )
+
+    assert not downloaded and calls == [] and setups == ["1"]
+    assert not target.is_symlink()
+    assert (target / "hydrotable.csv").read_text() == "HydroID"
+
+
+def test_empty_target_is_linked(cache_root, tmp_path):
+    target = tmp_path / "output" / "flood_1" / "1"
+    target.mkdir(parents=True)
+
+    cache = HucInputCache(cache_root)
+    calls = []
+    cache.ensure("1", target, download_into(cache, "1", calls=calls), lambda: None)
+    cache.release()
+
+    assert calls == ["1"]
+    assert target.is_symlink() and target.resolve() == cache.entry_path("1").resolve()
+    assert (target / "branches" / "0" / "rem.tif").exists()
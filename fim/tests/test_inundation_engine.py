@@ -0,0 +1,123 @@
+import numpy
+import pandas
+import pytest
+import rasterio
+
+from conftest import REM_NODATA, TRANSFORM
+from inundation_engine import HucInundationEngine, index_catchments, load_hydrotable
+
+
+def brute_force_inundation(huc_dir, flows):
+    """
+    Inundates every pixel of the HUC grid whose REM is below the stage of its
+    catchment, in any branch. Lake catchments are never inundated.
+    """
+
+    mask = None
+    for branch_dir in sorted((huc_dir / "branches").iterdir()):
+        b = branch_dir.name
+        with rasterio.open(branch_dir / f"rem_zeroed_masked_{b}.tif") as src:
+            rem = src.read(1)
+        with rasterio.open(
+            branch_dir / f"gw_catchments_reaches_filtered_addedAttributes_{b}.tif"
+        ) as src:
+            catchments = src.read(1)
+        if mask is None:
+            mask = numpy.zeros(rem.shape, dtype=bool)
+
+        hydrotable = pandas.read_csv(branch_dir / f"hydroTable_{b}.csv")
+        for hydroid, curve in hydrotable.groupby("HydroID"):
+            feature_id = int(curve.feature_id.iloc[0])
+            if feature_id not in flows or (curve.LakeID != -999).any():
+                continue
+            stage = numpy.interp(flows[feature_id], curve.discharge_cms, curve.stage)
+            mask |= (catchments == hydroid) & (rem != REM_NODATA) & (stage > rem)
+    return mask
+
+
+def on_huc_grid(mask, transform, shape):
+    # place an engine mask on the full grid of the synthetic HUC
+    col, row = ~TRANSFORM * (transform.c, transform.f)
+    row, col = int(round(row)), int(round(col))
+    full = numpy.zeros(shape, dtype=bool)
+    full[row : row + mask.shape[0], col : col + mask.shape[1]] = mask > 0
+    return full
+
+
+def test_index_catchments_bounds():
+    catchments = numpy.zeros((10, 8), dtype="int32")
+    catchments[2:5, 1:3] = 7
+    catchments[6, 4:8] = 9
+    catchments[9, 0] = 7
+
+    bounds = index_catchments(catchments, numpy.array([5, 7, 9]), chunk_rows=3)
+
+    assert bounds[0, 0] >= bounds[0, 1]
+    assert bounds[1].tolist() == [2, 10, 0, 3]
+    assert bounds[2].tolist() == [6, 7, 4, 8]
+
+
+def test_hydrotable_select(huc_dir, tmp_path):
+    hydrotable = load_hydrotable(
+        huc_dir / "branches/0/hydroTable_0.csv", tmp_path / "cache"
+    )
+
+    rows = hydrotable.select([3, 1, 42])
+
+    assert sorted(rows.feature_id.unique()) == [1, 3]
+    assert (rows.loc[rows.feature_id == 1, "HydroID"] == 101).all()
+    assert len(hydrotable.select([])) == 0
+
+
+@pytest.mark.parametrize(
+    "flows",
+    [
+        {1: 5.0},
+        {2: 12.5},
+        {1: 30.0, 2: 3.0},
+        {1: 7.5, 2: 25.0, 3: 30.0},
+    ],
+)
+def test_engine_matches_brute_force(huc_dir, tmp_path, flows):
+    engine = HucInundationEngine(huc_dir, tmp_path / "cache")
+    engine.prepare(flows.keys())
+
+    mask = engine.inundate(flows)
+
+    expected = brute_force_inundation(huc_dir, flows)
+    assert mask.dtype == numpy.uint8
+    numpy.testing.assert_array_equal(
+        on_huc_grid(mask, engine.transform, expected.shape), expected
+    )
+
+
+def test_subset_shares_index(huc_dir, tmp_path):
+    huc_engine = HucInundationEngine(huc_dir, tmp_path / "cache")
+    huc_engine.index([1, 2])
+
+    for feature_id in (1, 2):
+        subset = huc_engine.subset([feature_id])
+        engine = HucInundationEngine(huc_dir, tmp_path / "cache")
+        engine.prepare([feature_id])
+
+        flows = {feature_id: 20.0}
+        numpy.testing.assert_array_equal(subset.inundate(flows), engine.inundate(flows))
+        assert subset.transform == engine.transform
+
+
+def test_footprint_covers_catchments(huc_dir, tmp_path):
+    engine = HucInundationEngine(huc_dir, tmp_path / "cache").subset([2])
+
+    footprint = on_huc_grid(engine.footprint(), engine.transform, (20, 30))
+
+    expected = numpy.zeros((20, 30), dtype=bool)
+    expected[:, 10:20] = True
+    expected[5, 15] = False
+    assert footprint.sum() == expected.sum()
+    numpy.testing.assert_array_equal(footprint, expected)
+
+
+def test_lake_reaches_are_not_mapped(huc_dir, tmp_path):
+    engine = HucInundationEngine(huc_dir, tmp_path / "cache")
+    with pytest.raises(ValueError):
+        engine.prepare([3])
@@ -0,0 +1,90 @@
+import pytest
+
+pytest.importorskip("googleapiclient")
+pytest.importorskip("google.cloud.storage")
+
+from submit_cloudrun import batch_jobs
+
+
+def lines(*rows):
+    return [row.split(",") for row in rows]
+
+
+def test_single_reach_jobs_save_to_reach_subdirectory():
+    pending = lines("reachfim_interval,01080106,10102360,0.5,10")
+
+    assert batch_jobs(pending, 1) == [
+        (
+            ["reachfim_interval", "01080106", "10102360", "0.5", "10", "10102360"],
+            "01080106",
+            ["10102360"],
+        )
+    ]
+
+
+def test_reaches_of_a_huc_are_batched():
+    pending = lines(
+        "reachfim_interval,01080106,1,0.5,10",
+        "reachfim_interval,01080106,2,0.5,10",
+        "reachfim_interval,01080106,3,0.5,10",
+        "reachfim_interval,01080106,4,0.5,10",
+        "reachfim_interval,01080106,5,0.5,10",
+    )
+
+    batches = batch_jobs(pending, 2)
+
+    assert [args for args, _, _ in batches] == [
+        ["hucfim_interval", "01080106", "1,2", "0.5", "10"],
+        ["hucfim_interval", "01080106", "3,4", "0.5", "10"],
+        ["hucfim_interval", "01080106", "5", "0.5", "10"],
+    ]
+    assert [reach_ids for _, _, reach_ids in batches] == [["1", "2"], ["3", "4"], ["5"]]
+    assert all(huc == "01080106" for _, huc, _ in batches)
+
+
+def test_batches_do_not_mix_hucs_or_settings():
+    pending = lines(
+        "reachfim_interval,01080106,1,0.5,10",
+        "reachfim_interval,01080107,2,0.5,10",
+        "reachfim_interval,01080106,3,0.25,10",
+        "reachfim_interval,01080106,4,0.5,10",
+    )
+
+    batches = batch_jobs(pending, 100)
+
+    assert sorted(args for args, _, _ in batches) == [
+        ["hucfim_interval", "01080106", "1,4", "0.5", "10"],
+        ["hucfim_interval", "01080106", "3", "0.25", "10"],
+        ["hucfim_interval", "01080107", "2", "0.5", "10"],
+    ]
+
+
+def test_other_commands_are_submitted_unchanged():
+    pending = lines(
+        "reachfim,01080106,1,100.0",
+        "reachfim_interval,01080106,2,0.5,10",
+    )
+
+    batches = batch_jobs(pending, 10)
+
+    assert (["reachfim", "01080106", "1", "100.0"], "01080106", ["1"]) in batches
+    assert (
+        ["hucfim_interval", "01080106", "2", "0.5", "10"],
+        "01080106",
+        ["2"],
+    ) in batches
+    assert len(batches) == 2
+
+
+def test_every_reach_is_submitted_once():
+    pending = lines(
+        *[f"reachfim_interval,0108010{i % 3},{i},0.5,10" for i in range(23)]
+    )
+
+    batches = batch_jobs(pending, 4)
+
+    reach_ids = [r for _, _, chunk in batches for r in chunk]
+    assert sorted(reach_ids, key=int) == [str(i) for i in range(23)]
+    assert all(len(chunk) <= 4 for _, _, chunk in batches)
+    for args, huc, chunk in batches:
+        assert args[1] == huc and args[2] == ",".join(chunk)